@@ -8,9 +8,13 @@ Usage:
 diagonal_partition.py <max-segments> <lastz-command>
 
 set <max-segments> = 0 to skip partitioning, -1 to estimate best parameter
+
+<lastz-command> is either the words of a lastz shell command line or a
+single JSON object as printed by kegalign --json_commands
 """
 
 import collections
+import json
 import os
 import statistics
 import sys
@@ -52,14 +56,24 @@ if __name__ == "__main__":
     segment_index = None
     input_file = None
 
-    for index, value in enumerate(params):
-        if value[:len(segment_key)] == segment_key:
-            segment_index = index
-            input_file = value[len(segment_key):]
-            break
+    command_json: dict[str, typing.Any] | None = None
+    if len(params) == 1 and params[0].startswith("{"):
+        try:
+            command_json = json.loads(params[0])
+        except json.JSONDecodeError:
+            sys.exit(f"Error: could not parse JSON command {params[0]}")
+
+    if command_json is not None:
+        input_file = command_json.get("segments")
+    else:
+        for index, value in enumerate(params):
+            if value[:len(segment_key)] == segment_key:
+                segment_index = index
+                input_file = value[len(segment_key):]
+                break
 
-    if segment_index is None:
-        sys.exit(f"Error: could not get segment key {segment_key} from parameters {params}")
+        if segment_index is None:
+            sys.exit(f"Error: could not get segment key {segment_key} from parameters {params}")
 
     if input_file is None:
         sys.exit(f"Error: could not get segment file from parameters {params}")
@@ -122,15 +136,29 @@ if __name__ == "__main__":
     output_format = None
 
     strand_key = "--strand="
-    strand_index = None
-    for index, value in enumerate(params):
-        if value[:len(output_key)] == output_key:
-            output_index = index
-            output_alignment_file = value[len(output_key):]
+    strand_value = None
+
+    if command_json is not None:
+        output_alignment_file = command_json.get("output")
+        if output_alignment_file is not None:
             output_alignment_file_base, output_format = output_alignment_file.rsplit(".", 1)
+        strand_value = command_json.get("strand")
+        err_name_base = str(command_json.get("stderr", "")).split(".err", 1)[0]
+    else:
+        for index, value in enumerate(params):
+            if value[:len(output_key)] == output_key:
+                output_index = index
+                output_alignment_file = value[len(output_key):]
+                output_alignment_file_base, output_format = output_alignment_file.rsplit(".", 1)
 
-        if value[:len(strand_key)] == strand_key:
-            strand_index = index
+            if value[:len(strand_key)] == strand_key:
+                strand_value = value[len(strand_key):]
+
+        if output_index is None:
+            sys.exit(f"Error: could not get output key {output_key} from parameters {params}")
+
+        # error file is at very end
+        err_name_base = params[-1].split(".err", 1)[0]
 
     if output_alignment_file_base is None:
         sys.exit(f"Error: could not get output alignment file base from parameters {params}")
@@ -138,26 +166,42 @@ if __name__ == "__main__":
     if output_format is None:
         sys.exit(f"Error: could not get output format from parameters {params}")
 
-    if output_index is None:
-        sys.exit(f"Error: could not get output key {output_key} from parameters {params}")
-
-    if strand_index is None:
+    if strand_value is None:
         sys.exit(f"Error: could not get strand key {strand_key} from parameters {params}")
 
-    # error file is at very end
-    err_index = -1
-    err_name_base = params[-1].split(".err", 1)[0]
+    alignment_file_base: str = output_alignment_file_base
+    alignment_format: str = output_format
+
+    def chunk_command(name_addition: str, segments_filename: str, chunk: typing.Sequence[str]) -> str:
+        if command_json is not None:
+            chunk_json = dict(command_json)
+            chunk_json["segments"] = segments_filename
+            chunk_json["output"] = alignment_file_base + name_addition + "." + alignment_format
+            chunk_json["stderr"] = err_name_base + name_addition + ".err"
+            chunk_json["split"] = int(name_addition.rsplit(".split", 1)[1])
+            chunk_json["num_hsps"] = len(chunk)
+            chunk_json["segment_bytes"] = sum(len(line) for line in chunk)
+            return json.dumps(chunk_json)
+
+        assert segment_index is not None and output_index is not None
+        # update segment file in command
+        params[segment_index] = segment_key + segments_filename
+        # update output file in command
+        params[output_index] = output_key + alignment_file_base + name_addition + "." + alignment_format
+        # update error file in command
+        params[-1] = err_name_base + name_addition + ".err"
+        return " ".join(params)
 
     # dict of list of tuple (x, y, str)
     data: dict[tuple[str, str], list[tuple[int, int, str]]] = {}
 
     direction = None
-    if "plus" in params[strand_index]:
+    if "plus" in strand_value:
         direction = "f"
-    elif "minus" in params[strand_index]:
+    elif "minus" in strand_value:
         direction = "r"
     else:
-        sys.exit(f"Error: could not figure out direction from strand value {params[strand_index]}")
+        sys.exit(f"Error: could not figure out direction from strand value {strand_value}")
 
     for line in open(input_file, "r"):
         if line == "":
@@ -221,13 +265,7 @@ if __name__ == "__main__":
             assert len(chunk) != 0
             with open(fname, "w") as f:
                 f.writelines(chunk)
-            # update segment file in command
-            params[segment_index] = segment_key + fname
-            # update output file in command
-            params[output_index] = output_key + output_alignment_file_base + name_addition + "." + output_format
-            # update error file in command
-            params[-1] = err_name_base + name_addition + ".err"
-            print(" ".join(params), flush=True)
+            print(chunk_command(name_addition, fname, chunk), flush=True)
 
     # writing unsorted skipped pairs
     if len(skip_pairs) > 0:
@@ -260,19 +298,15 @@ if __name__ == "__main__":
 
             fname = input_file.split(".segments", 1)[0] + name_addition + ".segments"
 
+            aggregate_lines: list[str] = []
             with open(fname, "w") as f:
                 # fix possible lastz query key order violations
                 # p[1] is query key
                 for pair in sorted(aggregate, key=lambda p: query_key_order_table[p[1]]):
                     chunk = list(zip(*data[pair]))[2]
                     f.writelines(chunk)
-            # update segment file in command
-            params[segment_index] = segment_key + fname
-            # update output file in command
-            params[output_index] = output_key + output_alignment_file_base + name_addition + "." + output_format
-            # update error file in command
-            params[-1] = err_name_base + name_addition + ".err"
-            print(" ".join(params), flush=True)
+                    aggregate_lines.extend(chunk)
+            print(chunk_command(name_addition, fname, aggregate_lines), flush=True)
 
     if DELETE_AFTER_CHUNKING:
         os.remove(input_file)
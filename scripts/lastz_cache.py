@@ -0,0 +1,330 @@
+"""
+Content-addressed cache of lastz output files, shared by runner.py and
+run_lastz_tarball.py
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import typing
+
+TWOBIT_SIGNATURE: typing.Final = 0x1A412743
+# ioctl cloning a file on copy-on-write filesystems (btrfs, XFS, ...)
+FICLONE: typing.Final = 0x40049409
+SIZE_SUFFIXES: typing.Final = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+# options that name files whose contents, not names, go into the key
+CONTENT_OPTIONS: typing.Final = ["segments", "scores"]
+# options that do not change what lastz writes to --output, the
+# allocate:* memory sizes only differ between runner.py and run_lastz_tarball.py
+IGNORED_OPTIONS: typing.Final = ["output"]
+IGNORED_OPTION_PREFIXES: typing.Final = ["allocate:"]
+
+
+class TwoBitIndex:
+    """
+    Sequence names of a 2bit file and a hash of each sequence record
+
+    A record (sizes, N and mask blocks and packed bases) is only hashed
+    the first time it is asked for.
+    """
+
+    def __init__(self, pathname: str) -> None:
+        self.pathname = pathname
+        self.offsets: dict[str, tuple[int, int]] = {}
+        self.names: list[str] = []
+        self._hashes: dict[str, str] = {}
+        self._read_index()
+
+    def _read_index(self) -> None:
+        with open(self.pathname, "rb") as f:
+            header = f.read(16)
+            if len(header) != 16:
+                raise ValueError(f"not a 2bit file: {self.pathname}")
+
+            endian = "<"
+            if struct.unpack("<I", header[:4])[0] != TWOBIT_SIGNATURE:
+                endian = ">"
+                if struct.unpack(">I", header[:4])[0] != TWOBIT_SIGNATURE:
+                    raise ValueError(f"not a 2bit file: {self.pathname}")
+
+            version, sequence_count = struct.unpack(f"{endian}II", header[4:12])
+            offset_format = f"{endian}Q" if version == 1 else f"{endian}I"
+            offset_size = struct.calcsize(offset_format)
+
+            starts: list[tuple[int, str]] = []
+            for _ in range(sequence_count):
+                name_size = f.read(1)[0]
+                name = f.read(name_size).decode()
+                starts.append((struct.unpack(offset_format, f.read(offset_size))[0], name))
+                self.names.append(name)
+
+            file_size = os.fstat(f.fileno()).st_size
+
+        starts.sort()
+        for i, (start, name) in enumerate(starts):
+            end = starts[i + 1][0] if i + 1 < len(starts) else file_size
+            self.offsets[name] = (start, end)
+
+    def sequence_hash(self, name: str) -> str:
+        if name not in self._hashes:
+            start, end = self.offsets[name]
+            digest = hashlib.sha256()
+            with open(self.pathname, "rb") as f:
+                f.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    remaining -= len(chunk)
+            self._hashes[name] = digest.hexdigest()
+
+        return self._hashes[name]
+
+
+class LastzCache:
+    """
+    Cache of lastz output files keyed on what determines them
+
+    The key covers the segment file contents, the names and record hashes
+    of the target and query sequences that are used and the normalized
+    lastz arguments. Entries are hardlinked (or copied) in and out of the
+    cache directory; their mtime is refreshed on every hit so evict() can
+    drop the least recently used ones.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int | None = None, debug: bool = False) -> None:
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.debug = debug
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self.stored = 0
+        self._twobit_indexes: dict[tuple[str, int, int], TwoBitIndex] = {}
+        self._digests: dict[tuple[str, int, int], str] = {}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, args: list[str]) -> str | None:
+        """
+        Returns the cache key of a lastz argv (with or without the leading
+        "lastz"), None if the command can not be cached. Relative pathnames
+        are resolved against the current working directory.
+        """
+
+        lastz_args = args[1:] if args and args[0] == "lastz" else args
+        if not any(arg.startswith("--output=") for arg in lastz_args):
+            return None
+
+        try:
+            positionals = [self._sequence_key(arg) for arg in lastz_args if not arg.startswith("--")]
+            options = [(name, self._file_digest(value) if name in CONTENT_OPTIONS else value) for name, value in key_options(lastz_args)]
+        except (OSError, ValueError, KeyError):
+            # unreadable inputs are left for lastz to report
+            return None
+
+        key_material = {"sequences": positionals, "options": options}
+        return hashlib.sha256(json.dumps(key_material, sort_keys=True).encode()).hexdigest()
+
+    def _sequence_key(self, spec: str) -> dict[str, typing.Any]:
+        # e.g. work/ref.2bit[nameparse=darkspace][multiple][subset=ref_block0.name]
+        pathname = spec.split("[", 1)[0]
+        modifiers = re.findall(r"\[([^\]]*)\]", spec)
+
+        subset_names: list[str] | None = None
+        kept_modifiers = []
+        for modifier in modifiers:
+            if modifier.startswith("subset="):
+                with open(modifier[7:]) as f:
+                    subset_names = [line.split()[0] for line in f if line.strip()]
+            else:
+                kept_modifiers.append(modifier)
+
+        sequence_key: dict[str, typing.Any] = {"modifiers": kept_modifiers}
+
+        twobit_index = self._twobit_index(pathname)
+        if twobit_index is None:
+            sequence_key["file"] = self._file_digest(pathname)
+            sequence_key["subset"] = subset_names
+        else:
+            names = subset_names if subset_names is not None else twobit_index.names
+            sequence_key["records"] = [(name, twobit_index.sequence_hash(name)) for name in names]
+
+        return sequence_key
+
+    def _stat_key(self, pathname: str) -> tuple[str, int, int]:
+        st = os.stat(pathname)
+        return (os.path.abspath(pathname), st.st_size, st.st_mtime_ns)
+
+    def _twobit_index(self, pathname: str) -> TwoBitIndex | None:
+        stat_key = self._stat_key(pathname)
+        if stat_key not in self._twobit_indexes:
+            with open(pathname, "rb") as f:
+                signature = f.read(4)
+            if signature not in [struct.pack("<I", TWOBIT_SIGNATURE), struct.pack(">I", TWOBIT_SIGNATURE)]:
+                return None
+            self._twobit_indexes[stat_key] = TwoBitIndex(pathname)
+
+        return self._twobit_indexes[stat_key]
+
+    def _file_digest(self, pathname: str) -> str:
+        stat_key = self._stat_key(pathname)
+        if stat_key not in self._digests:
+            digest = hashlib.sha256()
+            with open(pathname, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    digest.update(chunk)
+            self._digests[stat_key] = digest.hexdigest()
+
+        return self._digests[stat_key]
+
+    def _entry_pathname(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key: str, output_pathname: str) -> bool:
+        entry_pathname = self._entry_pathname(key)
+
+        try:
+            if not os.path.exists(entry_pathname):
+                raise FileNotFoundError(entry_pathname)
+            link_or_copy(entry_pathname, output_pathname)
+            os.utime(entry_pathname)
+        except FileNotFoundError:
+            # missing, or evicted by another run in the meantime
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        return True
+
+    def put(self, key: str, output_pathname: str) -> None:
+        entry_pathname = self._entry_pathname(key)
+        os.makedirs(os.path.dirname(entry_pathname), exist_ok=True)
+
+        fd, tmp_pathname = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(entry_pathname))
+        os.close(fd)
+        try:
+            link_or_copy(output_pathname, tmp_pathname)
+            os.replace(tmp_pathname, entry_pathname)
+        except OSError:
+            if os.path.exists(tmp_pathname):
+                os.remove(tmp_pathname)
+            return
+
+        self.stored += 1
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "uncacheable": self.uncacheable, "stored": self.stored}
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used entries until the cache fits in
+        max_bytes, returns the number of entries removed
+        """
+
+        if self.max_bytes is None:
+            return 0
+
+        entries: list[tuple[int, int, str]] = []
+        total_bytes = 0
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                total_bytes += st.st_size
+
+        entries.sort()
+        num_evicted = 0
+        for _, size, pathname in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(pathname)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            num_evicted += 1
+
+        return num_evicted
+
+
+def key_options(args: list[str]) -> list[tuple[str, str]]:
+    """
+    Sorted (name, value) pairs of the lastz options that go into a cache key
+
+    runner.py and run_lastz_tarball.py share the cache, so the same command
+    must give the same options whichever of them runs it:
+
+    >>> runner = ["lastz", "ref.2bit", "query.2bit", "--format=maf-", "--ydrop=9400", "--strand=plus", "--segments=a.segments", "--output=a.maf-"]
+    >>> tarball = ["lastz", "--allocate:traceback=1.99G", "ref.2bit", "query.2bit", "--strand=plus", "--ydrop=9400", "--format=maf-", "--segments=a.segments", "--output=b.maf-"]
+    >>> key_options(runner) == key_options(tarball)
+    True
+    """
+
+    options = []
+    for arg in args:
+        if not arg.startswith("--"):
+            continue
+
+        name, _, value = arg[2:].partition("=")
+        if name in IGNORED_OPTIONS or any(name.startswith(prefix) for prefix in IGNORED_OPTION_PREFIXES):
+            continue
+        options.append((name, value))
+
+    return sorted(options)
+
+
+def parse_size(value: str) -> int:
+    match = re.match(r"^(\d+(?:\.\d+)?)([KMGT]?)B?$", value.strip().upper())
+    if not match:
+        sys.exit(f"ERROR: invalid size: {value}")
+
+    return int(float(match.group(1)) * SIZE_SUFFIXES[match.group(2)])
+
+
+def print_stats(stats: list[dict[str, int]], num_evicted: int) -> None:
+    totals = {name: sum(s.get(name, 0) for s in stats) for name in ["hits", "misses", "uncacheable", "stored"]}
+    lookups = totals["hits"] + totals["misses"]
+    hit_rate = 100 * totals["hits"] / lookups if lookups else 0.0
+
+    print(f"lastz cache: {totals['hits']} hits, {totals['misses']} misses ({hit_rate:.1f}% hit rate), {totals['uncacheable']} uncacheable, {totals['stored']} stored, {num_evicted} evicted", file=sys.stderr, flush=True)
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if not os.path.exists(src):
+            raise FileNotFoundError(src) from e
+        if not reflink(src, dst):
+            shutil.copy2(src, dst)
+
+
+def reflink(src: str, dst: str) -> bool:
+    # a copy-on-write clone shares the blocks of src, False if unsupported
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        if os.path.lexists(dst):
+            os.remove(dst)
+        return False
+
+    shutil.copystat(src, dst)
+    return True
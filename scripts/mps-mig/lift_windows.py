@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+Lift MAF alignments of windows made by split_input.py --max_sequence_bp back
+to the sequences the windows were cut from.
+
+Neighbouring windows overlap, so an alignment in the overlap is found in
+both. Each window owns the part of its sequence up to the middle of its
+overlaps; an alignment is only kept from the window owning its start, in
+the target and in the query.
+
+Usage example:
+lift_windows.py --input apples_oranges.maf --output apples_oranges.lifted.maf --target_windows target_split/windows.json --query_windows query_split/windows.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import typing
+
+
+class Windows:
+    """
+    The windows.json of split_input.py
+    """
+
+    def __init__(self, pathname: str | None = None) -> None:
+        self.overlap = 0
+        self.windows: dict[str, dict[str, typing.Any]] = {}
+
+        if pathname is not None:
+            try:
+                with open(pathname) as f:
+                    manifest = json.load(f)
+            except FileNotFoundError:
+                sys.exit(f"ERROR: Unable to read file: {pathname}")
+
+            self.overlap = manifest["overlap"]
+            self.windows = manifest["windows"]
+
+    def lift(self, name: str, start: int, size: int, strand: str, src_size: int) -> tuple[str, int, int, bool]:
+        """
+        Returns the sequence name, start and size in MAF coordinates and if
+        the window owns the alignment
+        """
+
+        window = self.windows.get(name)
+        if window is None:
+            return name, start, src_size, True
+
+        # MAF coordinates of the - strand count from the end
+        forward_start = start if strand == "+" else window["length"] - start - size
+
+        core_start = 0 if window["start"] == 0 else self.overlap // 2
+        core_end = window["length"]
+        if window["start"] + window["length"] < window["parent_length"]:
+            core_end -= self.overlap - self.overlap // 2
+        owned = core_start <= forward_start < core_end
+
+        parent_start = window["start"] + forward_start
+        if strand == "-":
+            parent_start = window["parent_length"] - parent_start - size
+
+        return window["parent"], parent_start, window["parent_length"], owned
+
+
+def lift_block(lines: list[str], windows: list[Windows]) -> list[str] | None:
+    """
+    Returns the lines of an alignment block lifted to the sequences, None if
+    another window owns it
+    """
+
+    lifted = []
+    names: dict[str, str] = {}
+    s_lines = 0
+
+    for line in lines:
+        fields = line.split()
+        if fields and fields[0] == "s":
+            # target first, then query
+            src, start, size, strand, src_size, text = fields[1:7]
+            name, parent_start, parent_size, owned = windows[min(s_lines, 1)].lift(src, int(start), int(size), strand, int(src_size))
+            if not owned:
+                return None
+
+            names[src] = name
+            line = f"s {name} {parent_start} {size} {strand} {parent_size} {text}\n"
+            s_lines += 1
+        elif fields and fields[0] in ["i", "q"] and fields[1] in names:
+            line = " ".join([fields[0], names[fields[1]]] + fields[2:]) + "\n"
+
+        lifted.append(line)
+
+    return lifted
+
+
+def lift_maf(input_pathname: str, output_pathname: str, windows: list[Windows], debug: bool = False) -> None:
+    num_blocks = 0
+    num_dropped = 0
+    block: list[str] = []
+
+    def flush(of: typing.TextIO) -> None:
+        nonlocal num_blocks, num_dropped
+        if not block:
+            return
+
+        num_blocks += 1
+        lifted = lift_block(block, windows)
+        if lifted is None:
+            num_dropped += 1
+        else:
+            of.writelines(lifted)
+            of.write("\n")
+        block.clear()
+
+    with open(input_pathname) as f, open(f"{output_pathname}.tmp", "w") as of:
+        for line in f:
+            if line.startswith("#"):
+                of.write(line)
+            elif line.startswith("a"):
+                flush(of)
+                block.append(line)
+            elif line.strip():
+                block.append(line)
+            else:
+                flush(of)
+        flush(of)
+
+    os.replace(f"{output_pathname}.tmp", output_pathname)
+
+    if debug:
+        print(f"DEBUG: {num_blocks} alignments, {num_dropped} duplicates from window overlaps dropped", file=sys.stderr, flush=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, required=True, help="MAF alignments of the split inputs")
+    parser.add_argument("--output", type=str, required=True, help="Output MAF file name")
+    parser.add_argument("--target_windows", type=str, default=None, help="windows.json of the split target")
+    parser.add_argument("--query_windows", type=str, default=None, help="windows.json of the split query")
+    parser.add_argument("--debug", action="store_true", help="Print debug information")
+
+    if len(sys.argv) <= 1:
+        parser.print_help()
+        sys.exit(0)
+
+    args = parser.parse_args()
+
+    lift_maf(args.input, args.output, [Windows(args.target_windows), Windows(args.query_windows)], debug=args.debug)
+
+
+if __name__ == "__main__":
+    main()
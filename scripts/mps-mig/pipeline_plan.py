@@ -0,0 +1,524 @@
+#!/usr/bin/env python
+
+"""
+Plan and run the whole alignment pipeline as one incremental job graph.
+
+The graph has one node per input split, per target/query chunk pair
+(kegalign, which also runs the diagonal partitioning), per lastz command,
+per pair merge and one for the final merge. A node is keyed by a hash of
+the contents of its inputs and its parameters and writes its outputs
+under that key, so a rerun only executes the nodes whose key changed.
+Nodes with the same key, like the splits of a self-alignment, run once.
+Nodes are expanded as their inputs appear: the chunk pairs once both
+inputs are split, the lastz commands once kegalign of a pair finished.
+
+Usage example:
+pipeline_plan.py --target hg38.fa.gz --query mm39.fa.gz --work ./plan --output hg38.mm39.maf --goal_bp 200000000 --max_chunks 20 --diagonal_partition --gpus 0,1 --kegalign_options "--hspthresh 3000"
+"""
+
+import abc
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import queue
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import typing
+
+STATE_FILENAME: typing.Final = "plan-state.json"
+# kinds of nodes that keep their outputs under work/<kind>/<key>
+NODE_KINDS: typing.Final = ["split", "kegalign", "lastz", "merge"]
+
+
+class Node(abc.ABC):
+    """
+    A job in the plan
+
+    key_material() may only use the outputs of the dependencies, it is
+    evaluated once all of them are done.
+    """
+
+    kind = ""
+    resource = "cpu"
+
+    def __init__(self, plan: "Plan", name: str, deps: list[str] | None = None) -> None:
+        self.plan = plan
+        self.name = name
+        self.deps = deps or []
+        self.key = ""
+
+    @abc.abstractmethod
+    def key_material(self) -> dict[str, typing.Any]:
+        pass
+
+    def compute_key(self) -> str:
+        material = {"kind": self.kind, **self.key_material()}
+        self.key = hashlib.sha256(json.dumps(material, sort_keys=True).encode()).hexdigest()
+        return self.key
+
+    @property
+    def output(self) -> str:
+        return os.path.join(self.plan.work_dir, self.kind, self.key)
+
+    @abc.abstractmethod
+    def run(self) -> None:
+        pass
+
+    def expand(self) -> list["Node"]:
+        return []
+
+
+class SplitNode(Node):
+    kind = "split"
+
+    def __init__(self, plan: "Plan", role: str, pathname: str) -> None:
+        super().__init__(plan, f"split:{role}")
+        self.role = role
+        self.pathname = os.path.abspath(pathname)
+
+    def key_material(self) -> dict[str, typing.Any]:
+        return {
+            "input": self.plan.digest(self.pathname),
+            "goal_bp": self.plan.args.goal_bp,
+            "max_chunks": self.plan.args.max_chunks,
+            "outputs": ["fasta", "2bit"],
+        }
+
+    def run(self) -> None:
+        tmp_dir = f"{self.output}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        run_args = [sys.executable, os.path.join(self.plan.tool_directory, "mps-mig", "split_input.py"), "--input", self.pathname, "--out", tmp_dir, "--to_2bit", "--goal_bp", str(self.plan.args.goal_bp), "--max_chunks", str(self.plan.args.max_chunks)]
+        run_command(self.name, run_args)
+        os.rename(tmp_dir, self.output)
+
+    def chunks(self) -> list[str]:
+        # kegalign reads the fasta chunks, lastz their chunk_N.2bit copies
+        names = [name for name in os.listdir(self.output) if re.match(r"chunk_\d+$", name)]
+        names.sort(key=lambda name: int(name[6:]))
+        return [os.path.join(self.output, name) for name in names]
+
+    def expand(self) -> list[Node]:
+        return self.plan.pair_nodes()
+
+
+class KegAlignNode(Node):
+    kind = "kegalign"
+    resource = "gpu"
+
+    def __init__(self, plan: "Plan", pair: str, target_pathname: str, query_pathname: str) -> None:
+        super().__init__(plan, f"kegalign:{pair}")
+        self.pair = pair
+        self.target_pathname = target_pathname
+        self.query_pathname = query_pathname
+
+    def key_material(self) -> dict[str, typing.Any]:
+        return {
+            "target": self.plan.digest(self.target_pathname),
+            "query": self.plan.digest(self.query_pathname),
+            "kegalign_options": self.plan.kegalign_options,
+            "diagonal_partition": self.plan.args.diagonal_partition,
+        }
+
+    def run(self) -> None:
+        tmp_dir = f"{self.output}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        # the lastz commands read work/ref.2bit and work/query.2bit
+        data_dir = os.path.join(tmp_dir, "work")
+        os.makedirs(data_dir)
+        link_file(f"{self.target_pathname}.2bit", os.path.join(data_dir, "ref.2bit"))
+        link_file(f"{self.query_pathname}.2bit", os.path.join(data_dir, "query.2bit"))
+
+        run_args = [sys.executable, os.path.join(self.plan.tool_directory, "runner.py"), "--output-type", "commands", "--json-commands", "--output-file", "commands.jsonl", "--tool_directory", self.plan.tool_directory, "--num-cpu", str(self.plan.args.num_cpu)]
+        if self.plan.args.diagonal_partition:
+            run_args.append("--diagonal-partition")
+        run_args.extend([self.target_pathname, self.query_pathname])
+        run_args.extend(self.plan.kegalign_options)
+
+        device = self.plan.gpu_devices.get()
+        try:
+            env = dict(os.environ)
+            if device != "":
+                env["CUDA_VISIBLE_DEVICES"] = device
+            run_command(self.name, run_args, cwd=tmp_dir, env=env)
+        finally:
+            self.plan.gpu_devices.put(device)
+
+        os.rename(tmp_dir, self.output)
+
+    def expand(self) -> list[Node]:
+        nodes: list[Node] = []
+        with open(os.path.join(self.output, "commands.jsonl")) as f:
+            for i, line in enumerate(f):
+                nodes.append(LastzNode(self.plan, self, i, json.loads(line)))
+
+        nodes.append(PairMergeNode(self.plan, self.pair, [node.name for node in nodes]))
+        return nodes
+
+
+class LastzNode(Node):
+    kind = "lastz"
+
+    def __init__(self, plan: "Plan", kegalign_node: KegAlignNode, index: int, command_dict: dict[str, typing.Any]) -> None:
+        super().__init__(plan, f"lastz:{kegalign_node.pair}:{index}", [kegalign_node.name])
+        self.kegalign_node = kegalign_node
+        self.command_dict = command_dict
+
+        # gapped-stage options come from the plan, not from the kegalign run
+        options = dict(command_dict["options"])
+        options["format"] = plan.args.format
+        if plan.args.ydrop is not None:
+            options["ydrop"] = plan.args.ydrop
+        if plan.args.gappedthresh is not None:
+            options["gappedthresh"] = plan.args.gappedthresh
+        if plan.args.notrivial:
+            options["notrivial"] = True
+        self.options = options
+
+    def key_material(self) -> dict[str, typing.Any]:
+        kegalign_dir = self.kegalign_node.output
+        ref_names = os.path.join(kegalign_dir, f"ref_block{self.command_dict['ref_block']}.name")
+        query_names = os.path.join(kegalign_dir, f"query_block{self.command_dict['query_block']}.name")
+
+        return {
+            "target": self.plan.digest(self.kegalign_node.target_pathname),
+            "query": self.plan.digest(self.kegalign_node.query_pathname),
+            "target_subset": self.plan.digest(ref_names),
+            "query_subset": self.plan.digest(query_names),
+            "segments": self.plan.digest(os.path.join(kegalign_dir, self.command_dict["segments"])),
+            "target_spec": self.command_dict["target"],
+            "query_spec": self.command_dict["query"],
+            "strand": self.command_dict["strand"],
+            "options": self.options,
+        }
+
+    @property
+    def output(self) -> str:
+        return os.path.join(self.plan.work_dir, self.kind, f"{self.key}.{self.plan.args.format}")
+
+    def run(self) -> None:
+        options = self.options
+        run_args = [
+            "lastz",
+            self.command_dict["target"],
+            self.command_dict["query"],
+            f"--format={options['format']}",
+            f"--ydrop={options['ydrop']}",
+            f"--gappedthresh={options['gappedthresh']}",
+            f"--strand={self.command_dict['strand']}",
+        ]
+
+        if "ambiguous" in options:
+            run_args.append(f"--ambiguous={options['ambiguous']}")
+
+        if options.get("notrivial", False):
+            run_args.append("--notrivial")
+
+        if "scores" in options:
+            run_args.append(f"--scores={options['scores']}")
+
+        run_args.append(f"--segments={self.command_dict['segments']}")
+        run_args.append(f"--output={self.output}.tmp")
+
+        run_command(self.name, run_args, cwd=self.kegalign_node.output)
+        os.rename(f"{self.output}.tmp", self.output)
+
+
+class PairMergeNode(Node):
+    kind = "merge"
+
+    def __init__(self, plan: "Plan", pair: str, deps: list[str]) -> None:
+        super().__init__(plan, f"merge:{pair}", deps)
+
+    def key_material(self) -> dict[str, typing.Any]:
+        return {"inputs": [self.plan.nodes[dep].key for dep in self.deps]}
+
+    @property
+    def output(self) -> str:
+        return os.path.join(self.plan.work_dir, self.kind, f"{self.key}.{self.plan.args.format}")
+
+    def run(self) -> None:
+        concatenate([self.plan.nodes[dep].output for dep in self.deps], self.output, header=False)
+
+
+class MergeNode(Node):
+    kind = "output"
+
+    def __init__(self, plan: "Plan", deps: list[str]) -> None:
+        super().__init__(plan, "merge", deps)
+
+    def key_material(self) -> dict[str, typing.Any]:
+        return {"inputs": [self.plan.nodes[dep].key for dep in self.deps]}
+
+    @property
+    def output(self) -> str:
+        return typing.cast(str, self.plan.args.output)
+
+    def run(self) -> None:
+        concatenate([self.plan.nodes[dep].output for dep in self.deps], self.output, header=self.plan.args.format.startswith("maf"))
+
+
+class Plan:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.work_dir = os.path.abspath(args.work)
+        self.tool_directory = os.path.abspath(args.tool_directory)
+        self.kegalign_options = shlex.split(args.kegalign_options)
+        self.nodes: dict[str, Node] = {}
+        self.done: set[str] = set()
+        self.stale: list[Node] = []
+        # outputs written by this run, shared by any node with the same key
+        self.produced: set[str] = set()
+        self.num_run = 0
+
+        # each slot hands its device to one kegalign at a time
+        self.gpu_devices: queue.Queue[str] = queue.Queue()
+        self.num_gpu_slots = 0
+        for device in (args.gpus.split(",") if args.gpus else [""]):
+            for _ in range(args.jobs_per_gpu):
+                self.gpu_devices.put(device)
+                self.num_gpu_slots += 1
+
+        self.state_pathname = os.path.join(self.work_dir, STATE_FILENAME)
+        self.state: dict[str, typing.Any] = {"nodes": {}, "digests": {}}
+        if os.path.exists(self.state_pathname):
+            with open(self.state_pathname) as f:
+                self.state = json.load(f)
+
+        for kind in NODE_KINDS:
+            os.makedirs(os.path.join(self.work_dir, kind), exist_ok=True)
+
+    def digest(self, pathname: str) -> str:
+        # contents are only rehashed when the size or mtime changed
+        try:
+            st = os.stat(pathname)
+        except FileNotFoundError:
+            sys.exit(f"ERROR: Unable to read file: {pathname}")
+
+        cached = self.state["digests"].get(pathname)
+        if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return typing.cast(str, cached[2])
+
+        digest = hashlib.sha256()
+        with open(pathname, "rb") as f:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+
+        self.state["digests"][pathname] = [st.st_size, st.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def add(self, node: Node) -> None:
+        if node.name in self.nodes:
+            sys.exit(f"ERROR: duplicate node {node.name}")
+        self.nodes[node.name] = node
+
+    def pair_nodes(self) -> list[Node]:
+        if "split:target" not in self.done or "split:query" not in self.done:
+            return []
+
+        target_split = typing.cast(SplitNode, self.nodes["split:target"])
+        query_split = typing.cast(SplitNode, self.nodes["split:query"])
+
+        nodes: list[Node] = []
+        pairs = []
+        for t, target_pathname in enumerate(target_split.chunks()):
+            for q, query_pathname in enumerate(query_split.chunks()):
+                pair = f"t{t}.q{q}"
+                pairs.append(pair)
+                nodes.append(KegAlignNode(self, pair, target_pathname, query_pathname))
+
+        nodes.append(MergeNode(self, [f"merge:{pair}" for pair in pairs]))
+        return nodes
+
+    def is_fresh(self, node: Node) -> bool:
+        if node.output in self.produced:
+            return True
+        return self.state["nodes"].get(node.name) == node.key and os.path.exists(node.output)
+
+    def ready_nodes(self, started: set[str]) -> list[Node]:
+        ready = []
+        for name, node in self.nodes.items():
+            if name not in started and all(dep in self.done for dep in node.deps):
+                ready.append(node)
+        return ready
+
+    def complete(self, node: Node) -> None:
+        self.done.add(node.name)
+        self.state["nodes"][node.name] = node.key
+        self.save_state()
+
+        for new_node in node.expand():
+            self.add(new_node)
+
+    def save_state(self) -> None:
+        with open(f"{self.state_pathname}.tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(f"{self.state_pathname}.tmp", self.state_pathname)
+
+    def run(self) -> None:
+        started: set[str] = set()
+        running: dict[concurrent.futures.Future[None], Node] = {}
+        # nodes with the key of a running node, e.g. the target and query
+        # splits of a self-alignment, share its output instead of racing
+        # on it
+        sharing: dict[str, list[Node]] = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.num_cpu) as cpu_executor, concurrent.futures.ThreadPoolExecutor(max_workers=self.num_gpu_slots) as gpu_executor:
+            while True:
+                ready = self.ready_nodes(started)
+                for node in ready:
+                    started.add(node.name)
+                    node.compute_key()
+
+                    if self.is_fresh(node):
+                        if self.args.debug:
+                            print(f"DEBUG: fresh {node.name} {node.key[:12]}", file=sys.stderr, flush=True)
+                        self.complete(node)
+                    elif self.args.dry_run:
+                        self.stale.append(node)
+                    elif node.output in sharing:
+                        if self.args.debug:
+                            print(f"DEBUG: sharing {node.name} {node.key[:12]}", file=sys.stderr, flush=True)
+                        sharing[node.output].append(node)
+                    else:
+                        if self.args.verbose:
+                            print(f"running {node.name} {node.key[:12]}", flush=True)
+                        executor = gpu_executor if node.resource == "gpu" else cpu_executor
+                        running[executor.submit(node.run)] = node
+                        sharing[node.output] = []
+
+                if ready:
+                    # fresh nodes may have made more nodes ready
+                    continue
+
+                if not running:
+                    break
+
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    future.result()
+                    self.num_run += 1
+                    self.produced.add(node.output)
+                    self.complete(node)
+                    for shared_node in sharing.pop(node.output):
+                        self.complete(shared_node)
+
+        if self.args.dry_run:
+            for node in self.stale:
+                print(f"stale: {node.name} {node.key[:12]}")
+            print(f"{len(self.stale)} stale nodes, their dependents are planned once they ran")
+            return
+
+        unresolved = [name for name in self.nodes if name not in self.done]
+        if unresolved:
+            sys.exit(f"ERROR: unresolved nodes: {', '.join(unresolved)}")
+
+        print(f"ran {self.num_run} of {len(self.nodes)} nodes")
+
+    def prune(self) -> None:
+        keys = {node.key for node in self.nodes.values()}
+        for kind in NODE_KINDS:
+            kind_dir = os.path.join(self.work_dir, kind)
+            for entry in os.scandir(kind_dir):
+                if entry.name.split(".", 1)[0] in keys:
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+
+        nodes = self.state["nodes"]
+        self.state["nodes"] = {name: key for name, key in nodes.items() if name in self.nodes}
+        self.state["digests"] = {pathname: value for pathname, value in self.state["digests"].items() if os.path.exists(pathname)}
+        self.save_state()
+
+
+def run_command(name: str, run_args: list[str], cwd: str | None = None, env: dict[str, str] | None = None) -> None:
+    process = subprocess.run(run_args, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    if process.stdout:
+        print(f"{process.stdout}", file=sys.stdout, end="", flush=True)
+    if process.stderr:
+        print(f"{process.stderr}", file=sys.stderr, end="", flush=True)
+
+    if process.returncode != 0:
+        sys.exit(f"ERROR: {name} exited with returncode {process.returncode}")
+
+
+def link_file(src: str, dst: str) -> None:
+    # a symlink when the work directory is on another file system
+    try:
+        os.link(src, dst)
+    except OSError:
+        os.symlink(os.path.abspath(src), dst)
+
+
+def concatenate(pathnames: list[str], output_pathname: str, header: bool) -> None:
+    with open(f"{output_pathname}.tmp", "wb") as of:
+        if header:
+            of.write(b"##maf version=1\n")
+        for pathname in pathnames:
+            with open(pathname, "rb") as f:
+                shutil.copyfileobj(f, of)
+
+    os.replace(f"{output_pathname}.tmp", output_pathname)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", type=str, required=True, help="Target sequence in fasta or fasta.gz format")
+    parser.add_argument("--query", type=str, required=True, help="Query sequence in fasta or fasta.gz format")
+    parser.add_argument("--work", type=str, required=True, help="Directory holding the outputs of every node and the plan state")
+    parser.add_argument("--output", type=str, required=True, help="Output alignment file name")
+    parser.add_argument("--format", type=str, default="maf-", help="Output alignment file format. Must be able to be concatenated.")
+    parser.add_argument("--goal_bp", default=0, type=int, help="Goal basepairs count for each input partition. See split_input.py")
+    parser.add_argument("--max_chunks", default=20, type=int, help="Maximum number of chunks to split each input into. See split_input.py")
+    parser.add_argument("--diagonal_partition", action="store_true", help="Run diagonal partitioning on the segments of each chunk pair")
+    parser.add_argument("--kegalign_options", type=str, default="", help="Additional seeding and filtering options passed to kegalign. Pathnames must be absolute.")
+    parser.add_argument("--ydrop", type=int, default=None, help="lastz --ydrop (default: as printed by kegalign)")
+    parser.add_argument("--gappedthresh", type=int, default=None, help="lastz --gappedthresh (default: as printed by kegalign)")
+    parser.add_argument("--notrivial", action="store_true", help="lastz --notrivial")
+    parser.add_argument("--gpus", type=str, default="", help="Comma separated list of GPU or MIG device names, one kegalign runs on each at a time (default: let kegalign choose)")
+    parser.add_argument("--jobs_per_gpu", type=int, default=1, help="Number of kegalign processes sharing each device, e.g. with MPS")
+    parser.add_argument("--num_cpu", type=int, default=-1, help="Number of CPU jobs (and threads per kegalign) to run at once (default: all CPUs)")
+    parser.add_argument("--tool_directory", type=str, default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), help="Directory holding runner.py and diagonal_partition.py")
+    parser.add_argument("--dry_run", action="store_true", help="Only list the stale nodes that can be planned now")
+    parser.add_argument("--prune", action="store_true", help="Remove node outputs that are not part of this plan after a successful run")
+    parser.add_argument("--verbose", action="store_true", help="Print each node as it starts")
+    parser.add_argument("--debug", action="store_true", help="Print debug information")
+
+    if len(sys.argv) <= 1:
+        parser.print_help()
+        sys.exit(0)
+
+    args = parser.parse_args()
+
+    cpus_available = len(os.sched_getaffinity(0))
+    if args.num_cpu == -1 or args.num_cpu > cpus_available:
+        args.num_cpu = cpus_available
+
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+
+    plan = Plan(args)
+    plan.add(SplitNode(plan, "target", args.target))
+    plan.add(SplitNode(plan, "query", args.query))
+    plan.run()
+
+    if args.prune and not args.dry_run:
+        plan.prune()
+
+
+if __name__ == "__main__":
+    main()
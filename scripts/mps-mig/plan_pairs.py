@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""
+Split the query and the target genomes together for run_mig.py.
+
+split_input.py splits each genome on its own and run_mig.py aligns every query
+block against every target block. The work of a pair is roughly the product
+of the two block weights (see split_input.py --weight) plus a fixed cost for
+starting KegAlign, and the pairs are run --slots at a time. Every query and
+target block count up to --max_chunks is tried, the pairs of each are
+scheduled heaviest first on the slots as run_mig.py does, and the block counts
+with the shortest predicted makespan are written. The pairs and their costs
+go to a manifest for run_mig.py --pairs.
+
+Usage example:
+plan_pairs.py --query ./test-data/apple.fasta.gz --target ./test-data/orange.fasta.gz --query_out query_split --target_out target_split --to_2bit --slots 8 --max_chunks 30 --output pairs.json
+"""
+
+import argparse
+import heapq
+import json
+import os
+import sys
+import typing
+
+from split_input import WEIGHT_MODES, WINDOWS_FILENAME, FastaFile, pack_lengths, split_chr
+
+PAIRS_VERSION: typing.Final = 1
+
+
+def makespan(costs: list[int], slots: int) -> int:
+    """
+    Returns when the last of the costs finishes, started in the given order
+    on whichever of the slots is free first
+    """
+
+    finish_times = [0] * min(slots, len(costs))
+    for cost in costs:
+        heapq.heapreplace(finish_times, finish_times[0] + cost)
+
+    return max(finish_times, default=0)
+
+
+def pair_costs(query_sizes: list[int], target_sizes: list[int], pair_overhead: int) -> list[tuple[int, int, int]]:
+    """
+    Returns the cost, query block and target block of each pair, heaviest
+    first
+    """
+
+    costs = [(query_size * target_size + pair_overhead, query_no, target_no) for query_no, query_size in enumerate(query_sizes) for target_no, target_size in enumerate(target_sizes)]
+    costs.sort(key=lambda pair: pair[0], reverse=True)
+
+    return costs
+
+
+def plan_block_counts(query_weights: list[int], target_weights: list[int], slots: int, max_chunks: int, pair_overhead: int, debug: bool = False) -> tuple[int, int, int]:
+    """
+    Returns the query block count, the target block count and the predicted
+    makespan of the pairs with the shortest one, fewest pairs on ties
+    """
+
+    # the packing only depends on the weights, every block count of each
+    # genome is packed once
+    query_bins = [pack_lengths(sorted(query_weights, reverse=True), i)[0] for i in range(1, min(max_chunks, len(query_weights)) + 1)]
+    target_bins = [pack_lengths(sorted(target_weights, reverse=True), i)[0] for i in range(1, min(max_chunks, len(target_weights)) + 1)]
+    total_work = sum(query_weights) * sum(target_weights)
+
+    best: tuple[int, int, int, int] | None = None
+    for query_sizes in query_bins:
+        for target_sizes in target_bins:
+            num_pairs = len(query_sizes) * len(target_sizes)
+
+            # no schedule beats the heaviest pair or the work spread evenly
+            lower_bound = max(max(query_sizes) * max(target_sizes) + pair_overhead, -(-(total_work + num_pairs * pair_overhead) // slots))
+            if best is not None and (lower_bound, num_pairs) >= best[:2]:
+                continue
+
+            predicted = makespan([cost for cost, _, _ in pair_costs(query_sizes, target_sizes, pair_overhead)], slots)
+            if debug:
+                print(f"DEBUG: * {len(query_sizes)} query blocks, {len(target_sizes)} target blocks, makespan {predicted}", file=sys.stderr, flush=True)
+
+            if best is None or (predicted, num_pairs) < best[:2]:
+                best = (predicted, num_pairs, len(query_sizes), len(target_sizes))
+
+    if best is None:
+        sys.exit("ERROR: no sequences to plan")
+
+    return best[2], best[3], best[0]
+
+
+def split_genome(pathname: str, out: str, args: argparse.Namespace) -> tuple[FastaFile, list[int]]:
+    """
+    Returns the index of the genome and the weight of each sequence, long
+    sequences cut into windows
+    """
+
+    os.makedirs(out, exist_ok=True)
+    fasta = FastaFile(pathname, debug=args.debug, tmp_dir=out)
+
+    try:
+        if args.max_sequence_bp:
+            windows = fasta.split_long_sequences(args.max_sequence_bp, args.overlap_bp)
+            with open(os.path.join(out, WINDOWS_FILENAME), "w") as f:
+                json.dump({"overlap": args.overlap_bp, "windows": windows}, f, indent=2)
+
+        return fasta, fasta.weights(args.weight)
+    except BaseException:
+        # the caller only closes the genomes it got back
+        fasta.close()
+        raise
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--query", type=str, required=True, help="Query sequence in fasta or fasta.gz format")
+    parser.add_argument("--target", type=str, required=True, help="Target sequence in fasta or fasta.gz format")
+    parser.add_argument("--query_out", type=str, required=True, help="Output directory of the query blocks")
+    parser.add_argument("--target_out", type=str, required=True, help="Output directory of the target blocks")
+    parser.add_argument("--output", type=str, default="pairs.json", help="Manifest of the pairs to align, for run_mig.py --pairs")
+    parser.add_argument("--slots", type=int, required=True, help="Number of KegAlign processes run at a time, the sum of run_mig.py --MPS over the GPU or MIG devices")
+    parser.add_argument("--max_chunks", default=20, type=int, help="Maximum number of blocks to split each input into")
+    parser.add_argument("--pair_overhead_bp", default=10_000_000, type=int, help="Fixed cost of a pair, as the cost of aligning two blocks of this size. Larger values make fewer pairs")
+    parser.add_argument("--to_2bit", action="store_true", help="Also write the blocks in .2bit format")
+    parser.add_argument("--weight", default="length", choices=WEIGHT_MODES, help="What the cost of a block is based on. See split_input.py")
+    parser.add_argument("--max_sequence_bp", default=0, type=int, help="Split sequences longer than this into overlapping windows. See split_input.py")
+    parser.add_argument("--overlap_bp", default=100_000, type=int, help="Overlap of the windows of split sequences. See split_input.py")
+    parser.add_argument("--debug", action="store_true", help="Print debug information")
+
+    if len(sys.argv) <= 1:
+        parser.print_help()
+        sys.exit(0)
+
+    args = parser.parse_args()
+
+    for pathname in [args.query, args.target]:
+        if not os.path.exists(pathname):
+            sys.exit(f"ERROR: Input file {pathname} does not exist")
+    if args.slots < 1:
+        sys.exit("ERROR: --slots must be at least 1")
+    if args.max_sequence_bp and not 0 <= args.overlap_bp < args.max_sequence_bp:
+        sys.exit("ERROR: --overlap_bp must be smaller than --max_sequence_bp")
+
+    pair_overhead = args.pair_overhead_bp * args.pair_overhead_bp
+
+    query_fasta, query_weights = split_genome(args.query, args.query_out, args)
+    try:
+        target_fasta, target_weights = split_genome(args.target, args.target_out, args)
+        try:
+            num_query_blocks, num_target_blocks, predicted = plan_block_counts(query_weights, target_weights, args.slots, args.max_chunks, pair_overhead, debug=args.debug)
+            if args.debug:
+                print(f"DEBUG: {num_query_blocks} query blocks, {num_target_blocks} target blocks, makespan {predicted}", file=sys.stderr, flush=True)
+
+            query_sizes = split_chr(query_fasta, args.query_out, num_query_blocks, debug=args.debug, to_2bit=args.to_2bit, weights=query_weights)
+            target_sizes = split_chr(target_fasta, args.target_out, num_target_blocks, debug=args.debug, to_2bit=args.to_2bit, weights=target_weights)
+        finally:
+            target_fasta.close()
+    finally:
+        query_fasta.close()
+
+    # kegalign reads the blocks in fasta format, so there is no --no_fasta
+    manifest = {
+        "version": PAIRS_VERSION,
+        "slots": args.slots,
+        "weight": args.weight,
+        "pair_overhead": pair_overhead,
+        "makespan": predicted,
+        "query": {"directory": os.path.abspath(args.query_out), "blocks": {f"chunk_{i}": size for i, size in enumerate(query_sizes)}},
+        "target": {"directory": os.path.abspath(args.target_out), "blocks": {f"chunk_{i}": size for i, size in enumerate(target_sizes)}},
+        "pairs": [{"query": f"chunk_{query_no}", "target": f"chunk_{target_no}", "cost": cost} for cost, query_no, target_no in pair_costs(query_sizes, target_sizes, pair_overhead)],
+    }
+
+    with open(f"{args.output}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{args.output}.tmp", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 
 import argparse
 import datetime
+import json
 import os
 import pynvml
 import re
@@ -346,6 +347,7 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--verbose", action="store_true", help="Print additional information to console.")
     parser.add_argument("--twobit_ext", type=str, default=".2bit", help="File extensions of 2bit files in query and target directories.")
     parser.add_argument("--resubmit_fails", action="store_false", help="Whether to resubmit failed alignment pairs.")
+    parser.add_argument("--pairs", type=str, default=None, help="Manifest written by plan_pairs.py. Only its pairs of query and target files are aligned, in its order (heaviest first), instead of every query file against every target file.")
 
     return parser.parse_args()
 
@@ -424,8 +426,30 @@ def main() -> None:
     print(f"MPS init time: {get_time(mps_timer)}")
 
     _2bit_extension = args.twobit_ext
-    query_block_file_names = sorted([filename for filename in os.listdir(query_dir) if _2bit_extension not in filename])
-    target_block_file_names = sorted([filename for filename in os.listdir(target_dir) if _2bit_extension not in filename])
+    # windows.json and hidden (e.g. temporary) files of split_input.py are not blocks
+    query_block_file_names = sorted([filename for filename in os.listdir(query_dir) if _2bit_extension not in filename and not filename.endswith(".json") and not filename.startswith(".")])
+    target_block_file_names = sorted([filename for filename in os.listdir(target_dir) if _2bit_extension not in filename and not filename.endswith(".json") and not filename.startswith(".")])
+
+    # list of tasks
+    pairs: list[tuple[str, str]] = []
+    if args.pairs:
+        try:
+            with open(args.pairs) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            sys.exit(f"ERROR: Unable to read file: {args.pairs}")
+        # the pairs name blocks of the directories the manifest was planned for
+        for role, block_dir in [("query", query_dir), ("target", target_dir)]:
+            if os.path.realpath(manifest[role]["directory"]) != os.path.realpath(block_dir):
+                sys.exit(f"ERROR: {args.pairs} plans the {role} blocks in {manifest[role]['directory']}, not in --{role} {block_dir}")
+        for pair in manifest["pairs"]:
+            pairs.append((pair["query"], pair["target"]))
+        print(f"{len(pairs)} pairs from {args.pairs}, predicted makespan {manifest['makespan']} for {manifest['slots']} slots")
+    else:
+        for q in query_block_file_names:
+            for t in target_block_file_names:
+                pairs.append((q, t))
+    total_pairs = len(pairs)
 
     process_list = Process_List()
 
@@ -470,12 +494,6 @@ def main() -> None:
         print(f"max processes = {max_processes}")
         print(mig_process_dict)
         print("=====")
-        # list of tasks
-        pairs = []
-        for q in query_block_file_names:
-            for t in target_block_file_names:
-                pairs.append((q, t))
-        total_pairs = len(pairs)
         # used when resubmitting mem fails. Need to know file pair for given UID
         uid_pair_map: dict[str, tuple[str, str]] = {}
         while len(pairs) > 0:
@@ -611,7 +629,7 @@ def main() -> None:
 
         # check if missing parts
         output_file_list = [i for i in os.listdir(tmp_dir) if i.startswith("part_") and i.endswith(f".{output_format}")]
-        expected_outputs = len(query_block_file_names) * len(target_block_file_names)
+        expected_outputs = total_pairs
         if len(output_file_list) != expected_outputs:
             print(f"Missing {expected_outputs-len(output_file_list)} output parts: ")
             set_output_file_list = set(output_file_list)
@@ -1,28 +1,48 @@
 #!/usr/bin/env python
 
 """
-Split an input genome file into multiple files with size near goal_bp. Individual chromosomes are not split.
+Split an input genome file into multiple files with size near goal_bp. Individual chromosomes are not split,
+unless they are longer than --max_sequence_bp: those are cut into overlapping windows, see lift_windows.py.
 
 Usage example:
 split_input.py --input <input_genome> --out ./blocked_20_chr_hg38 --to_2bit true --goal_bp 200000000 --max_chunks 20
 """
 
 import argparse
+import array
 import collections
-import concurrent.futures
 import gzip
 import heapq
+import json
 import math
 import os
 import re
 import resource
-import subprocess
+import shutil
+import struct
 import sys
+import tempfile
 import time
 import typing
 
 TEN_MB: typing.Final = 10_000_000
 TEN_KB: typing.Final = 10_000
+COPY_BUFFER_SIZE: typing.Final = 1 << 20
+TWOBIT_SIGNATURE: typing.Final = 0x1A412743
+# room for the N and mask blocks before 64 bit offsets are needed
+TWOBIT_BLOCKS_MARGIN: typing.Final = 1 << 28
+WHITESPACE: typing.Final = b" \t\r\n\v\f"
+N_BLOCK_REGEX: typing.Final = re.compile(rb"[Nn]+")
+MASK_BLOCK_REGEX: typing.Final = re.compile(rb"[a-z]+")
+# windows of long sequences are named <sequence><WINDOW_SEPARATOR><start>
+WINDOW_SEPARATOR: typing.Final = "__"
+WINDOWS_FILENAME: typing.Final = "windows.json"
+# bytes that do not count for the weight modes, whitespace included
+NOT_WEIGHED: typing.Final = {
+    "acgt": bytes(c for c in range(256) if c not in b"ACGTacgt"),
+    "unmasked": bytes(c for c in range(256) if c not in b"ACGT"),
+}
+WEIGHT_MODES: typing.Final = ["length"] + list(NOT_WEIGHED.keys())
 
 RUSAGE_ATTRS: typing.Final = [
     "ru_utime",
@@ -36,8 +56,15 @@ RUSAGE_ATTRS: typing.Final = [
     "ru_nivcsw",
 ]
 
+# faidx-style index entry: the header line starts at offset, the sequence
+# lines start at sequence_offset and end at end, line_bases bases per
+# line_width bytes (0 when the lines are not all the same length). A window
+# of a longer sequence has no header line in the input, offset and
+# sequence_offset are the same
 FastaSequence = collections.namedtuple(
-    "FastaSequence", ["description", "sequence", "length"], defaults=["", "", 0]
+    "FastaSequence",
+    ["description", "length", "offset", "sequence_offset", "end", "line_bases", "line_width"],
+    defaults=["", 0, 0, 0, 0, 0, 0],
 )
 
 
@@ -62,62 +89,289 @@ def debug_end(
 
 
 class FastaFile:
-    def __init__(self, pathname: str, debug: bool = False) -> None:
+    """
+    Index of the sequences of a fasta file, the sequences themselves stay
+    on disk and are copied from it as raw byte ranges
+
+    A gzip compressed file is decompressed once to a temporary file next to
+    the output, removed by close().
+    """
+
+    def __init__(self, pathname: str, debug: bool = False, tmp_dir: str | None = None) -> None:
         self.pathname = pathname
+        # the input as given, self.pathname becomes the decompressed copy
+        self.input_pathname = pathname
+        self.debug = debug
+        self.tmp_pathname: str | None = None
         self.sequences: list[FastaSequence] = []
-        self._read_fasta()
+
+        try:
+            if self._is_gzip():
+                self._decompress(tmp_dir)
+
+            self._index_fasta()
+        except BaseException:
+            # e.g. sys.exit on a malformed input, the caller never gets to close()
+            self.close()
+            raise
         self.sequences.sort(key=lambda x: x.length, reverse=True)
 
-    def _read_fasta(self) -> None:
-        description = ""
-        seqs: list[str] = []
+    def _is_gzip(self) -> bool:
+        try:
+            with open(self.pathname, "rb") as f:
+                return f.read(2) == b"\x1f\x8b"
+        except FileNotFoundError:
+            sys.exit(f"ERROR: Unable to read file: {self.pathname}")
 
-        if args.debug:
+    def _decompress(self, tmp_dir: str | None) -> None:
+        if self.debug:
             debug_r_beg, debug_beg, debug_who = debug_start(
-                resource.RUSAGE_SELF, f"loading fasta {self.pathname}"
+                resource.RUSAGE_SELF, f"decompressing fasta {self.pathname}"
             )
 
-        with self._get_open_method() as f:
-            for line in f:
-                line = line.rstrip()
+        fd, self.tmp_pathname = tempfile.mkstemp(prefix=".tmp-", suffix=".fa", dir=tmp_dir)
+        with gzip.open(self.pathname, "rb") as ifh, os.fdopen(fd, "wb") as ofh:
+            shutil.copyfileobj(ifh, ofh, COPY_BUFFER_SIZE)
+
+        self.pathname = self.tmp_pathname
+
+        if self.debug:
+            debug_end(
+                debug_r_beg,
+                debug_beg,
+                debug_who,
+                f"decompressed fasta {self.pathname}",
+            )
+
+    def close(self) -> None:
+        if self.tmp_pathname is not None and os.path.exists(self.tmp_pathname):
+            os.remove(self.tmp_pathname)
+
+    def _index_fasta(self) -> None:
+        if self.debug:
+            debug_r_beg, debug_beg, debug_who = debug_start(
+                resource.RUSAGE_SELF, f"indexing fasta {self.pathname}"
+            )
 
-                if line.startswith(">"):
-                    if seqs:
-                        sequence = "".join(seqs)
+        description = ""
+        offset = 0
+        sequence_offset = 0
+        length = 0
+        line_bases = 0
+        line_width = 0
+        position = 0
+        # only the last line may be shorter
+        short_line = False
+        regular = True
+        seen_header = False
+
+        with open(self.pathname, "rb") as f:
+            for line in f:
+                if not seen_header and not line.startswith(b">"):
+                    # blank lines before the first header are skipped
+                    if line.strip():
+                        sys.exit(f"ERROR: sequence data before the first header in {self.input_pathname}")
+                    position += len(line)
+                    sequence_offset = position
+                    continue
+
+                if line.startswith(b">"):
+                    if not line[1:].split():
+                        sys.exit(f"ERROR: header without a sequence name in {self.input_pathname}: {line.rstrip().decode()}")
+                    seen_header = True
+                    # as before, a header without sequence lines is dropped
+                    if sequence_offset < position:
                         self.sequences.append(
-                            FastaSequence(description, sequence, len(sequence))
+                            FastaSequence(description, length, offset, sequence_offset, position, line_bases if regular else 0, line_width)
                         )
-                        seqs.clear()
 
-                    description = line
+                    description = line.rstrip().decode()
+                    offset = position
+                    sequence_offset = position + len(line)
+                    length = 0
+                    line_bases = 0
+                    line_width = 0
+                    short_line = False
+                    regular = True
                 else:
-                    seqs.append(line)
-
-            if seqs:
-                sequence = "".join(seqs)
+                    bases = len(line.rstrip())
+                    if line_bases == 0:
+                        line_bases = bases
+                        line_width = len(line)
+                    elif short_line or bases > line_bases:
+                        regular = False
+                    elif bases < line_bases or len(line) != line_width:
+                        short_line = True
+                    length += bases
+
+                position += len(line)
+
+            if sequence_offset < position:
                 self.sequences.append(
-                    FastaSequence(description, sequence, len(sequence))
+                    FastaSequence(description, length, offset, sequence_offset, position, line_bases if regular else 0, line_width)
                 )
 
-        if args.debug:
+        if self.debug:
             debug_end(
                 debug_r_beg,
                 debug_beg,
                 debug_who,
-                f"loaded fasta {self.pathname}",
+                f"indexed fasta {self.pathname}",
             )
 
-    def _get_open_method(self) -> typing.TextIO:
+    def split_long_sequences(self, max_bp: int, overlap_bp: int) -> dict[str, dict[str, typing.Any]]:
+        """
+        Replaces the sequences longer than max_bp by windows of max_bp
+        overlapping by overlap_bp, returns where each window is in its
+        sequence
+        """
+
+        windows: dict[str, dict[str, typing.Any]] = {}
+        sequences: list[FastaSequence] = []
+        names = {sequence.description[1:].split()[0] for sequence in self.sequences if sequence.description}
+        step = max_bp - overlap_bp
+
+        for sequence in self.sequences:
+            if sequence.length <= max_bp:
+                sequences.append(sequence)
+                continue
+
+            if sequence.line_bases == 0:
+                sys.exit(f"ERROR: sequence {sequence.description} has lines of different lengths and can not be split")
+
+            name = sequence.description[1:].split()[0]
+            for start in range(0, sequence.length - overlap_bp, step):
+                end = min(start + max_bp, sequence.length)
+                window_name = f"{name}{WINDOW_SEPARATOR}{start}"
+                if window_name in names:
+                    sys.exit(f"ERROR: window {window_name} has the name of a sequence")
+
+                window_offset = self._base_offset(sequence, start)
+                sequences.append(
+                    FastaSequence(f">{window_name}", end - start, window_offset, window_offset, self._base_offset(sequence, end), sequence.line_bases, sequence.line_width)
+                )
+                windows[window_name] = {"parent": name, "start": start, "length": end - start, "parent_length": sequence.length}
+
+                if end == sequence.length:
+                    break
+
+        self.sequences = sequences
+        self.sequences.sort(key=lambda x: x.length, reverse=True)
+        return windows
+
+    def weights(self, mode: str = "length") -> list[int]:
+        """
+        Returns the weight of each sequence: its length, its number of
+        bases that are not N (acgt) or of those not soft-masked either
+        (unmasked)
+        """
+
+        if mode == "length":
+            return [sequence.length for sequence in self.sequences]
+
+        if self.debug:
+            debug_r_beg, debug_beg, debug_who = debug_start(
+                resource.RUSAGE_SELF, f"weighing sequences of {self.pathname}"
+            )
+
+        # counted a read at a time by deleting the other bytes
+        not_weighed = NOT_WEIGHED[mode]
+        weights = [0] * len(self.sequences)
+        with open(self.pathname, "rb") as f:
+            for ind in sorted(range(len(self.sequences)), key=lambda ind: self.sequences[ind].offset):
+                for data in self._copy_sequence(f, self.sequences[ind], None):
+                    weights[ind] += len(data.translate(None, not_weighed))
+
+        if self.debug:
+            debug_end(
+                debug_r_beg,
+                debug_beg,
+                debug_who,
+                f"weighed sequences of {self.pathname}",
+            )
+
+        return weights
+
+    def _base_offset(self, sequence: FastaSequence, position: int) -> int:
+        lines, column = divmod(position, sequence.line_bases)
+        return typing.cast(int, sequence.sequence_offset + lines * sequence.line_width + column)
+
+    def write_chunks(self, pathnames: list[str], chunk_indexes: list[list[int]], fasta: bool = True, to_2bit: bool = False) -> None:
+        """
+        Writes the sequences with the indexes in chunk_indexes[i] to
+        pathnames[i] and/or pathnames[i].2bit, reading the input once from
+        start to end
+        """
+
+        chunk_of_sequence = {}
+        for chunk_no, indexes in enumerate(chunk_indexes):
+            for ind in indexes:
+                chunk_of_sequence[ind] = chunk_no
+        in_file_order = sorted(chunk_of_sequence, key=lambda ind: self.sequences[ind].offset)
+
+        out_files: list[typing.BinaryIO | None] = [None] * len(pathnames)
+        twobit_writers: list[TwoBitWriter | None] = [None] * len(pathnames)
         try:
+            for chunk_no, pathname in enumerate(pathnames):
+                if fasta:
+                    out_files[chunk_no] = open(pathname, "wb")
+                if to_2bit:
+                    # the 2bit index lists the sequences in the order they are written
+                    chunk_sequences = [self.sequences[ind] for ind in in_file_order if chunk_of_sequence[ind] == chunk_no]
+                    twobit_writers[chunk_no] = TwoBitWriter(f"{pathname}.2bit", chunk_sequences)
+
             with open(self.pathname, "rb") as f:
-                if f.read(2) == b"\x1f\x8b":
-                    return gzip.open(self.pathname, mode="rt")
-        except FileNotFoundError:
-            sys.exit(f"ERROR: Unable to read file: {self.pathname}")
-        except Exception:
-            pass
+                for ind in in_file_order:
+                    sequence = self.sequences[ind]
+                    out_file = out_files[chunk_of_sequence[ind]]
+                    twobit_writer = twobit_writers[chunk_of_sequence[ind]]
+
+                    sequence_data = self._copy_sequence(f, sequence, out_file)
+                    if twobit_writer is not None:
+                        twobit_writer.add(sequence, sequence_data)
+                    else:
+                        for _ in sequence_data:
+                            pass
+        finally:
+            for out_file in out_files:
+                if out_file is not None:
+                    out_file.close()
+            for twobit_writer in twobit_writers:
+                if twobit_writer is not None:
+                    twobit_writer.close()
+
+    def _copy_sequence(self, f: typing.BinaryIO, sequence: FastaSequence, out_file: typing.BinaryIO | None) -> typing.Iterator[bytes]:
+        """
+        Copies the header and sequence lines as they are in the input to
+        out_file, yielding the sequence lines on the way
+        """
+
+        # a window gets a header of its own
+        if out_file is not None and sequence.offset == sequence.sequence_offset:
+            out_file.write(f"{sequence.description}\n".encode())
+
+        f.seek(sequence.offset)
+        remaining = sequence.end - sequence.offset
+        header_remaining = sequence.sequence_offset - sequence.offset
+        last_byte = b""
+        while remaining > 0:
+            data = f.read(min(remaining, COPY_BUFFER_SIZE))
+            if not data:
+                break
+            if out_file is not None:
+                out_file.write(data)
+            remaining -= len(data)
+            last_byte = data[-1:]
+
+            if header_remaining >= len(data):
+                header_remaining -= len(data)
+                continue
+            yield data[header_remaining:]
+            header_remaining = 0
 
-        return open(self.pathname, mode="rt")
+        # the last sequence of the input may not end in a newline
+        if out_file is not None and last_byte != b"\n":
+            out_file.write(b"\n")
 
     @property
     def total_bases(self) -> int:
@@ -131,13 +385,6 @@ class FastaFile:
         for fasta_sequence in self.sequences:
             yield fasta_sequence
 
-    def to_single_seq(self) -> None:
-        description = self.sequences[0].description
-        sequence = "".join([seq.sequence for seq in self.sequences])
-
-        self.sequences.clear()
-        self.sequences.append(FastaSequence(description, sequence, len(sequence)))
-
     def discard_sequences_after_and_including(
         self, description: str, debug: bool = False
     ) -> None:
@@ -163,44 +410,155 @@ class FastaFile:
             self.sequences = self.sequences[: split_index - 1]
 
 
-def convert_to_2bit(root_dir: str) -> None:
-    commands = []
+def _twobit_tables() -> tuple[bytes, bytes]:
+    # other letters (IUPAC codes) become N, keeping their case, and so does
+    # anything else that is not whitespace
+    normalize = bytearray(range(256))
+    for c in range(256):
+        if chr(c).islower() and chr(c).isascii():
+            normalize[c] = ord("n")
+        elif c not in WHITESPACE:
+            normalize[c] = ord("N")
+    for bases in [b"ACGTN", b"acgtn"]:
+        for c in bases:
+            normalize[c] = c
+    normalize[ord("U")] = ord("T")
+    normalize[ord("u")] = ord("t")
 
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        for filename in filenames:
-            match = re.match(r"chunk_\d+$", filename)
-            if match:
-                pathname = os.path.join(root_dir, filename)
-                new_pathname = f"{pathname}.2bit"
-                command = f"faToTwoBit {pathname} {new_pathname}"
-                commands.append(command)
+    # N is stored as T, the N blocks tell them apart
+    codes = bytearray(256)
+    for bases in [b"TCAG", b"tcag"]:
+        for code, c in enumerate(bases):
+            codes[c] = code
 
-    cpus_available = len(os.sched_getaffinity(0))
-    num_commands = len(commands)
-    if cpus_available > num_commands:
-        cpus_available = num_commands
+    return bytes(normalize), bytes(codes)
 
-    if args.debug:
-        print(
-            f"DEBUG: converting to 2bit {cpus_available} CPUs",
-            file=sys.stderr,
-            flush=True,
-        )
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=cpus_available) as executor:
-        for _ in executor.map(twobit_wrapper, commands):
-            pass
+TWOBIT_NORMALIZE, TWOBIT_CODES = _twobit_tables()
 
 
-def twobit_wrapper(command: str) -> None:
-    process = subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True
-    )
-    stdout, stderr = process.communicate()
-    if stdout:
-        print(f"{stdout}", file=sys.stdout)
-    if stderr:
-        print(f"{stderr}", file=sys.stderr)
+class TwoBitWriter:
+    """
+    Writes a .2bit file as faToTwoBit does, one sequence at a time
+
+    The index at the start of the file is written last, when the offsets of
+    the sequence records are known. Files that would not fit 32 bit offsets
+    are written as version 1 (faToTwoBit -long).
+    """
+
+    def __init__(self, pathname: str, sequences: list[FastaSequence]) -> None:
+        self.pathname = pathname
+        # faToTwoBit skips sequences without bases
+        self.names = [sequence.description[1:].split()[0] for sequence in sequences if sequence.length > 0]
+        self.offsets: list[int] = []
+
+        if len(set(self.names)) != len(self.names):
+            sys.exit(f"ERROR: duplicate sequence name in {pathname}")
+
+        # records without the N and mask blocks
+        estimated_size = 16 + sum(1 + len(name) + 4 for name in self.names) + sum(16 + (sequence.length + 3) // 4 for sequence in sequences)
+        self.version = 1 if estimated_size + TWOBIT_BLOCKS_MARGIN >= 1 << 32 else 0
+        self.offset_format = "<Q" if self.version == 1 else "<I"
+
+        self.f = open(pathname, "wb")
+        self.f.write(struct.pack("<IIII", TWOBIT_SIGNATURE, self.version, len(self.names), 0))
+        self.index_offset = self.f.tell()
+        self._write_index()
+
+    def _write_index(self) -> None:
+        self.f.seek(self.index_offset)
+        offsets = self.offsets + [0] * (len(self.names) - len(self.offsets))
+        for name, offset in zip(self.names, offsets):
+            encoded_name = name.encode()
+            self.f.write(struct.pack("<B", len(encoded_name)) + encoded_name + struct.pack(self.offset_format, offset))
+
+    def add(self, sequence: FastaSequence, sequence_data: typing.Iterable[bytes]) -> None:
+        # starts and sizes
+        n_blocks = (array.array("I"), array.array("I"))
+        mask_blocks = (array.array("I"), array.array("I"))
+        packed: list[bytes] = []
+        position = 0
+        carry = b""
+
+        for data in sequence_data:
+            bases = data.translate(TWOBIT_NORMALIZE, WHITESPACE)
+            for (starts, sizes), regex in [(n_blocks, N_BLOCK_REGEX), (mask_blocks, MASK_BLOCK_REGEX)]:
+                spans = [match.span() for match in regex.finditer(bases)]
+                # runs continue across reads
+                if spans and starts and starts[-1] + sizes[-1] == position + spans[0][0]:
+                    sizes[-1] += spans[0][1] - spans[0][0]
+                    del spans[0]
+                starts.extend([position + start for start, _ in spans])
+                sizes.extend([end - start for start, end in spans])
+            position += len(bases)
+
+            codes = carry + bases.translate(TWOBIT_CODES)
+            whole = len(codes) - len(codes) % 4
+            packed.append(pack_bases(codes[:whole]))
+            carry = codes[whole:]
+
+        if position == 0:
+            return
+
+        # the last byte is filled up with T
+        if carry:
+            packed.append(pack_bases(carry + bytes(4 - len(carry))))
+
+        offset = self.f.tell()
+        if self.version == 0 and offset >= 1 << 32:
+            sys.exit(f"ERROR: {self.pathname} needs 64 bit offsets")
+        self.offsets.append(offset)
+
+        record = [struct.pack("<I", position)]
+        for starts, sizes in [n_blocks, mask_blocks]:
+            if sys.byteorder == "big":
+                starts.byteswap()
+                sizes.byteswap()
+            record.append(struct.pack("<I", len(starts)))
+            record.append(starts.tobytes())
+            record.append(sizes.tobytes())
+        record.append(struct.pack("<I", 0))
+
+        self.f.write(b"".join(record))
+        for data in packed:
+            self.f.write(data)
+
+    def close(self) -> None:
+        self._write_index()
+        self.f.close()
+
+
+def pack_bases(codes: bytes) -> bytes:
+    # four 2 bit codes a byte, first base in the high bits. Every fourth code
+    # is shifted as a single big integer, no code carries into the next byte
+    packed = 0
+    for i, shift in enumerate([6, 4, 2, 0]):
+        packed |= int.from_bytes(codes[i::4], "big") << shift
+
+    return packed.to_bytes(len(codes) // 4, "big")
+
+
+def pack_lengths(lengths: list[int], num_chunks: int) -> tuple[list[int], list[list[int]]]:
+    """
+    Returns the bin sizes and the indexes of the lengths in each bin
+    """
+
+    # Longest-processing-time-first Algorithm
+    # sequence length is used as a proxy for processing-time
+    pq: list[tuple[int, int]] = [(0, i) for i in range(num_chunks)]  # bin size and bin id
+    files: list[list[int]] = [[] for _ in range(num_chunks)]
+
+    for i, length in enumerate(lengths):
+        # get smallest file
+        size, bin_no = pq[0]
+        heapq.heapreplace(pq, (size + length, bin_no))
+        files[bin_no].append(i)
+
+    sizes = [0] * num_chunks
+    for size, bin_no in pq:
+        sizes[bin_no] = size
+
+    return sizes, files
 
 
 def split_chr(
@@ -209,52 +567,36 @@ def split_chr(
     num_chunks: int,
     write_to_output_dir: bool = True,
     debug: bool = False,
+    fasta: bool = True,
+    to_2bit: bool = False,
+    weights: list[int] | None = None,
 ) -> list[int]:
-    # Longest-processing-time-first Algorithm
-    # sequence length is used as a proxy for processing-time
-    chunk_size_list = []
-
-    pq: list[tuple[int, int]] = []
-    for i in range(num_chunks):
-        heapq.heappush(pq, (0, i))  # bin size and bin id
-
-    files: dict[int, list[int]] = {}
-    for i in range(num_chunks):
-        files[i] = []
-
-    i = 0
-    for sequence in target_fasta:
-        # get smallest file
-        size, bin_no = heapq.heappop(pq)
-        size += sequence.length
-        heapq.heappush(pq, (size, bin_no))
-        files[bin_no].append(i)
-        i += 1
-
-    seen_inds = []  # for sanity checking
+    if weights is None:
+        weights = [sequence.length for sequence in target_fasta]
 
-    for bin_no, chr_indexes in files.items():
-        bin_size = 0
+    # heaviest first, the sequences are already sorted by length
+    order = sorted(range(len(weights)), key=lambda ind: weights[ind], reverse=True)
+    chunk_size_list, packed = pack_lengths([weights[ind] for ind in order], num_chunks)
+    files = [[order[i] for i in chr_indexes] for chr_indexes in packed]
 
+    seen_inds = set()  # for sanity checking
+    for bin_no, chr_indexes in enumerate(files):
         for ind in chr_indexes:
             assert ind not in seen_inds  # sanity check
-            seen_inds.append(ind)
-            bin_size += target_fasta.sequences[ind].length
+            seen_inds.add(ind)
 
         if debug:
             print(
-                f"DEBUG: chunk_{bin_no} num bp {bin_size}", file=sys.stderr, flush=True
+                f"DEBUG: chunk_{bin_no} weight {chunk_size_list[bin_no]}", file=sys.stderr, flush=True
             )
 
-        chunk_size_list.append(bin_size)
-        block_file_name = os.path.join(output_dir, f"chunk_{bin_no}")
-
-        if write_to_output_dir:
-            with open(block_file_name, "w") as out_file:
-                for ind in chr_indexes:
-                    sequence = target_fasta.sequences[ind]
-                    print(f"{sequence.description}", file=out_file)
-                    print(f"{sequence.sequence}", file=out_file)
+    if write_to_output_dir:
+        target_fasta.write_chunks(
+            [os.path.join(output_dir, f"chunk_{bin_no}") for bin_no in range(num_chunks)],
+            files,
+            fasta=fasta,
+            to_2bit=to_2bit,
+        )
 
     if debug:
         print(
@@ -268,11 +610,6 @@ def split_chr(
     return chunk_size_list
 
 
-def parallel_wrapper(pass_list: tuple[str, str, int, bool, bool]) -> list[int]:
-    _pass_list = (FastaFile(pass_list[0]), pass_list[1], pass_list[2], pass_list[3])
-    return split_chr(*_pass_list)
-
-
 def mse(data: list[int], base: int) -> float:
     mse = [(base - i) ** 2 for i in data]
     return sum(mse) / len(mse)
@@ -289,14 +626,17 @@ if __name__ == "__main__":
     )
     parser.add_argument("--out", type=str, required=True, help="Output directory")
     parser.add_argument(
-        "--to_2bit", action="store_true", help="Convert partitioned inputs into .2bit format"
+        "--to_2bit", action="store_true", help="Also write partitioned inputs in .2bit format"
+    )
+    parser.add_argument(
+        "--no_fasta", action="store_true", help="Do not write partitioned inputs in fasta format, only with --to_2bit"
     )
 
     parser.add_argument(
         "--max_chunks",
         default=20,
         type=int,
-        help="Maximum number of chunks to split input into. If --goal_bp is not provided, this is the exact number of bins to partition input into",
+        help="Maximum number of chunks to split input into. If --goal_bp is not provided, this is the exact number of bins to partition input into. Every bin count up to it is tried on the sequence lengths alone, so large values are cheap",
     )
     # TODO: could get rid of max_chunks parameter by checking whether local
     # minima is enountered when calculating mse, when goal_bp is provided
@@ -307,6 +647,24 @@ if __name__ == "__main__":
         type=int,
         help="Goal basepairs count for each partition. Number of partitions calculated using MSE. Check up to --max_chunks number of bins",
     )
+    parser.add_argument(
+        "--max_sequence_bp",
+        default=0,
+        type=int,
+        help="Split sequences longer than this into overlapping windows, listed in windows.json in the output directory. See lift_windows.py",
+    )
+    parser.add_argument(
+        "--overlap_bp",
+        default=100_000,
+        type=int,
+        help="Overlap of the windows of split sequences. Alignments longer than half of it may be cut where windows meet",
+    )
+    parser.add_argument(
+        "--weight",
+        default="length",
+        choices=WEIGHT_MODES,
+        help="What the chunks are balanced on: sequence length, bases that are not N (acgt) or bases that are neither N nor soft-masked (unmasked), which is closer to the seeding work",
+    )
     parser.add_argument("--debug", action="store_true", help="Print debug information")
 
     if len(sys.argv) <= 1:
@@ -316,7 +674,6 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     target_file = args.input
-    # target_fasta = FastaFile(target_file, debug=args.debug)
 
     target_block_dir = args.out
 
@@ -324,37 +681,36 @@ if __name__ == "__main__":
         print(f"Input file {args.input} does not exist.")
         exit(1)
 
+    if args.no_fasta and not args.to_2bit:
+        sys.exit("ERROR: --no_fasta needs --to_2bit")
+    if args.max_sequence_bp and not 0 <= args.overlap_bp < args.max_sequence_bp:
+        sys.exit("ERROR: --overlap_bp must be smaller than --max_sequence_bp")
+
     os.makedirs(target_block_dir, exist_ok=True)
 
-    if args.goal_bp:
-        bin_count = args.max_chunks
-        goal_bp = args.goal_bp
-        best_bin_count = -1
-        best_bin_loss = math.inf
-        # NOTE: FastaFile object is not serializable and using it in pass list
-        # prevents parallel execution. As a workaround, pass the input file path
-        # and initialize FastFile object in parallel_wrapper
-        # TODO: find a better way to do this
-        pass_list = [
-            (target_file, "", i, False, False) for i in range(1, bin_count + 1)
-        ]
-
-        cpus_available = len(os.sched_getaffinity(0))
-        if cpus_available > bin_count:
-            cpus_available = bin_count
+    # only the index is kept in memory
+    target_fasta = FastaFile(target_file, debug=args.debug, tmp_dir=target_block_dir)
+    try:
+        if args.max_sequence_bp:
+            windows = target_fasta.split_long_sequences(args.max_sequence_bp, args.overlap_bp)
+            with open(os.path.join(target_block_dir, WINDOWS_FILENAME), "w") as f:
+                json.dump({"overlap": args.overlap_bp, "windows": windows}, f, indent=2)
 
-        if args.debug:
-            print(
-                f"DEBUG: spliting using {cpus_available} CPUs",
-                file=sys.stderr,
-                flush=True,
-            )
+        weights = target_fasta.weights(args.weight)
 
-        with concurrent.futures.ProcessPoolExecutor(
-            max_workers=cpus_available
-        ) as executor:
-            for bins in executor.map(parallel_wrapper, pass_list):
-                i = len(bins)
+        if args.goal_bp:
+            # the goal in the same units as the weights
+            goal_bp = args.goal_bp
+            if args.weight != "length" and target_fasta.total_bases > 0:
+                goal_bp = args.goal_bp * sum(weights) // target_fasta.total_bases
+            best_bin_count = -1
+            best_bin_loss = math.inf
+
+            # the packing only depends on the sequence weights, every bin count
+            # is tried on those
+            sorted_weights = sorted(weights, reverse=True)
+            for i in range(1, args.max_chunks + 1):
+                bins, _ = pack_lengths(sorted_weights, i)
                 loss = mse(bins, goal_bp)
 
                 if args.debug:
@@ -368,30 +724,26 @@ if __name__ == "__main__":
                     best_bin_count = i
                     best_bin_loss = loss
 
-        bin_count = best_bin_count
-    else:
-        bin_count = args.max_chunks
-    if args.debug:
-
-        if args.goal_bp:
-            print(
-                print(f"bin_count = {bin_count}, loss={best_bin_loss}"),
-                file=sys.stderr,
-                flush=True,
-            )
+            bin_count = best_bin_count
         else:
-            print(
-                f"DEBUG: bin_count = {bin_count}",
-                file=sys.stderr,
-                flush=True,
-            )
+            bin_count = args.max_chunks
+        if args.debug:
 
-    # TODO: this is a bit inefficient, since this was already calculated
-    # in parallel_wrapper (if goal_bp provided), but was not written to
-    # output directory
-    target_fasta = FastaFile(target_file, debug=args.debug)
-    split_chr(target_fasta, target_block_dir, bin_count)
+            if args.goal_bp:
+                print(
+                    f"DEBUG: bin_count = {bin_count}, loss={best_bin_loss}",
+                    file=sys.stderr,
+                    flush=True,
+                )
+            else:
+                print(
+                    f"DEBUG: bin_count = {bin_count}",
+                    file=sys.stderr,
+                    flush=True,
+                )
 
-    if args.to_2bit:
-        # Convert to 2bit format
-        convert_to_2bit(target_block_dir)
+        split_chr(target_fasta, target_block_dir, bin_count, fasta=not args.no_fasta, to_2bit=args.to_2bit, weights=weights)
+    finally:
+        # the decompressed input is in the output directory, remove it on
+        # errors too
+        target_fasta.close()
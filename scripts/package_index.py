@@ -0,0 +1,171 @@
+"""
+Offset index of seekable packages, written by package_output.py and read by
+run_lastz_tarball.py
+
+A seekable package is an ordinary gzip or zstd compressed tar whose members
+each start a new gzip member / zstd frame. After the compressed tar comes the
+index, a frame table and the uncompressed offset and size of every tar
+member, followed by a fixed-size trailer pointing at the index. Both are
+stored where decompressors skip them, in the comment of an empty gzip member
+or in a zstd skippable frame, so the package still reads as a plain .tgz or
+.tar.zst.
+"""
+
+import bisect
+import gzip
+import json
+import os
+import struct
+import tempfile
+import typing
+
+try:
+    import zstandard
+except ImportError:
+    # only needed for zstd compressed packages
+    zstandard = None  # type: ignore[assignment,unused-ignore]
+
+INDEX_VERSION: typing.Final = 1
+TRAILER_MAGIC: typing.Final = b"KEGALIGN-INDEX"
+# magic, index offset and index size as hex
+TRAILER_PAYLOAD_SIZE: typing.Final = len(TRAILER_MAGIC) + 32
+ZSTD_SKIPPABLE_MAGIC: typing.Final = 0x184D2A50
+# flags FCOMMENT, the comment, then an empty deflate block, crc32 and isize
+GZIP_COMMENT_HEADER: typing.Final = b"\x1f\x8b\x08\x10\x00\x00\x00\x00\x00\xff"
+GZIP_EMPTY_TAIL: typing.Final = b"\x00\x03\x00" + struct.pack("<II", 0, 0)
+
+
+def wrap_payload(compression: str, payload: bytes) -> bytes:
+    if compression == "zstd":
+        return struct.pack("<II", ZSTD_SKIPPABLE_MAGIC, len(payload)) + payload
+
+    # the comment is zero terminated, json.dumps() output is plain ASCII
+    return GZIP_COMMENT_HEADER + payload + GZIP_EMPTY_TAIL
+
+
+def unwrap_payload(compression: str, data: bytes) -> bytes:
+    if compression == "zstd":
+        return data[8:]
+
+    return data[len(GZIP_COMMENT_HEADER): -len(GZIP_EMPTY_TAIL)]
+
+
+def index_trailer(compression: str, frames: typing.List[typing.Tuple[int, int]], members: typing.Dict[str, typing.Tuple[int, int]], offset: int) -> bytes:
+    """
+    Returns the index and trailer appended at compressed offset offset,
+    right after the last frame
+    """
+
+    index = {
+        "version": INDEX_VERSION,
+        "compression": compression,
+        "frames": frames,
+        "end": offset,
+        "members": members,
+    }
+    wrapped_index = wrap_payload(compression, json.dumps(index).encode())
+
+    trailer_payload = TRAILER_MAGIC + b"%016x%016x" % (offset, len(wrapped_index))
+    return wrapped_index + wrap_payload(compression, trailer_payload)
+
+
+class SeekablePackage:
+    """
+    Random access to the members of a seekable package
+
+    Only the frames holding a member are read and decompressed.
+    """
+
+    def __init__(self, pathname: str, index: typing.Dict[str, typing.Any]) -> None:
+        self.pathname = pathname
+        self.compression: str = index["compression"]
+        self.members: typing.Dict[str, typing.List[int]] = index["members"]
+        self.compressed_offsets: typing.List[int] = [frame[0] for frame in index["frames"]]
+        self.uncompressed_offsets: typing.List[int] = [frame[1] for frame in index["frames"]]
+        # the index starts where the last frame ends
+        self.compressed_offsets.append(index["end"])
+
+    @classmethod
+    def load(cls, pathname: str) -> typing.Optional["SeekablePackage"]:
+        """
+        Returns None when pathname is not a seekable package
+        """
+
+        trailer_sizes = {
+            "zstd": len(wrap_payload("zstd", bytes(TRAILER_PAYLOAD_SIZE))),
+            "gzip": len(wrap_payload("gzip", bytes(TRAILER_PAYLOAD_SIZE))),
+        }
+
+        with open(pathname, "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
+
+            for compression, trailer_size in trailer_sizes.items():
+                if file_size < trailer_size:
+                    continue
+
+                f.seek(file_size - trailer_size)
+                payload = unwrap_payload(compression, f.read(trailer_size))
+                if not payload.startswith(TRAILER_MAGIC):
+                    continue
+
+                offset = int(payload[len(TRAILER_MAGIC): len(TRAILER_MAGIC) + 16], 16)
+                size = int(payload[len(TRAILER_MAGIC) + 16:], 16)
+                f.seek(offset)
+                index: typing.Dict[str, typing.Any] = json.loads(unwrap_payload(compression, f.read(size)))
+                if index.get("version") != INDEX_VERSION:
+                    return None
+
+                return cls(pathname, index)
+
+        return None
+
+    def names(self) -> typing.List[str]:
+        return list(self.members.keys())
+
+    def _decompress(self, data: bytes) -> bytes:
+        if self.compression == "zstd":
+            if zstandard is None:
+                raise RuntimeError(f"zstd compressed package needs the zstandard module: {self.pathname}")
+            decompressed: bytes = zstandard.ZstdDecompressor().decompress(data)
+            return decompressed
+
+        return gzip.decompress(data)
+
+    def read_chunks(self, name: str) -> typing.Iterator[bytes]:
+        offset, size = self.members[name]
+        end = offset + size
+        frame = bisect.bisect_right(self.uncompressed_offsets, offset) - 1
+
+        with open(self.pathname, "rb") as f:
+            f.seek(self.compressed_offsets[frame])
+            while offset < end:
+                data = self._decompress(f.read(self.compressed_offsets[frame + 1] - self.compressed_offsets[frame]))
+                frame_offset = self.uncompressed_offsets[frame]
+
+                chunk = data[offset - frame_offset: end - frame_offset]
+                yield chunk
+                offset += len(chunk)
+                frame += 1
+
+    def read(self, name: str) -> bytes:
+        return b"".join(self.read_chunks(name))
+
+    def extract(self, name: str, pathname: str) -> None:
+        """
+        Writes member name to pathname, atomically so concurrent readers
+        never see a partial file
+        """
+
+        dirname = os.path.dirname(pathname) or "."
+        os.makedirs(dirname, exist_ok=True)
+
+        fd, tmp_pathname = tempfile.mkstemp(prefix=".tmp-", dir=dirname)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in self.read_chunks(name):
+                    f.write(chunk)
+            os.replace(tmp_pathname, pathname)
+        except BaseException:
+            if os.path.exists(tmp_pathname):
+                os.remove(tmp_pathname)
+            raise
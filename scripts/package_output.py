@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 
 import argparse
+import collections
+import concurrent.futures
 import configparser
+import contextlib
+import gzip
+import io
+import itertools
 import json
 import os
+import re
 import resource
+import shutil
 import sys
 import tarfile
 import time
@@ -12,9 +20,115 @@ import typing
 
 import bashlex
 
+import segment_codec
+from lastz_cache import link_or_copy
+from package_index import index_trailer
+
+try:
+    import zstandard
+except ImportError:
+    # only needed for --compression zstd
+    zstandard = None  # type: ignore[assignment,unused-ignore]
+
+# uncompressed bytes per independently compressed gzip member / zstd frame
+BLOCK_SIZE: typing.Final = 4 << 20
+DEFAULT_LEVELS: typing.Final = {"gzip": 6, "zstd": 3}
+# command lines handed to a parser process at a time
+PARSE_CHUNK_LINES: typing.Final = 10000
+# seconds between checks of a followed command file for new lines
+FOLLOW_POLL_INTERVAL: typing.Final = 0.2
+# a streamed package gets a commands part after this many commands or
+# seconds, following the files of its commands
+STREAM_PART_COMMANDS: typing.Final = 1000
+STREAM_PART_SECONDS: typing.Final = 5.0
 RUSAGE_ATTRS: typing.Final = ["ru_utime", "ru_stime", "ru_maxrss", "ru_minflt", "ru_majflt", "ru_inblock", "ru_oublock", "ru_nvcsw", "ru_nivcsw"]
 
 
+class ParallelCompressor:
+    """
+    Write-only file object compressing fixed-size blocks on a thread pool
+
+    Every block becomes an independent gzip member or zstd frame, and the
+    concatenated blocks are a valid gzip or zstd stream. zlib and zstd
+    release the GIL, so the blocks really are compressed in parallel.
+    """
+
+    def __init__(
+        self,
+        fileobj: typing.BinaryIO,
+        compression: str = "gzip",
+        level: typing.Optional[int] = None,
+        threads: int = 1,
+        block_size: int = BLOCK_SIZE,
+    ) -> None:
+        if compression == "zstd" and zstandard is None:
+            sys.exit("zstd compression needs the zstandard module")
+
+        self.fileobj = fileobj
+        self.compression = compression
+        self.level: int = DEFAULT_LEVELS[compression] if level is None else level
+        self.threads = max(threads, 1)
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending: typing.Deque[typing.Tuple[concurrent.futures.Future[bytes], int]] = collections.deque()
+        # uncompressed bytes written so far, and bytes in the output file
+        self.uncompressed_offset = 0
+        self.compressed_offset = 0
+        # (compressed offset, uncompressed offset) of the start of every frame
+        self.frames: typing.List[typing.Tuple[int, int]] = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+
+    def _compress(self, block: bytes) -> bytes:
+        if self.compression == "zstd":
+            # compressor objects are not thread safe, use one per block
+            compressed: bytes = zstandard.ZstdCompressor(level=self.level).compress(block)
+            return compressed
+
+        return gzip.compress(block, compresslevel=self.level, mtime=0)
+
+    def _submit(self, block: bytes) -> None:
+        self.pending.append((self.executor.submit(self._compress, block), self.uncompressed_offset - len(self.buffer)))
+
+        # write finished blocks in order, bounding the blocks held in memory
+        while len(self.pending) > 2 * self.threads or (self.pending and self.pending[0][0].done()):
+            self._write_block()
+
+    def _write_block(self) -> None:
+        future, uncompressed_offset = self.pending.popleft()
+        compressed = future.result()
+
+        self.frames.append((self.compressed_offset, uncompressed_offset))
+        self.fileobj.write(compressed)
+        self.compressed_offset += len(compressed)
+
+    def tell(self) -> int:
+        return self.uncompressed_offset
+
+    def end_frame(self) -> None:
+        # the next write starts a new gzip member / zstd frame
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        self.uncompressed_offset += len(data)
+
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[: self.block_size]))
+            del self.buffer[: self.block_size]
+
+        return len(data)
+
+    def close(self) -> None:
+        self.end_frame()
+
+        while self.pending:
+            self._write_block()
+
+        self.executor.shutdown()
+
+
 class PackageFile:
     def __init__(
         self,
@@ -22,7 +136,15 @@ class PackageFile:
         top_dir: str = "galaxy",
         data_dir: str = "files",
         config_file: str = "commands.json",
-        format_file: str = "format.txt"
+        format_file: str = "format.txt",
+        metadata_file: str = "package.json",
+        compression: str = "gzip",
+        compression_level: typing.Optional[int] = None,
+        threads: int = 1,
+        shard: int = 0,
+        num_shards: int = 1,
+        seekable: bool = False,
+        compact_segments: bool = False,
     ) -> None:
         self.pathname: str = os.path.realpath(pathname)
         self.data_root: str = os.path.join(top_dir, data_dir)
@@ -30,18 +152,92 @@ class PackageFile:
         self.config_file: str = config_file
         self.format_path: str = os.path.join(top_dir, format_file)
         self.format_file: str = format_file
+        self.metadata_path: str = os.path.join(top_dir, metadata_file)
+        self.compression = compression
+        self.compression_level = compression_level
+        self.threads = threads
+        self.shard = shard
+        self.num_shards = num_shards
+        self.seekable = seekable
+        self.compact_segments = compact_segments
+        # uncompressed (offset, size) of the data of every member
+        self.members: typing.Dict[str, typing.Tuple[int, int]] = {}
+        self.fileobj: typing.Optional[typing.BinaryIO] = None
+        self.compressor: typing.Optional[ParallelCompressor] = None
         self.tarfile: typing.Optional[tarfile.TarFile] = None
         self.name_cache: typing.Dict[typing.Any, typing.Any] = {}
         self.working_dir: str = os.path.realpath(os.getcwd())
 
     def _initialize(self) -> None:
         if self.tarfile is None:
+            self.fileobj = open(self.pathname, "wb")
+            self.compressor = ParallelCompressor(
+                self.fileobj,
+                compression=self.compression,
+                level=self.compression_level,
+                threads=self.threads,
+            )
+            # the compressor tells the uncompressed offset, so the member
+            # offsets can be indexed
             self.tarfile = tarfile.open(
-                name=self.pathname,
-                mode="w:gz",
+                fileobj=typing.cast(typing.BinaryIO, self.compressor),
+                mode="w",
                 format=tarfile.GNU_FORMAT,
-                compresslevel=6,
             )
+            self._add_metadata()
+
+    def _add_metadata(self) -> None:
+        # readers detect the compression from the magic bytes, this records
+        # how the package was written
+        metadata = {
+            "compression": self.compression,
+            "compression_level": self.compressor.level if self.compressor is not None else None,
+            "block_size": BLOCK_SIZE,
+            # only shard 0 starts the concatenated output with a header
+            "shard": self.shard,
+            "num_shards": self.num_shards,
+            "seekable": self.seekable,
+            "compact_segments": self.compact_segments,
+        }
+        data = json.dumps(metadata).encode()
+
+        tarinfo = tarfile.TarInfo(self.metadata_path)
+        tarinfo.size = len(data)
+        tarinfo.mtime = int(time.time())
+        self._add(self.metadata_path, tarinfo=tarinfo, data=data)
+
+    def _add(
+        self,
+        arcname: str,
+        source_path: typing.Optional[str] = None,
+        tarinfo: typing.Optional[tarfile.TarInfo] = None,
+        data: typing.Optional[bytes] = None,
+    ) -> None:
+        if self.tarfile is None or self.compressor is None:
+            return
+
+        if self.seekable:
+            # a member never shares a frame with the one before it, so
+            # reading it only decompresses its own frames
+            self.compressor.end_frame()
+
+        if tarinfo is None:
+            tarinfo = self.tarfile.gettarinfo(source_path, arcname=arcname)
+
+        if data is not None:
+            self.tarfile.addfile(tarinfo, io.BytesIO(data))
+        elif source_path is not None and tarinfo.isreg():
+            with open(source_path, "rb") as f:
+                self.tarfile.addfile(tarinfo, f)
+        else:
+            self.tarfile.addfile(tarinfo)
+
+        if tarinfo.islnk():
+            # a hardlink to a file that is already in the package
+            self.members[arcname] = self.members[tarinfo.linkname]
+        else:
+            padded_size = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            self.members[arcname] = (self.tarfile.offset - padded_size, tarinfo.size)
 
     def add_config(self, pathname: str) -> None:
         if self.tarfile is None:
@@ -49,10 +245,24 @@ class PackageFile:
 
         source_path = os.path.realpath(pathname)
 
-        if self.tarfile is not None:
-            self.tarfile.add(source_path, arcname=self.config_path, recursive=False)
+        self._add(self.config_path, source_path)
+
+    def _add_segments(self, arcname: str, source_path: str) -> None:
+        with open(source_path, "rb") as f:
+            encoded = segment_codec.encode(f.read())
+
+        if encoded is None or self.tarfile is None:
+            # not a plain segment file, kept as text
+            self._add(arcname, source_path)
+            return
 
-    def add_file(self, pathname: str, arcname: typing.Optional[str] = None) -> None:
+        tarinfo = self.tarfile.gettarinfo(source_path, arcname=arcname)
+        tarinfo.type = tarfile.REGTYPE
+        tarinfo.linkname = ""
+        tarinfo.size = len(encoded)
+        self._add(arcname, tarinfo=tarinfo, data=encoded)
+
+    def add_file(self, pathname: str, arcname: typing.Optional[str] = None, segments: bool = False) -> None:
         if self.tarfile is None:
             self._initialize()
 
@@ -71,17 +281,17 @@ class PackageFile:
                 sys.exit("path fail")
 
         if dest_path is not None:
-            if self.tarfile is not None:
-                if dest_path not in self.name_cache:
-                    try:
-                        self.tarfile.add(
-                            source_path, arcname=dest_path, recursive=False
-                        )
-                    except FileNotFoundError:
-                        sys.exit(f"missing source file {source_path}")
-
-                    self.name_cache[dest_path] = 1
-                    # print(f"added: {dest_path}", flush=True)
+            if dest_path not in self.name_cache:
+                try:
+                    if segments and self.compact_segments:
+                        self._add_segments(dest_path, source_path)
+                    else:
+                        self._add(dest_path, source_path)
+                except FileNotFoundError:
+                    sys.exit(f"missing source file {source_path}")
+
+                self.name_cache[dest_path] = 1
+                # print(f"added: {dest_path}", flush=True)
 
     def add_format(self, pathname: str) -> None:
         if self.tarfile is None:
@@ -89,14 +299,102 @@ class PackageFile:
 
         source_path = os.path.realpath(pathname)
 
-        if self.tarfile is not None:
-            self.tarfile.add(source_path, arcname=self.format_path, recursive=False)
+        self._add(self.format_path, source_path)
+
+    def add_commands_part(self, part: int, lines: typing.List[str]) -> None:
+        # commands.json of a streamed package only comes at the end, the
+        # parts let run_lastz_tarball.py start the commands before that
+        if self.tarfile is None:
+            self._initialize()
+
+        arcname = commands_part_path(self.config_path, part)
+        data = "".join(f"{line}\n" for line in lines).encode()
+
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = len(data)
+        tarinfo.mtime = int(time.time())
+        self._add(arcname, tarinfo=tarinfo, data=data)
 
     def close(self) -> None:
         if self.tarfile is not None:
             self.tarfile.close()
             self.tarfile = None
 
+        if self.compressor is not None:
+            self.compressor.close()
+            if self.seekable and self.fileobj is not None:
+                self.fileobj.write(index_trailer(self.compression, self.compressor.frames, self.members, self.compressor.compressed_offset))
+            self.compressor = None
+
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+
+
+class PackageDirectory(PackageFile):
+    """
+    Package laid out as a directory instead of a compressed tarball
+
+    For batched_lastz runs on the same filesystem as kegalign. The files are
+    hardlinked, reflinked or, failing both, copied into the galaxy/files
+    layout of the tarball, so nothing is compressed or extracted.
+    """
+
+    def __init__(self, pathname: str = "data_package", **kwargs: typing.Any) -> None:
+        super().__init__(pathname, **kwargs)
+        self.initialized = False
+
+    def _initialize(self) -> None:
+        if self.initialized:
+            return
+
+        if os.path.lexists(self.pathname):
+            # only ever replace an earlier package
+            if not os.path.isfile(os.path.join(self.pathname, self.metadata_path)):
+                sys.exit(f"not a package directory: {self.pathname}")
+            shutil.rmtree(self.pathname)
+
+        os.makedirs(os.path.join(self.pathname, self.data_root))
+        self.initialized = True
+        self._add_metadata()
+
+    def _add_metadata(self) -> None:
+        metadata = {
+            "layout": "directory",
+            "shard": self.shard,
+            "num_shards": self.num_shards,
+        }
+
+        with open(os.path.join(self.pathname, self.metadata_path), "w") as f:
+            json.dump(metadata, f)
+
+    def add_commands_part(self, part: int, lines: typing.List[str]) -> None:
+        # nothing is extracted from a directory package
+        pass
+
+    def _add(
+        self,
+        arcname: str,
+        source_path: typing.Optional[str] = None,
+        tarinfo: typing.Optional[tarfile.TarInfo] = None,
+        data: typing.Optional[bytes] = None,
+    ) -> None:
+        dest_path = os.path.join(self.pathname, arcname)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+
+        if data is not None:
+            with open(dest_path, "wb") as f:
+                f.write(data)
+        elif source_path is not None:
+            if arcname in [self.config_path, self.format_path]:
+                # commands.json is rewritten for every shard, never link it
+                shutil.copyfile(source_path, dest_path)
+            else:
+                link_or_copy(source_path, dest_path)
+
+    def close(self) -> None:
+        pass
+
 
 class bashCommandLineFile:
     def __init__(
@@ -104,25 +402,78 @@ class bashCommandLineFile:
         pathname: str,
         config: configparser.ConfigParser,
         args: argparse.Namespace,
-        package_file: PackageFile,
+        package_files: typing.List[PackageFile],
     ) -> None:
         self.pathname: str = pathname
         self.config = config
         self.args = args
-        self.package_file = package_file
+        # one package, or one per shard
+        self.package_files = package_files
+        self.package_file = package_files[0]
+        self.num_shards = len(package_files)
         self.executable: typing.Optional[str] = None
-        self._parse_lines()
+        self.command_parser = LastzCommandParser(config)
+        # stdin and followed files are still being written to
+        self.streaming: bool = pathname == "-" or getattr(args, "follow", False)
         self._write_format()
+        self._parse_lines()
+
+    @contextlib.contextmanager
+    def _open_input(self) -> typing.Iterator[typing.Iterator[str]]:
+        if self.pathname == "-":
+            yield sys.stdin
+        elif getattr(self.args, "follow", False):
+            yield follow_lines(self.pathname, f"{self.pathname}.done")
+        else:
+            with open(self.pathname) as f:
+                yield f
+
+    def _parse_commands(self, f: typing.Iterator[str]) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        # parse chunks of lines in worker processes, yielding in input order
+        threads: int = getattr(self.args, "threads", 1)
+        chunks = iter(lambda: list(itertools.islice(f, PARSE_CHUNK_LINES)), [])
+
+        if self.streaming:
+            # a stream is packaged as each line arrives rather than once a
+            # chunk is full, the segment files are still in the page cache
+            for line in f:
+                yield self.command_parser.parse(line.rstrip("\n"))
+            return
+
+        if threads <= 1:
+            for chunk in chunks:
+                for line in chunk:
+                    yield self.command_parser.parse(line.rstrip("\n"))
+            return
+
+        config_dict = {section: dict(self.config[section]) for section in self.config.sections()}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads, initializer=_init_parser_worker, initargs=(config_dict,)) as executor:
+            pending: typing.Deque[concurrent.futures.Future[typing.List[typing.Dict[str, typing.Any]]]] = collections.deque()
+            for chunk in chunks:
+                pending.append(executor.submit(_parse_chunk, chunk))
+                while len(pending) > 2 * threads:
+                    yield from pending.popleft().result()
+
+            while pending:
+                yield from pending.popleft().result()
 
     def _parse_lines(self) -> None:
+        # (command, files it references, estimated work) of every command,
+        # kept unless the input is streamed
+        held: typing.List[typing.Tuple[typing.Dict[str, typing.Any], typing.List[typing.Tuple[str, typing.Optional[str], bool]], int]] = []
+        # streamed commands whose files are packaged, not yet in a part
+        part_lines: typing.List[str] = []
+        part_begin = time.monotonic()
+        num_parts = 0
+
         with open("commands.json", "w") as ofh:
-            with open(self.pathname) as f:
-                line: str
-                for line in f:
-                    line = line.rstrip("\n")
-                    command_dict = self._parse_line(line)
+            with self._open_input() as f:
+                for command_dict in self._parse_commands(f):
+                    self.executable = command_dict["executable"]
                     # we may want to re-write args here
                     new_args_list = []
+                    files: typing.List[typing.Tuple[str, typing.Optional[str], bool]] = []
+                    weight = 1
 
                     args_list = command_dict.get("args", [])
                     for arg in args_list:
@@ -132,13 +483,13 @@ class bashCommandLineFile:
                             if "[" in pathname:
                                 elems = pathname.split("[")
                                 sequence_file = elems.pop(0)
-                                self.package_file.add_file(sequence_file, sequence_file)
+                                files.append((sequence_file, sequence_file, False))
                                 for elem in elems:
                                     if elem.endswith("]"):
                                         elem = elem[:-1]
                                         if elem.startswith("subset="):
                                             subset_file = elem[7:]
-                                            self.package_file.add_file(subset_file)
+                                            files.append((subset_file, None, False))
 
                         elif arg.startswith("--query="):
                             pathname = arg[8:]
@@ -146,58 +497,124 @@ class bashCommandLineFile:
                             if "[" in pathname:
                                 elems = pathname.split("[")
                                 sequence_file = elems.pop(0)
-                                self.package_file.add_file(sequence_file, sequence_file)
+                                files.append((sequence_file, sequence_file, False))
                                 for elem in elems:
                                     if elem.endswith("]"):
                                         elem = elem[:-1]
                                         if elem.startswith("subset="):
                                             subset_file = elem[7:]
-                                            self.package_file.add_file(subset_file)
+                                            files.append((subset_file, None, False))
                         elif arg.startswith("--segments="):
                             pathname = arg[11:]
                             new_args_list.append(arg)
-                            self.package_file.add_file(pathname)
+                            files.append((pathname, None, True))
+                            weight += count_lines(pathname)
                         elif arg.startswith("--scores="):
                             pathname = arg[9:]
                             new_args_list.append("--scores=data/scores.txt")
-                            self.package_file.add_file(pathname, "data/scores.txt")
+                            files.append((pathname, "data/scores.txt", False))
                         else:
                             new_args_list.append(arg)
 
                     command_dict["args"] = new_args_list
-                    print(json.dumps(command_dict), file=ofh)
-
-        self.package_file.add_config("commands.json")
-
-    def _parse_line(self, line: str) -> typing.Dict[str, typing.Any]:
-        # resolve shell redirects
-        trees: typing.List[typing.Any] = bashlex.parse(line, strictmode=False)
-        positions: typing.List[typing.Tuple[int, int]] = []
+                    # lastz run time is about linear in the number of segments,
+                    # run_lastz_tarball.py starts the most expensive commands first
+                    command_dict["cost"] = weight
+
+                    if not self.streaming:
+                        held.append((command_dict, files, weight))
+                        continue
+
+                    for pathname, arcname, segments in files:
+                        self.package_file.add_file(pathname, arcname, segments)
+                    line = json.dumps(command_dict)
+                    print(line, file=ofh)
+
+                    if not part_lines:
+                        part_begin = time.monotonic()
+                    part_lines.append(line)
+                    if len(part_lines) >= STREAM_PART_COMMANDS or time.monotonic() - part_begin >= STREAM_PART_SECONDS:
+                        self.package_file.add_commands_part(num_parts, part_lines)
+                        num_parts += 1
+                        part_lines = []
+
+        if self.streaming:
+            if part_lines:
+                self.package_file.add_commands_part(num_parts, part_lines)
+            self.package_file.add_config("commands.json")
+            self.package_file.add_format("format.txt")
+        else:
+            self._write_packages(held)
+
+    def _write_packages(self, held: typing.List[typing.Tuple[typing.Dict[str, typing.Any], typing.List[typing.Tuple[str, typing.Optional[str], bool]], int]]) -> None:
+        # contiguous ranges of about equal work, so the shard outputs
+        # concatenate back in command order
+        total_weight = sum(weight for _, _, weight in held)
+        shard_commands: typing.List[typing.List[int]] = [[] for _ in range(self.num_shards)]
+
+        cumulative_weight = 0
+        for i, (_, _, weight) in enumerate(held):
+            midpoint = cumulative_weight + weight / 2
+            shard = min(int(midpoint * self.num_shards / total_weight), self.num_shards - 1)
+            shard_commands[shard].append(i)
+            cumulative_weight += weight
+
+        for package_file, indexes in zip(self.package_files, shard_commands):
+            with open("commands.json", "w") as ofh:
+                for i in indexes:
+                    print(json.dumps(held[i][0]), file=ofh)
+
+            # the commands and the files every command shares go first, so
+            # run_lastz_tarball.py can start each command as soon as its
+            # segment file is extracted
+            package_file.add_config("commands.json")
+            package_file.add_format("format.txt")
+            for segment_files in [False, True]:
+                for i in indexes:
+                    for pathname, arcname, segments in held[i][1]:
+                        if segments == segment_files:
+                            package_file.add_file(pathname, arcname, segments)
+            package_file.close()
+
+            if self.num_shards > 1 and self.args.debug:
+                weight = sum(held[i][2] for i in indexes)
+                print(f"shard {package_file.shard}: {len(indexes)} commands, estimated work {weight} ({package_file.pathname})", file=sys.stderr, flush=True)
 
-        for tree in trees:
-            visitor = nodevisitor(positions)
-            visitor.visit(tree)
+    def _write_format(self) -> None:
+        if self.args.format_selector == "bam":
+            format_name = "bam"
+        elif self.args.format_selector == "maf":
+            format_name = "maf"
+        elif self.args.format_selector == "differences":
+            format_name = "interval"
+        else:
+            format_name = "tabular"
 
-        # do replacements from the end so the indicies will be correct
-        positions.reverse()
+        with open("format.txt", "w") as ofh:
+            print(f"{format_name}", file=ofh)
 
-        processed = list(line)
-        for start, end in positions:
-            processed[start:end] = ""
 
-        processed_line: str = "".join(processed)
+class LastzCommandParser:
+    """
+    Turns a lastz command line, or a kegalign JSON job, into a command dict
 
-        command_dict = self._parse_processed_line(processed_line)
-        command_dict["stdin"] = visitor.stdin
-        command_dict["stdout"] = visitor.stdout
-        command_dict["stderr"] = visitor.stderr
+    The argparse parser is built once from lastz-cmd.ini. Lines following
+    kegalign's command template are split directly, anything else goes
+    through bashlex and argparse.
+    """
 
-        return command_dict
+    word = r"[\w./:+,=@%\[\]-]+"
+    template_line_regex = re.compile(rf"^(?P<command>[\w./+-]+(?: {word})*?)(?: 2> (?P<stderr>{word}))?$")
 
-    def _parse_processed_line(self, line: str) -> typing.Dict[str, typing.Any]:
-        argv: typing.List[str] = list(bashlex.split(line))
-        self.executable = argv.pop(0)
+    def __init__(self, config: configparser.ConfigParser) -> None:
+        self.config = config
+        self.executable: typing.Optional[str] = None
+        # option name -> ini kind, and the order argparse reports them in
+        self.option_kinds: typing.Dict[str, str] = {}
+        self.option_order: typing.Dict[str, int] = {}
+        self.parser = self._build_parser()
 
+    def _build_parser(self) -> argparse.ArgumentParser:
         parser: argparse.ArgumentParser = argparse.ArgumentParser(add_help=False)
         if "arguments" in self.config:
             arguments_section = self.config["arguments"]
@@ -206,28 +623,172 @@ class bashCommandLineFile:
             if "flag_args" in arguments_section:
                 for arg in arguments_section["flag_args"].split():
                     parser.add_argument(f"--{arg}", action="store_true")
+                    self._add_kind(arg, "flag_args")
 
             if "str_args" in arguments_section:
                 for arg in arguments_section["str_args"].split():
                     parser.add_argument(f"--{arg}", type=str)
+                    self._add_kind(arg, "str_args")
 
             if "bool_str_args" in arguments_section:
                 for arg in arguments_section["bool_str_args"].split():
                     parser.add_argument(
                         f"--{arg}", nargs="?", const=True, default=False
                     )
+                    self._add_kind(arg, "bool_str_args")
 
             if "int_args" in arguments_section:
                 for arg in arguments_section["int_args"].split():
                     parser.add_argument(f"--{arg}", type=int)
+                    self._add_kind(arg, "int_args")
 
             if "bool_int_args" in arguments_section:
                 for arg in arguments_section["bool_int_args"].split():
                     parser.add_argument(
                         f"--{arg}", nargs="?", const=True, default=False
                     )
+                    self._add_kind(arg, "bool_int_args")
+
+        return parser
+
+    def _add_kind(self, arg: str, kind: str) -> None:
+        self.option_kinds[arg] = kind
+        self.option_order[arg] = len(self.option_order)
+
+    def parse(self, line: str) -> typing.Dict[str, typing.Any]:
+        if line.startswith("{"):
+            return self._load_json_line(line)
+
+        command_dict = self._parse_template_line(line)
+        if command_dict is None:
+            command_dict = self._parse_line(line)
+
+        return command_dict
+
+    def _parse_template_line(self, line: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        # kegalign's command template: plain words and a 2> redirect, split
+        # directly into the same args argparse would produce
+        match = self.template_line_regex.match(line)
+        if not match:
+            return None
+
+        words = match.group("command").split(" ")
+        executable = words.pop(0)
+        positionals: typing.List[str] = []
+        values: typing.Dict[str, typing.Any] = {}
+
+        for word in words:
+            if not word.startswith("-"):
+                positionals.append(word)
+                continue
+
+            name, sep, value = word[2:].partition("=")
+            kind = self.option_kinds.get(name) if word.startswith("--") else None
+
+            if kind is None:
+                # unknown or abbreviated option
+                return None
+            elif kind == "flag_args":
+                if sep:
+                    return None
+                values[name] = True
+            elif kind in ["bool_str_args", "bool_int_args"]:
+                values[name] = value if sep else True
+            elif not sep:
+                return None
+            elif kind == "int_args":
+                try:
+                    values[name] = int(value)
+                except ValueError:
+                    return None
+            else:
+                values[name] = value
+
+        if len(positionals) != 2:
+            return None
+
+        args: typing.List[str] = []
+        for name in sorted(values, key=self.option_order.__getitem__):
+            value = values[name]
+            if value is True:
+                args.append(f"--{name}")
+            else:
+                args.append(f"--{name}={value}")
+
+        args.append(f"--target={positionals[0]}")
+        args.append(f"--query={positionals[1]}")
+
+        return {
+            "executable": executable,
+            "args": args,
+            "stdin": None,
+            "stdout": None,
+            "stderr": match.group("stderr"),
+        }
+
+    def _load_json_line(self, line: str) -> typing.Dict[str, typing.Any]:
+        # job object printed by kegalign --json_commands, no parsing needed
+        try:
+            job: typing.Dict[str, typing.Any] = json.loads(line)
+            self.executable = job.get("executable", "lastz")
+
+            args: typing.List[str] = []
+            for name, value in job.get("options", {}).items():
+                if isinstance(value, bool):
+                    if value is True:
+                        args.append(f"--{name}")
+                else:
+                    args.append(f"--{name}={value}")
+
+            args.append(f"--strand={job['strand']}")
+            args.append(f"--segments={job['segments']}")
+            args.append(f"--output={job['output']}")
+            args.append(f"--target={job['target']}")
+            args.append(f"--query={job['query']}")
+            stderr = job.get("stderr")
+        except (json.JSONDecodeError, KeyError, TypeError, AttributeError):
+            sys.exit(f"bad json command: {line}")
+
+        command_dict: typing.Dict[str, typing.Any] = {
+            "executable": self.executable,
+            "args": args,
+            "stdin": None,
+            "stdout": None,
+            "stderr": stderr,
+        }
+
+        return command_dict
+
+    def _parse_line(self, line: str) -> typing.Dict[str, typing.Any]:
+        # resolve shell redirects
+        trees: typing.List[typing.Any] = bashlex.parse(line, strictmode=False)
+        positions: typing.List[typing.Tuple[int, int]] = []
+
+        for tree in trees:
+            visitor = nodevisitor(positions)
+            visitor.visit(tree)
+
+        # do replacements from the end so the indicies will be correct
+        positions.reverse()
+
+        processed = list(line)
+        for start, end in positions:
+            processed[start:end] = ""
+
+        processed_line: str = "".join(processed)
+
+        command_dict = self._parse_processed_line(processed_line)
+        command_dict["stdin"] = visitor.stdin
+        command_dict["stdout"] = visitor.stdout
+        command_dict["stderr"] = visitor.stderr
+
+        return command_dict
 
-        namespace, rest = parser.parse_known_intermixed_args(argv)
+    def _parse_processed_line(self, line: str) -> typing.Dict[str, typing.Any]:
+        argv: typing.List[str] = list(bashlex.split(line))
+        self.executable = argv.pop(0)
+
+        namespace, rest = self.parser.parse_known_intermixed_args(argv)
         vars_dict = vars(namespace)
 
         command_dict: typing.Dict[str, typing.Any] = {
@@ -254,20 +815,75 @@ class bashCommandLineFile:
 
         return command_dict
 
-    def _write_format(self) -> None:
-        if self.args.format_selector == "bam":
-            format_name = "bam"
-        elif self.args.format_selector == "maf":
-            format_name = "maf"
-        elif self.args.format_selector == "differences":
-            format_name = "interval"
-        else:
-            format_name = "tabular"
 
-        with open("format.txt", "w") as ofh:
-            print(f"{format_name}", file=ofh)
+_worker_parser: typing.Optional[LastzCommandParser] = None
+
+
+def count_lines(pathname: str) -> int:
+    try:
+        with open(pathname, "rb") as f:
+            return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+    except FileNotFoundError:
+        sys.exit(f"missing source file {os.path.realpath(pathname)}")
+
+
+def commands_part_path(config_path: str, part: int) -> str:
+    # galaxy/commands.json -> galaxy/commands.part<part>.json
+    stem, ext = os.path.splitext(config_path)
+    return f"{stem}.part{part}{ext}"
+
+
+def shard_pathname(pathname: str, shard: int) -> str:
+    # data_package.tgz -> data_package.shard0.tgz
+    dirname, basename = os.path.split(pathname)
+    stem, dot, ext = basename.partition(".")
+    return os.path.join(dirname, f"{stem}.shard{shard}{dot}{ext}")
+
 
-        self.package_file.add_format("format.txt")
+def follow_lines(pathname: str, done_pathname: str, poll_interval: float = FOLLOW_POLL_INTERVAL) -> typing.Iterator[str]:
+    """
+    Yields the lines of a file that is still being appended to
+
+    The writer creates done_pathname once the file is complete, a partial
+    last line is held back until its newline (or the marker) shows up.
+    """
+
+    while not os.path.exists(pathname):
+        if os.path.exists(done_pathname):
+            sys.exit(f"missing command file {pathname}")
+        time.sleep(poll_interval)
+
+    with open(pathname) as f:
+        partial = ""
+        while True:
+            line = f.readline()
+            if line:
+                partial += line
+                if partial.endswith("\n"):
+                    yield partial
+                    partial = ""
+                continue
+
+            if os.path.exists(done_pathname):
+                # the marker is written after the last line, drain the rest
+                rest = partial + f.read()
+                yield from rest.splitlines(keepends=True)
+                return
+
+            time.sleep(poll_interval)
+
+
+def _init_parser_worker(config_dict: typing.Dict[str, typing.Dict[str, str]]) -> None:
+    global _worker_parser
+
+    config = configparser.ConfigParser()
+    config.read_dict(config_dict)
+    _worker_parser = LastzCommandParser(config)
+
+
+def _parse_chunk(lines: typing.List[str]) -> typing.List[typing.Dict[str, typing.Any]]:
+    assert _worker_parser is not None
+    return [_worker_parser.parse(line.rstrip("\n")) for line in lines]
 
 
 class nodevisitor(bashlex.ast.nodevisitor):  # type: ignore[misc]
@@ -307,9 +923,22 @@ def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--tool_directory", type=str, required=True, help="tool directory")
     parser.add_argument("--format_selector", type=str, required=True, help="format selector")
+    parser.add_argument("--input", type=str, default="lastz-commands.txt", help="lastz command file, - for stdin (default: %(default)s)")
+    parser.add_argument("--output", type=str, help="package file (default: data_package.tgz, or data_package with --directory)")
+    parser.add_argument("--follow", action="store_true", help="package the command file while it is written, until <input>.done exists")
+    parser.add_argument("--directory", action="store_true", help="write the package as a directory of hardlinks, reflinks or copies instead of a compressed tarball, for batched_lastz runs on the same filesystem")
+    parser.add_argument("--seekable", action="store_true", help="start every member on a compressed frame boundary and append an offset index, for random-access reads")
+    parser.add_argument("--compact_segments", action="store_true", help="store segment files in a compact binary encoding, decoded again before lastz runs")
+    parser.add_argument("--shards", type=int, default=1, help="split the commands into this many packages of about equal lastz work, named <output stem>.shardN.<ext> (default: %(default)s)")
+    parser.add_argument("--compression", type=str, default="gzip", choices=["gzip", "zstd"], help="package compression (default: %(default)s)")
+    parser.add_argument("--compression_level", type=int, default=None, help="compression level (default: 6 for gzip, 3 for zstd)")
+    parser.add_argument("--threads", type=int, default=-1, help="number of parsing processes and compression threads (default: %(default)s [use all CPUs])")
     parser.add_argument("--debug", action="store_true", help="enable debug messages")
     args = parser.parse_args()
 
+    if args.threads == -1:
+        args.threads = len(os.sched_getaffinity(0))
+
     if args.debug:
         r_beg = resource.getrusage(resource.RUSAGE_SELF)
         beg: int = time.monotonic_ns()
@@ -319,10 +948,36 @@ def main() -> None:
     config: configparser.ConfigParser = configparser.ConfigParser()
     config.read(lastz_command_config_file)
 
-    package_file = PackageFile()
-    lastz_command_file = "lastz-commands.txt"
-    bashCommandLineFile(lastz_command_file, config, args, package_file)
-    package_file.close()
+    if args.shards < 1:
+        sys.exit("--shards must be at least 1")
+
+    if args.shards > 1 and (args.follow or args.input == "-"):
+        # balancing the shards needs the work of every command up front
+        sys.exit("--shards only applies to a complete command file, not to --follow or --input -")
+
+    if args.directory and (args.seekable or args.compact_segments):
+        sys.exit("--seekable and --compact_segments only apply to tarball packages")
+
+    if args.output is None:
+        args.output = "data_package" if args.directory else "data_package.tgz"
+
+    package_class = PackageDirectory if args.directory else PackageFile
+    package_files = [
+        package_class(
+            pathname=args.output if args.shards == 1 else shard_pathname(args.output, shard),
+            compression=args.compression,
+            compression_level=args.compression_level,
+            threads=args.threads,
+            shard=shard,
+            num_shards=args.shards,
+            seekable=args.seekable,
+            compact_segments=args.compact_segments,
+        )
+        for shard in range(args.shards)
+    ]
+    bashCommandLineFile(args.input, config, args, package_files)
+    for package_file in package_files:
+        package_file.close()
 
     if args.debug:
         ns: int = time.monotonic_ns() - beg
@@ -2,6 +2,9 @@
 
 import argparse
 import concurrent.futures
+import gzip
+import heapq
+import itertools
 import json
 import multiprocessing
 import os
@@ -12,10 +15,40 @@ import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 import time
 import typing
-
-
+import urllib.parse
+
+import segment_codec
+from lastz_cache import LastzCache, link_or_copy, parse_size, print_stats
+from package_index import SeekablePackage
+from shared_work import DEFAULT_LEASE, SharedWorkDir
+
+try:
+    import zstandard
+except ImportError:
+    # only needed for zstd compressed packages
+    zstandard = None  # type: ignore[assignment,unused-ignore]
+
+ZSTD_MAGIC: typing.Final = b"\x28\xb5\x2f\xfd"
+GZIP_MAGIC: typing.Final = b"\x1f\x8b"
+# seconds between looks at the claims of other instances
+SHARED_POLL_INTERVAL: typing.Final = 1.0
+# lastz --allocate:traceback, the lastz default up to just under 2G
+MIN_TRACEBACK_BYTES: typing.Final = 80 << 20
+MAX_TRACEBACK_BYTES: typing.Final = int(1.99 * (1 << 30))
+TRACEBACK_BYTES_PER_SEGMENT_BYTE: typing.Final = 256
+TRACEBACK_GROWTH: typing.Final = 4
+# lastz holds one byte per base of the four packed in a 2bit byte
+SEQUENCE_BYTES_PER_2BIT_BYTE: typing.Final = 4
+RUNTIME_STATS_FILENAME: typing.Final = "runtime_stats.json"
+STATS_PERCENTILES: typing.Final = [50, 90, 95, 99]
+# commands taking this many times the median run time
+STRAGGLER_FACTOR: typing.Final = 4
+MAX_STRAGGLERS: typing.Final = 20
+# commands of a streamed package, see package_output.py commands_part_path()
+commands_part_regex = re.compile(r"^galaxy/commands\.part\d+\.json$")
 lastz_output_format_regex = re.compile(
     r"^(?:axt\+?|blastn|cigar|differences|general-?.+|lav|lav\+text|maf[-+]?|none|paf(?::wfmash)?|rdotplot|sam-?|softsam-?|text)$",
     re.IGNORECASE,
@@ -29,11 +62,25 @@ lastz_output_format_regex = re.compile(
 def run_command(
     instance: int,
     input_queue: "queue.Queue[typing.Dict[str, typing.Any]]",
-    output_queue: "queue.Queue[float]",
+    output_queue: "queue.Queue[typing.Dict[str, typing.Any]]",
+    cache_queue: "queue.Queue[typing.Dict[str, int]]",
+    cache_dir: str | None = None,
+    package_pathname: str | None = None,
+    done_queue: "queue.Queue[str | None] | None" = None,
+    memory_budget: "MemoryBudget | None" = None,
     debug: bool = False,
 ) -> str | None:
     os.chdir("galaxy/files")
 
+    cache = None
+    if cache_dir is not None:
+        cache = LastzCache(cache_dir, debug=debug)
+
+    # segment files of a seekable package are read when their command runs
+    package = None
+    if package_pathname is not None:
+        package = SeekablePackage.load(package_pathname)
+
     # These are not considered errors even though
     # we will end up with a segmented alignment
     truncation_regex = re.compile(
@@ -45,98 +92,430 @@ def run_command(
         command_dict = input_queue.get()
 
         if not command_dict:
+            if cache is not None:
+                cache_queue.put(cache.stats())
             return None
 
-        args = ["lastz", "--allocate:traceback=1.99G"]
+        # the traceback allocation only matters when it truncates
+        # alignments, and then the largest one is used in the end
+        args = ["lastz", f"--allocate:traceback={traceback_size(MAX_TRACEBACK_BYTES)}"]
         args.extend(command_dict["args"])
 
-        stdin = command_dict["stdin"]
-        if stdin is not None:
-            stdin = open(stdin, "r")
+        segment_bytes = 0
+        for arg in command_dict["args"]:
+            if arg.startswith("--segments="):
+                if package is not None and not os.path.exists(arg[11:]):
+                    package.extract(os.path.normpath(os.path.join("galaxy/files", arg[11:])), arg[11:])
+                # package_output.py --compact_segments, lastz reads text
+                segment_codec.decode_file(arg[11:])
+                segment_bytes += os.path.getsize(arg[11:])
+
+        output_file = None
+        for arg in args:
+            if arg.startswith("--output="):
+                output_file = arg[9:]
+
+        run_stats = {
+            "output": output_file,
+            "cost": command_dict.get("cost", 0.0),
+            "segment_bytes": segment_bytes,
+            "cached": False,
+            "elapsed": 0.0,
+            "max_rss_bytes": 0,
+            "output_bytes": 0,
+            "traceback_bytes": 0,
+            "attempts": 0,
+        }
 
-        stdout = command_dict["stdout"]
-        if stdout is not None:
-            stdout = open(stdout, "w")
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.key(args)
+            if cache_key is None or output_file is None:
+                cache.uncacheable += 1
+            elif cache.get(cache_key, output_file):
+                # a cached run leaves the same (empty) stdout and stderr files
+                for redirect in [command_dict["stdout"], command_dict["stderr"]]:
+                    if redirect is not None:
+                        open(redirect, "w").close()
+                run_stats["cached"] = True
+                run_stats["output_bytes"] = os.path.getsize(output_file)
+                output_queue.put(run_stats)
+                if done_queue is not None and output_file is not None:
+                    done_queue.put(output_file)
+                continue
+
+        # only a truncation message tells that the traceback memory was too
+        # small, without a stderr file every command gets the maximum
+        traceback_bytes = MAX_TRACEBACK_BYTES
+        if command_dict["stderr"] is not None:
+            traceback_bytes = traceback_allocation(segment_bytes)
+
+        while True:
+            args = ["lastz", f"--allocate:traceback={traceback_size(traceback_bytes)}"]
+            args.extend(command_dict["args"])
+
+            stdin = command_dict["stdin"]
+            if stdin is not None:
+                stdin = open(stdin, "r")
+
+            stdout = command_dict["stdout"]
+            if stdout is not None:
+                stdout = open(stdout, "w")
+
+            stderr = command_dict["stderr"]
+            if stderr is not None:
+                stderr = open(stderr, "w")
+
+            memory_bytes = traceback_bytes + sequence_memory(command_dict["args"])
+            if memory_budget is not None:
+                memory_budget.acquire(memory_bytes)
+
+            begin = time.perf_counter()
+            p = subprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=stderr)
+            # wait4() also returns the resource usage of lastz alone
+            _, status, rusage = os.wait4(p.pid, 0)
+            p.returncode = os.waitstatus_to_exitcode(status)
+            run_stats["elapsed"] += time.perf_counter() - begin
+
+            if memory_budget is not None:
+                memory_budget.release(memory_bytes)
+
+            for var in [stdin, stdout, stderr]:
+                if var is not None:
+                    var.close()
+
+            # if there is a stderr_file, make sure it is
+            # empty or only contains truncation messages
+            stderr_ok = True
+            truncated = False
+            stderr_file = command_dict["stderr"]
+
+            if stderr_file is not None:
+                try:
+                    statinfo = os.stat(stderr_file, follow_symlinks=False)
+                    if statinfo.st_size != 0:
+                        with open(stderr_file) as f:
+                            for stderr_line in f:
+                                stderr_line = stderr_line.strip()
+                                if stderr_line == truncation_msg:
+                                    truncated = True
+                                elif not truncation_regex.match(stderr_line):
+                                    stderr_ok = False
+                except Exception:
+                    stderr_ok = False
+
+            # kilobytes on Linux
+            run_stats["max_rss_bytes"] = max(run_stats["max_rss_bytes"], rusage.ru_maxrss * 1024)
+            run_stats["traceback_bytes"] = traceback_bytes
+            run_stats["attempts"] += 1
+
+            if p.returncode in [0, 1] and stderr_ok and truncated and traceback_bytes < MAX_TRACEBACK_BYTES:
+                traceback_bytes = min(traceback_bytes * TRACEBACK_GROWTH, MAX_TRACEBACK_BYTES)
+                if debug:
+                    print(f"lastz: truncated alignments, rerunning {output_file} with --allocate:traceback={traceback_size(traceback_bytes)}", file=sys.stderr, flush=True)
+                continue
+
+            break
 
-        stderr = command_dict["stderr"]
-        if stderr is not None:
-            stderr = open(stderr, "w")
+        if p.returncode in [0, 1] and stderr_ok:
+            if output_file is not None and os.path.exists(output_file):
+                run_stats["output_bytes"] = os.path.getsize(output_file)
+            output_queue.put(run_stats)
 
-        begin = time.perf_counter()
-        p = subprocess.run(args, stdin=stdin, stdout=stdout, stderr=stderr)
+            if cache is not None and cache_key is not None and output_file is not None:
+                cache.put(cache_key, output_file)
 
-        for var in [stdin, stdout, stderr]:
-            if var is not None:
-                var.close()
+            # merged into the final output and deleted from here on
+            if done_queue is not None and output_file is not None:
+                done_queue.put(output_file)
+        else:
+            return f"command failed (rc={p.returncode}): {' '.join(args)}"
 
-        # if there is a stderr_file, make sure it is
-        # empty or only contains truncation messages
-        stderr_ok = True
-        stderr_file = command_dict["stderr"]
 
-        if stderr_file is not None:
-            try:
-                statinfo = os.stat(stderr_file, follow_symlinks=False)
-                if statinfo.st_size != 0:
-                    with open(stderr_file) as f:
-                        for stderr_line in f:
-                            stderr_line = stderr_line.strip()
-                            if (not truncation_regex.match(stderr_line) and stderr_line != truncation_msg):
-                                stderr_ok = False
-            except Exception:
-                stderr_ok = False
+class MemoryBudget:
+    """
+    Memory shared by the lastz processes of all workers
 
-        if p.returncode in [0, 1] and stderr_ok:
-            elapsed = time.perf_counter() - begin
-            output_queue.put(elapsed)
-        else:
-            return f"command failed (rc={p.returncode}): {' '.join(args)}"
+    A worker waits until its lastz process fits in what is left, a process
+    larger than the whole budget runs when no other one is.
+    """
+
+    def __init__(self, manager: typing.Any, limit: int) -> None:
+        self.limit = limit
+        self.condition = manager.Condition()
+        self.in_use = manager.Value("q", 0)
+        self.running = manager.Value("i", 0)
+
+    def acquire(self, size: int) -> None:
+        with self.condition:
+            while self.running.value > 0 and self.in_use.value + size > self.limit:
+                self.condition.wait()
+            self.in_use.value += size
+            self.running.value += 1
+
+    def release(self, size: int) -> None:
+        with self.condition:
+            self.in_use.value -= size
+            self.running.value -= 1
+            self.condition.notify_all()
 
 
 class BatchTar:
-    def __init__(self, pathname: str, debug: bool = False) -> None:
+    def __init__(self, pathname: str, debug: bool = False, extracted: bool = False) -> None:
         self.pathname = pathname
         self.debug = debug
         self.tarfile = None
+        self.package: SeekablePackage | None = None
         self.commands: typing.List[typing.Dict[str, typing.Any]] = []
         self.format_name = "tabular"
-        self._extract()
-        self._load_commands()
-        self._load_format()
+        self.shard = 0
+        self.num_shards = 1
+        self.tarball: tarfile.TarFile | None = None
+        self.compressed_file: typing.BinaryIO | gzip.GzipFile | None = None
+
+        if not extracted:
+            self._extract()
+        elif not os.path.isdir(self.pathname):
+            # extracted by another instance sharing the directory, the
+            # segment files of a seekable package are still read from it
+            self.package = SeekablePackage.load(self.pathname)
+
+        # a tarball is read member by member in ready_commands()
+        if self.tarball is None:
+            self._load_metadata()
+            self._load_commands()
+            self._load_format()
+            if not extracted:
+                self._extract_shared()
 
     def batch_commands(self) -> typing.Iterator[typing.Dict[str, typing.Any]]:
         for command in self.commands:
             yield command
 
+    def command_cost(self, command_dict: typing.Dict[str, typing.Any]) -> float:
+        """
+        Estimated lastz work of a command, the cost written by
+        package_output.py or else the size of its segment file
+        """
+
+        if "cost" in command_dict:
+            return float(command_dict["cost"])
+
+        cost = 0
+        for arg in command_dict["args"]:
+            if arg.startswith("--segments="):
+                name = os.path.normpath(os.path.join("galaxy/files", arg[11:]))
+                if self.package is not None and name in self.package.members:
+                    cost += self.package.members[name][1]
+                elif os.path.exists(name):
+                    cost += os.path.getsize(name)
+
+        return float(cost)
+
+    def ready_commands(self) -> typing.Iterator[typing.List[typing.Dict[str, typing.Any]]]:
+        """
+        Yields the commands in batches, each as soon as the files they
+        reference are on disk, extracting a tarball in the meantime
+        """
+
+        if self.tarball is None:
+            yield self.commands
+            return
+
+        begin = time.perf_counter()
+        extracted: typing.Set[str] = set()
+        waiting: typing.Dict[str, typing.List[int]] = {}
+        missing: typing.List[typing.Set[str]] = []
+        loaded_commands = False
+        loaded_parts = False
+        loaded_format = False
+
+        try:
+            for member in self.tarball:
+                self.tarball.extract(member, filter="data")
+                name = os.path.normpath(member.name)
+                extracted.add(name)
+
+                if name == "galaxy/package.json":
+                    self._load_metadata()
+                elif name == "galaxy/format.txt":
+                    self._load_format()
+                    loaded_format = True
+                elif name == "galaxy/commands.json" or commands_part_regex.match(name):
+                    # a streamed package has its commands in parts ahead of
+                    # commands.json, which then repeats them
+                    loaded_commands = True
+                    if name == "galaxy/commands.json" and loaded_parts:
+                        continue
+                    loaded_parts = name != "galaxy/commands.json"
+
+                    first = len(self.commands)
+                    self._load_commands(name)
+                    for i in range(first, len(self.commands)):
+                        missing.append(self._command_files(self.commands[i]) - extracted)
+                        for file_name in missing[i]:
+                            waiting.setdefault(file_name, []).append(i)
+                    yield [self.commands[i] for i in range(first, len(self.commands)) if not missing[i]]
+                else:
+                    ready = []
+                    for i in waiting.pop(name, []):
+                        missing[i].discard(name)
+                        if not missing[i]:
+                            ready.append(self.commands[i])
+                    yield ready
+        except (tarfile.ReadError, OSError, EOFError):
+            # gzip.GzipFile raises its own errors for a truncated package
+            sys.exit(f"ERROR: error reading input tarball: {self.pathname}")
+
+        self.tarball.close()
+        self.tarball = None
+        if self.compressed_file is not None:
+            self.compressed_file.close()
+        elapsed = time.perf_counter() - begin
+
+        if self.debug:
+            print(
+                f"Extracted tarball in {elapsed} seconds", file=sys.stderr, flush=True
+            )
+
+        # missing members are reported by these
+        if not loaded_commands:
+            self._load_commands()
+        if not loaded_format:
+            self._load_format()
+
+        # lastz reports the files that are not in the package
+        yield [self.commands[i] for i, files in enumerate(missing) if files]
+
+    def _command_files(self, command_dict: typing.Dict[str, typing.Any]) -> typing.Set[str]:
+        pathnames = []
+        for arg in command_dict["args"]:
+            if arg.startswith("--target=") or arg.startswith("--query="):
+                elems = arg.split("=", 1)[1].split("[")
+                pathnames.append(elems.pop(0))
+                for elem in elems:
+                    if elem.startswith("subset="):
+                        pathnames.append(elem[7:].rstrip("]"))
+            elif arg.startswith("--segments=") or arg.startswith("--scores="):
+                pathnames.append(arg.split("=", 1)[1])
+
+        return {os.path.normpath(os.path.join("galaxy/files", pathname)) for pathname in pathnames}
+
     def final_output_format(self) -> str:
         return self.format_name
 
     def _extract(self) -> None:
+        if os.path.isdir(self.pathname):
+            self._link_directory()
+            return
+
         try:
-            self.tarball = tarfile.open(
-                name=self.pathname, mode="r:*", format=tarfile.GNU_FORMAT
-            )
+            with open(self.pathname, "rb") as f:
+                magic = f.read(4)
         except FileNotFoundError:
             sys.exit(f"ERROR: unable to find input tarball: {self.pathname}")
-        except tarfile.ReadError:
+
+        self.package = SeekablePackage.load(self.pathname)
+        if self.package is not None:
+            # only the package metadata for now, see _extract_shared()
+            for name in self.package.names():
+                if not name.startswith("galaxy/files/"):
+                    self.package.extract(name, name)
+            os.makedirs("galaxy/files", exist_ok=True)
+            return
+
+        # package_output.py writes blocks of independent gzip members or
+        # zstd frames. tarfile's own gzip stream stops after the first
+        # member, gzip.GzipFile and read_across_frames read all of them
+        try:
+            if magic[:2] == GZIP_MAGIC:
+                self.compressed_file = gzip.GzipFile(self.pathname, "rb")
+                self.tarball = tarfile.open(
+                    fileobj=self.compressed_file, mode="r|", format=tarfile.GNU_FORMAT
+                )
+            elif magic == ZSTD_MAGIC:
+                if zstandard is None:
+                    sys.exit(f"ERROR: zstd compressed tarball needs the zstandard module: {self.pathname}")
+
+                self.compressed_file = open(self.pathname, "rb")
+                zstd_reader = zstandard.ZstdDecompressor().stream_reader(
+                    self.compressed_file, read_across_frames=True
+                )
+                self.tarball = tarfile.open(
+                    fileobj=zstd_reader, mode="r|", format=tarfile.GNU_FORMAT
+                )
+            else:
+                self.tarball = tarfile.open(
+                    name=self.pathname, mode="r|*", format=tarfile.GNU_FORMAT
+                )
+        except (tarfile.ReadError, OSError, EOFError):
             sys.exit(f"ERROR: error reading input tarball: {self.pathname}")
 
+        # the workers run in galaxy/files while the tarball is extracted, an
+        # empty shard does not even have it
+        os.makedirs("galaxy/files", exist_ok=True)
+
+    def _link_directory(self) -> None:
+        # a directory package (package_output.py --directory) on the same
+        # filesystem is linked into place instead of being extracted
+        top_dir = os.path.join(self.pathname, "galaxy")
+        if not os.path.isdir(top_dir):
+            sys.exit(f"ERROR: input directory is not a package: {self.pathname}")
+
         begin = time.perf_counter()
-        self.tarball.extractall(filter="data")
-        self.tarball.close()
+        if not os.path.samefile(self.pathname, "."):
+            for dirpath, _, filenames in os.walk(top_dir):
+                rel_dir = os.path.relpath(dirpath, self.pathname)
+                os.makedirs(rel_dir, exist_ok=True)
+                for filename in filenames:
+                    link_or_copy(os.path.join(dirpath, filename), os.path.join(rel_dir, filename))
+
+        os.makedirs("galaxy/files", exist_ok=True)
         elapsed = time.perf_counter() - begin
 
         if self.debug:
-            print(
-                f"Extracted tarball in {elapsed} seconds", file=sys.stderr, flush=True
-            )
+            print(f"Linked package directory in {elapsed} seconds", file=sys.stderr, flush=True)
+
+    def _extract_shared(self) -> None:
+        # extract the 2bit, subset and scores files of a seekable package,
+        # the workers read each segment file when its command runs
+        if self.package is None:
+            return
+
+        segment_names = set()
+        for command_dict in self.commands:
+            for arg in command_dict["args"]:
+                if arg.startswith("--segments="):
+                    segment_names.add(os.path.normpath(os.path.join("galaxy/files", arg[11:])))
+
+        begin = time.perf_counter()
+        for name in self.package.names():
+            if name.startswith("galaxy/files/") and name not in segment_names:
+                self.package.extract(name, name)
+        elapsed = time.perf_counter() - begin
+
+        if self.debug:
+            print(f"Extracted shared files in {elapsed} seconds", file=sys.stderr, flush=True)
 
-    def _load_commands(self) -> None:
+    def _load_metadata(self) -> None:
+        # written by newer versions of package_output.py only
         try:
-            f = open("galaxy/commands.json")
+            with open("galaxy/package.json") as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError:
+            sys.exit(f"ERROR: bad json in galaxy/package.json: {self.pathname}")
+
+        self.shard = metadata.get("shard", 0)
+        self.num_shards = metadata.get("num_shards", 1)
+
+    def _load_commands(self, commands_pathname: str = "galaxy/commands.json") -> None:
+        try:
+            f = open(commands_pathname)
         except FileNotFoundError:
             sys.exit(
-                f"ERROR: input tarball missing galaxy/commands.json: {self.pathname}"
+                f"ERROR: input tarball missing {commands_pathname}: {self.pathname}"
             )
 
         begin = time.perf_counter()
@@ -146,7 +525,7 @@ class BatchTar:
                 command_dict = json.loads(json_line)
             except json.JSONDecodeError:
                 sys.exit(
-                    f"ERROR: bad json line in galaxy/commands.json: {self.pathname}"
+                    f"ERROR: bad json line in {commands_pathname}: {self.pathname}"
                 )
 
             self._load_command(command_dict)
@@ -220,96 +599,276 @@ class BatchTar:
             self.format_name = "interval"
 
 
+class OutputMerger:
+    """
+    Appends the lastz outputs to the final output in command order, each as
+    soon as it and every output before it is complete, deleting it after
+
+    SAM headers have to be merged before the first record is written, so
+    SAM bodies wait until every header is known and are then streamed into
+    the output, or through samtools for BAM.
+    """
+
+    SAM_HEADER_ORDER: typing.Final = [b"@HD", b"@SQ", b"@RG", b"@PG", b"@CO"]
+
+    def __init__(self, batch_tar: BatchTar, output_file_format: typing.Dict[str, str], output_pathname: str, threads: int = 1) -> None:
+        self.batch_tar = batch_tar
+        self.output_file_format = output_file_format
+        self.output_pathname = output_pathname
+        self.threads = threads
+        self.done: typing.Set[str] = set()
+        self.merged: typing.Set[str] = set()
+        self.next_command = 0
+        self.output_file: typing.BinaryIO | None = None
+        self.sam_header_lines: typing.Dict[bytes, typing.List[bytes]] = {}
+        self.sam_bodies: typing.List[typing.Tuple[str, int]] = []
+
+    def complete(self, output_file: str) -> None:
+        self.done.add(output_file)
+
+        commands = self.batch_tar.commands
+        while self.next_command < len(commands):
+            next_output_file = command_output_file(commands[self.next_command])
+            if next_output_file is None or next_output_file not in self.done:
+                break
+
+            if next_output_file not in self.merged:
+                self._merge(next_output_file)
+                self.merged.add(next_output_file)
+            self.next_command += 1
+
+    def _is_sam(self, output_file: str) -> bool:
+        return re.match(r"^(?:soft)?sam", self.output_file_format.get(output_file, ""), re.IGNORECASE) is not None
+
+    def _open(self) -> typing.BinaryIO:
+        if self.output_file is None:
+            self.output_file = open(self.output_pathname, "wb")
+
+            # the outputs of the shards of a package are concatenated in
+            # shard order, the header is only written once
+            if self.batch_tar.final_output_format() == "maf" and self.batch_tar.shard == 0:
+                self.output_file.write(b"##maf version=1\n")
+
+        return self.output_file
+
+    def _merge(self, output_file: str) -> None:
+        pathname = os.path.join("galaxy/files", output_file)
+
+        if not self._is_sam(output_file):
+            copy_range(pathname, self._open())
+            os.remove(pathname)
+            return
+
+        with open(pathname, "rb") as f:
+            while True:
+                body_offset = f.tell()
+                line = f.readline()
+                if not line.startswith(b"@"):
+                    break
+                record_lines = self.sam_header_lines.setdefault(line[:3], [])
+                if line not in record_lines:
+                    record_lines.append(line)
+
+        self.sam_bodies.append((pathname, body_offset))
+
+    def finish(self) -> None:
+        if not self.sam_bodies and not self.sam_header_lines:
+            self._open().close()
+            return
+
+        header = b"".join(
+            line
+            for record_type in sorted(self.sam_header_lines, key=lambda t: self.SAM_HEADER_ORDER.index(t) if t in self.SAM_HEADER_ORDER else len(self.SAM_HEADER_ORDER))
+            for line in self.sam_header_lines[record_type]
+            # a single @HD line
+            if record_type != b"@HD" or line == self.sam_header_lines[record_type][0]
+        )
+
+        process = None
+        if self.batch_tar.final_output_format() == "bam":
+            if shutil.which("samtools") is None:
+                sys.exit("ERROR: samtools is needed for bam output")
+            process = subprocess.Popen(
+                ["samtools", "view", "--bam", "--threads", str(self.threads), "--output", self.output_pathname, "-"],
+                stdin=subprocess.PIPE,
+            )
+            output_file = typing.cast(typing.BinaryIO, process.stdin)
+        else:
+            output_file = self._open()
+
+        output_file.write(header)
+        for pathname, body_offset in self.sam_bodies:
+            copy_range(pathname, output_file, body_offset)
+            os.remove(pathname)
+        output_file.close()
+
+        if process is not None and process.wait() != 0:
+            sys.exit(f"ERROR: samtools exited with returncode {process.returncode}")
+
+
 class TarRunner:
     def __init__(
         self,
         input_pathname: str,
         output_pathname: str,
         parallel: int,
+        cache_dir: str | None = None,
+        cache_size: int | None = None,
+        memory_budget: int | None = None,
+        shared_dir: str | None = None,
+        lease: float = DEFAULT_LEASE,
         debug: bool = False,
     ) -> None:
         self.input_pathname = input_pathname
         self.output_pathname = output_pathname
         self.parallel = parallel
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.memory_budget = memory_budget
         self.debug = debug
-        self.batch_tar = BatchTar(self.input_pathname, debug=self.debug)
+        # galaxy.json and the runtime statistics stay where we started
+        self.metadata_dir = os.getcwd()
+        self.shared: SharedWorkDir | None = None
+
+        if shared_dir is None:
+            self.batch_tar = BatchTar(self.input_pathname, debug=self.debug)
+        else:
+            self.input_pathname = os.path.abspath(self.input_pathname)
+            self.output_pathname = os.path.abspath(self.output_pathname)
+            os.makedirs(shared_dir, exist_ok=True)
+            os.chdir(shared_dir)
+
+            self.shared = SharedWorkDir(".", lease, debug=self.debug)
+            self.shared.start()
+            self.batch_tar = self._shared_batch_tar(self.shared)
+
         self.output_file_format: typing.Dict[str, str] = {}
         self.output_files: typing.Dict[str, typing.List[str]] = {}
-        self._set_output()
-        self._set_target_query()
+        self.merger = OutputMerger(self.batch_tar, self.output_file_format, self.output_pathname, self.parallel)
 
-    def _set_output(self) -> None:
-        for command_dict in self.batch_tar.batch_commands():
-            output_file = None
-            output_format = None
+    def _shared_batch_tar(self, shared: SharedWorkDir) -> BatchTar:
+        # the first instance extracts the package, the others wait for it
+        while not shared.is_done("extract"):
+            if shared.claim("extract"):
+                batch_tar = BatchTar(self.input_pathname, debug=self.debug)
+                for _ in batch_tar.ready_commands():
+                    pass
+                shared.mark_done("extract")
+                return batch_tar
 
-            for arg in command_dict["args"]:
-                if arg.startswith("--format="):
-                    output_format = arg[9:]
-                elif arg.startswith("--output="):
-                    output_file = arg[9:]
+            time.sleep(SHARED_POLL_INTERVAL)
 
-            if output_file is None:
-                f = tempfile.NamedTemporaryFile(dir="galaxy/files", delete=False)
-                output_file = os.path.basename(f.name)
-                f.close()
-                command_dict["args"].append(f"--output={output_file}")
+        return BatchTar(self.input_pathname, debug=self.debug, extracted=True)
 
-            if output_format is None:
-                output_format = "lav"
-                command_dict["args"].append(f"--format={output_format}")
+    def _prepare_command(self, command_dict: typing.Dict[str, typing.Any]) -> None:
+        self._set_output(command_dict)
+        self._set_target_query(command_dict)
 
-            if not lastz_output_format_regex.match(output_format):
-                sys.exit(f"ERROR: invalid output format: {output_format}")
+    def _set_output(self, command_dict: typing.Dict[str, typing.Any]) -> None:
+        output_file = None
+        output_format = None
 
-            self.output_file_format[output_file] = output_format
+        for arg in command_dict["args"]:
+            if arg.startswith("--format="):
+                output_format = arg[9:]
+            elif arg.startswith("--output="):
+                output_file = arg[9:]
 
-        for output_file, output_format in self.output_file_format.items():
-            self.output_files.setdefault(output_format, [])
-            self.output_files[output_format].append(output_file)
+        if output_file is None:
+            f = tempfile.NamedTemporaryFile(dir="galaxy/files", delete=False)
+            output_file = os.path.basename(f.name)
+            f.close()
+            command_dict["args"].append(f"--output={output_file}")
 
-    def _set_target_query(self) -> None:
-        for command_dict in self.batch_tar.batch_commands():
-            new_args: typing.List[str] = []
+        if output_format is None:
+            output_format = "lav"
+            command_dict["args"].append(f"--format={output_format}")
+
+        if not lastz_output_format_regex.match(output_format):
+            sys.exit(f"ERROR: invalid output format: {output_format}")
 
+        self.output_file_format[output_file] = output_format
+
+    def _set_output_files(self) -> None:
+        # in command order, not in the order the commands were started
+        for command_dict in self.batch_tar.batch_commands():
             for arg in command_dict["args"]:
-                if arg.startswith("--target="):
-                    new_args.insert(0, arg[9:])
-                elif arg.startswith("--query="):
-                    new_args.insert(1, arg[8:])
-                else:
-                    new_args.append(arg)
+                if arg.startswith("--output="):
+                    output_file = arg[9:]
+                    output_format = self.output_file_format[output_file]
+                    output_files = self.output_files.setdefault(output_format, [])
+                    if output_file not in output_files:
+                        output_files.append(output_file)
+
+    def _set_target_query(self, command_dict: typing.Dict[str, typing.Any]) -> None:
+        new_args: typing.List[str] = []
 
-            command_dict["args"] = new_args
+        for arg in command_dict["args"]:
+            if arg.startswith("--target="):
+                new_args.insert(0, arg[9:])
+            elif arg.startswith("--query="):
+                new_args.insert(1, arg[8:])
+            else:
+                new_args.append(arg)
+
+        command_dict["args"] = new_args
 
     def run(self) -> None:
-        run_times = []
+        run_times: typing.List[typing.Dict[str, typing.Any]] = []
         begin = time.perf_counter()
 
         with multiprocessing.Manager() as manager:
             input_queue: queue.Queue[typing.Dict[str, typing.Any]] = manager.Queue()
-            output_queue: queue.Queue[float] = manager.Queue()
+            output_queue: queue.Queue[typing.Dict[str, typing.Any]] = manager.Queue()
+            cache_queue: queue.Queue[typing.Dict[str, int]] = manager.Queue()
+            done_queue: queue.Queue[str | None] = manager.Queue()
 
-            for command_dict in self.batch_tar.batch_commands():
-                input_queue.put(command_dict)
-
-            # use the empty dict as a sentinel
-            for _ in range(self.parallel):
-                input_queue.put({})
-
-            with concurrent.futures.ProcessPoolExecutor(
-                max_workers=self.parallel
-            ) as executor:
-                futures = [
-                    executor.submit(
-                        run_command,
-                        instance,
-                        input_queue,
-                        output_queue,
-                        debug=self.debug,
-                    )
-                    for instance in range(self.parallel)
-                ]
+            # --parallel is then only the most lastz processes at a time
+            memory_budget = None
+            if self.memory_budget is not None:
+                memory_budget = MemoryBudget(manager, self.memory_budget)
+
+            merger_thread = threading.Thread(target=self._merge_outputs, args=(done_queue,))
+            merger_thread.start()
+
+            try:
+                with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.parallel
+                ) as executor:
+                    futures = [
+                        executor.submit(
+                            run_command,
+                            instance,
+                            input_queue,
+                            output_queue,
+                            cache_queue,
+                            cache_dir=self.cache_dir,
+                            package_pathname=None if self.batch_tar.package is None else os.path.abspath(self.input_pathname),
+                            done_queue=done_queue,
+                            memory_budget=memory_budget,
+                            debug=self.debug,
+                        )
+                        for instance in range(self.parallel)
+                    ]
+
+                    try:
+                        self._dispatch(input_queue, futures)
+                    except BaseException:
+                        # e.g. an unreadable tarball, drop the commands not
+                        # started yet so the workers exit right away
+                        try:
+                            while True:
+                                input_queue.get_nowait()
+                        except queue.Empty:
+                            pass
+                        raise
+                    finally:
+                        # use the empty dict as a sentinel
+                        for _ in range(self.parallel):
+                            input_queue.put({})
+            finally:
+                done_queue.put(None)
+                merger_thread.join()
 
             found_falures = False
 
@@ -325,6 +884,14 @@ class TarRunner:
                 run_time = output_queue.get()
                 run_times.append(run_time)
 
+            if self.cache_dir is not None:
+                cache_stats = []
+                while not cache_queue.empty():
+                    cache_stats.append(cache_queue.get())
+
+                cache = LastzCache(self.cache_dir, self.cache_size)
+                print_stats(cache_stats, cache.evict())
+
             if found_falures:
                 sys.exit("lastz command failed")
 
@@ -332,28 +899,143 @@ class TarRunner:
 
         if self.debug:
             print(f"elapsed {elapsed}", file=sys.stderr, flush=True)
+            self._report_makespan(run_times, elapsed)
 
         self._cleanup()
+        self._write_runtime_stats(run_times, elapsed)
+
+    def _dispatch(
+        self,
+        input_queue: "queue.Queue[typing.Dict[str, typing.Any]]",
+        futures: typing.List["concurrent.futures.Future[str | None]"],
+    ) -> None:
+        # the workers start on the first commands while the rest of the
+        # tarball is still being extracted. The most expensive ready
+        # commands go first, and only a few are queued ahead so expensive
+        # ones that become ready later still get ahead of the cheap ones
+        ready: typing.List[typing.Tuple[float, int, typing.Dict[str, typing.Any]]] = []
+        counter = itertools.count()
+        for batch in self.batch_tar.ready_commands():
+            for command_dict in batch:
+                self._prepare_command(command_dict)
+                command_dict["cost"] = self.batch_tar.command_cost(command_dict)
+                heapq.heappush(ready, (-command_dict["cost"], next(counter), command_dict))
+
+            while ready and self.shared is None and input_queue.qsize() < self.parallel:
+                input_queue.put(heapq.heappop(ready)[2])
+
+        if self.shared is not None:
+            self._dispatch_shared(self.shared, ready, input_queue, futures)
+
+        while ready:
+            input_queue.put(heapq.heappop(ready)[2])
+
+    def _dispatch_shared(
+        self,
+        shared: SharedWorkDir,
+        ready: typing.List[typing.Tuple[float, int, typing.Dict[str, typing.Any]]],
+        input_queue: "queue.Queue[typing.Dict[str, typing.Any]]",
+        futures: typing.List["concurrent.futures.Future[str | None]"],
+    ) -> None:
+        """
+        Queues the commands this instance claims, one when a worker is about
+        to become free so the other instances get their share, until every
+        command is done or claimed here
+        """
+
+        claimed_elsewhere: typing.List[typing.Dict[str, typing.Any]] = []
+
+        while ready or claimed_elsewhere:
+            # workers only return early when a command failed
+            if any(future.done() for future in futures):
+                ready.clear()
+                return
+
+            if input_queue.qsize() >= self.parallel:
+                time.sleep(SHARED_POLL_INTERVAL / 10)
+                continue
+
+            if ready:
+                command_dict = heapq.heappop(ready)[2]
+                if shared.claim(command_claim_name(command_dict)):
+                    input_queue.put(command_dict)
+                elif not shared.is_done(command_claim_name(command_dict)):
+                    claimed_elsewhere.append(command_dict)
+                continue
+
+            # the rest is running elsewhere, unless its instance died
+            claimed_elsewhere = [command_dict for command_dict in claimed_elsewhere if not shared.is_done(command_claim_name(command_dict))]
+            for command_dict in claimed_elsewhere:
+                if shared.claim(command_claim_name(command_dict)):
+                    claimed_elsewhere.remove(command_dict)
+                    input_queue.put(command_dict)
+                    break
+            else:
+                time.sleep(SHARED_POLL_INTERVAL)
+
+    def _merge_outputs(self, done_queue: "queue.Queue[str | None]") -> None:
+        while True:
+            output_file = done_queue.get()
+            if output_file is None:
+                break
+
+            # the instance claiming the merge merges all outputs at the end
+            if self.shared is not None:
+                self.shared.mark_done(output_claim_name(output_file))
+            else:
+                self.merger.complete(output_file)
+
+    def _report_makespan(self, run_times: typing.List[typing.Dict[str, typing.Any]], elapsed: float) -> None:
+        # calibrated on this run, cached commands are not timed
+        run_times = [run_stats for run_stats in run_times if not run_stats["cached"]]
+        total_cost = sum(run_stats["cost"] for run_stats in run_times)
+        if total_cost == 0:
+            return
+
+        seconds_per_cost = sum(run_stats["elapsed"] for run_stats in run_times) / total_cost
+
+        costs = [command_dict["cost"] for command_dict in self.batch_tar.batch_commands()]
+        longest_first = predicted_makespan(sorted(costs, reverse=True), self.parallel) * seconds_per_cost
+        in_order = predicted_makespan(costs, self.parallel) * seconds_per_cost
+        print(f"makespan: predicted {longest_first:.2f} seconds longest-first ({in_order:.2f} in command order), actual {elapsed:.2f} seconds", file=sys.stderr, flush=True)
+
+    def _write_runtime_stats(self, run_times: typing.List[typing.Dict[str, typing.Any]], elapsed: float) -> None:
+        stats = runtime_stats(run_times, elapsed, self.parallel)
+
+        with open(os.path.join(self.metadata_dir, RUNTIME_STATS_FILENAME), "w") as ofh:
+            json.dump(stats, ofh, indent=2)
+
+        if self.debug:
+            print(f"parallel efficiency {stats['parallel_efficiency']:.2f}, {len(stats['stragglers'])} stragglers, stats in {RUNTIME_STATS_FILENAME}", file=sys.stderr, flush=True)
 
     def _cleanup(self) -> None:
+        self._set_output_files()
         num_output_files = len(self.output_files.keys())
-        if num_output_files != 1:
+        # a shard of a small job may have no commands at all
+        if num_output_files > 1 or (num_output_files == 0 and self.batch_tar.num_shards == 1):
             sys.exit(f"ERROR: expecting a single output file, found {num_output_files}")
 
         final_output_format = self.batch_tar.final_output_format()
 
-        for file_type, file_list in self.output_files.items():
-            with open(f"output.{final_output_format}", "w") as ofh:
-                if final_output_format == "maf":
-                    print("##maf version=1", file=ofh)
+        if self.shared is not None:
+            # every command is done, exactly one instance merges
+            if not self.shared.claim("merge"):
+                if self.debug:
+                    print("output merged by another instance", file=sys.stderr, flush=True)
+                self.shared.stop()
+                return
+
+            for command_dict in self.batch_tar.batch_commands():
+                output_file = command_output_file(command_dict)
+                if output_file is not None:
+                    self.merger.complete(output_file)
 
-                for filename in file_list:
-                    with open(f"galaxy/files/{filename}") as ifh:
-                        for line in ifh:
-                            ofh.write(line)
+        # text outputs are already merged while lastz runs
+        self.merger.finish()
 
-        src_filename = f"output.{final_output_format}"
-        shutil.copy2(src_filename, self.output_pathname)
+        if self.shared is not None:
+            self.shared.mark_done("merge")
+            self.shared.stop()
 
         output_metadata = {
             "output": {
@@ -361,10 +1043,134 @@ class TarRunner:
             }
         }
 
-        with open("galaxy.json", "w") as ofh:
+        with open(os.path.join(self.metadata_dir, "galaxy.json"), "w") as ofh:
             json.dump(output_metadata, ofh)
 
 
+def runtime_stats(run_times: typing.List[typing.Dict[str, typing.Any]], elapsed: float, parallel: int) -> typing.Dict[str, typing.Any]:
+    """
+    Summary of a run for tuning --parallel: the distribution of the lastz
+    run times, memory and sizes, the stragglers and how busy the workers
+    were
+    """
+
+    ran = [run_stats for run_stats in run_times if not run_stats["cached"]]
+    run_seconds = [run_stats["elapsed"] for run_stats in ran]
+    busy_seconds = sum(run_seconds)
+
+    median = percentile(run_seconds, 50)
+    stragglers = sorted(
+        (run_stats for run_stats in ran if run_stats["elapsed"] > STRAGGLER_FACTOR * median),
+        key=lambda run_stats: run_stats["elapsed"],
+        reverse=True,
+    )
+
+    def distribution(values: typing.List[float]) -> typing.Dict[str, float]:
+        summary = {f"p{p}": percentile(values, p) for p in STATS_PERCENTILES}
+        summary["max"] = max(values, default=0)
+        return summary
+
+    return {
+        "parallel": parallel,
+        "elapsed": elapsed,
+        "commands": len(run_times),
+        "cached": len(run_times) - len(ran),
+        "lastz_seconds": busy_seconds,
+        # 1.0 when all workers were running lastz for the whole run
+        "parallel_efficiency": busy_seconds / (elapsed * parallel) if elapsed > 0 and parallel > 0 else 0.0,
+        "elapsed_percentiles": distribution(run_seconds),
+        "max_rss_bytes_percentiles": distribution([run_stats["max_rss_bytes"] for run_stats in ran]),
+        "segment_bytes_percentiles": distribution([run_stats["segment_bytes"] for run_stats in run_times]),
+        "segment_bytes": sum(run_stats["segment_bytes"] for run_stats in run_times),
+        "output_bytes": sum(run_stats["output_bytes"] for run_stats in run_times),
+        "stragglers": stragglers[:MAX_STRAGGLERS],
+        "per_command": run_times,
+    }
+
+
+def percentile(values: typing.List[float], p: float) -> float:
+    # linear interpolation between the closest ranks
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return float(values[low] + (values[high] - values[low]) * (rank - low))
+
+
+def traceback_allocation(segment_bytes: int) -> int:
+    # more segments, more chances of a long alignment
+    return min(max(segment_bytes * TRACEBACK_BYTES_PER_SEGMENT_BYTE, MIN_TRACEBACK_BYTES), MAX_TRACEBACK_BYTES)
+
+
+def traceback_size(traceback_bytes: int) -> str:
+    if traceback_bytes >= MAX_TRACEBACK_BYTES:
+        return "1.99G"
+
+    return f"{traceback_bytes >> 20}M"
+
+
+def sequence_memory(args: typing.List[str]) -> int:
+    # e.g. ref.2bit[nameparse=darkspace][multiple][subset=ref_block0.name]
+    memory_bytes = 0
+    for arg in args:
+        if not arg.startswith("--"):
+            pathname = arg.split("[", 1)[0]
+            if os.path.exists(pathname):
+                memory_bytes += os.path.getsize(pathname) * SEQUENCE_BYTES_PER_2BIT_BYTE
+
+    return memory_bytes
+
+
+def command_claim_name(command_dict: typing.Dict[str, typing.Any]) -> str:
+    return output_claim_name(command_output_file(command_dict) or "")
+
+
+def output_claim_name(output_file: str) -> str:
+    # output files are unique, as a single file name
+    return "command." + urllib.parse.quote(output_file, safe="")
+
+
+def command_output_file(command_dict: typing.Dict[str, typing.Any]) -> str | None:
+    for arg in command_dict["args"]:
+        if arg.startswith("--output="):
+            return typing.cast(str, arg[9:])
+
+    return None
+
+
+def copy_range(src_pathname: str, dst: typing.BinaryIO, offset: int = 0) -> None:
+    # in the kernel where possible, copy_file_range() between files and
+    # sendfile() into a pipe
+    dst.flush()
+    with open(src_pathname, "rb") as src:
+        remaining = os.fstat(src.fileno()).st_size - offset
+        try:
+            while remaining > 0:
+                try:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining, offset)
+                except OSError:
+                    copied = os.sendfile(dst.fileno(), src.fileno(), offset, remaining)
+                if copied == 0:
+                    break
+                offset += copied
+                remaining -= copied
+        except OSError:
+            src.seek(offset)
+            shutil.copyfileobj(src, dst)
+
+
+def predicted_makespan(costs: typing.Iterable[float], parallel: int) -> float:
+    # every command goes to the worker that becomes free first
+    loads = [0.0] * max(parallel, 1)
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+
+    return max(loads)
+
+
 def main() -> None:
     if not hasattr(tarfile, "data_filter"):
         sys.exit("ERROR: extracting may be unsafe; consider updating Python")
@@ -372,11 +1178,33 @@ def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", type=str, required=True)
     parser.add_argument("--output", type=str, required=True)
-    parser.add_argument("--parallel", type=int, default=2, required=False)
+    parser.add_argument("--parallel", type=int, required=False)
+    parser.add_argument("--memory-budget", type=str, required=False)
+    parser.add_argument("--cache-dir", type=str, required=False)
+    parser.add_argument("--cache-size", type=str, default="10G", required=False)
+    parser.add_argument("--shared-dir", type=str, required=False)
+    parser.add_argument("--lease", type=float, default=DEFAULT_LEASE, required=False)
     parser.add_argument("--debug", action="store_true", required=False)
 
     args = parser.parse_args()
-    runner = TarRunner(args.input, args.output, args.parallel, args.debug)
+
+    # the lastz workers run in galaxy/files
+    cache_dir = None
+    if args.cache_dir is not None:
+        cache_dir = os.path.abspath(args.cache_dir)
+
+    # with a memory budget as many lastz processes as there are cores and
+    # memory for
+    memory_budget = None
+    parallel = args.parallel if args.parallel is not None else 2
+    if args.memory_budget is not None:
+        memory_budget = parse_size(args.memory_budget)
+        if args.parallel is None:
+            parallel = os.cpu_count() or 1
+
+    # instances given the same --shared-dir work through one package
+    # together, e.g. on nodes sharing a filesystem
+    runner = TarRunner(args.input, args.output, parallel, cache_dir, parse_size(args.cache_size), memory_budget, args.shared_dir, args.lease, args.debug)
     runner.run()
 
 
@@ -3,72 +3,141 @@
 import argparse
 import collections
 import concurrent.futures
+import copy
+import hashlib
+import json
 import multiprocessing
 import os
 import queue
 import re
 import resource
+import shutil
 import statistics
 import subprocess
 import sys
+import tempfile
 import time
 import typing
 
+from lastz_cache import LastzCache, link_or_copy, parse_size, print_stats
+
 SENTINEL_VALUE: typing.Final = "SENTINEL"
+# maximum number of commands waiting in any queue between stages
+QUEUE_SIZE: typing.Final = 10000
+# seconds between checks that a full queue still has someone reading it
+PUT_TIMEOUT: typing.Final = 1
 # CA_SENTEL_VALUE: typing.Final = ChunkAddress(0, 0, 0, 0, 0, SENTINEL_VALUE)
+# gapped-stage lastz options that can be swept in a single run
+SWEEP_OPTIONS: typing.Final = ["ydrop", "gappedthresh"]
 RUSAGE_ATTRS: typing.Final = ["ru_utime", "ru_stime", "ru_maxrss", "ru_minflt", "ru_majflt", "ru_inblock", "ru_oublock", "ru_nvcsw", "ru_nivcsw"]
 
 
-class LastzCommands:
-    def __init__(self) -> None:
-        self.commands: dict[str, LastzCommand] = {}
-        self.kegalign_segments: KegAlignSegments = KegAlignSegments()
-
-    def add(self, line: str) -> None:
-        if line not in self.commands:
-            self.commands[line] = LastzCommand(line)
-
-        command = self.commands[line]
-        self.kegalign_segments.add(command.segments_filename)
-
-    def segments(self) -> typing.Iterator["KegAlignSegment"]:
-        for segment in self.kegalign_segments:
-            yield segment
-
-
 class LastzCommand:
-    lastz_command_regex = re.compile(r"lastz (.+?)?ref\.2bit\[nameparse=darkspace\]\[multiple\]\[subset=ref_block(\d+)\.name\] (.+?)?query\.2bit\[nameparse=darkspace\]\[subset=query_block(\d+)\.name] --format=(\S+) --ydrop=(\d+) --gappedthresh=(\d+) --strand=(minus|plus)(?: --ambiguous=(\S+))?(?: --(notrivial))?(?: --scores=(\S+))? --segments=tmp(\d+)\.block(\d+)\.r(\d+)\.(minus|plus)(?:\.split(\d+))?\.segments --output=tmp(\d+)\.block(\d+)\.r(\d+)\.(minus|plus)(?:\.split(\d+))?\.(\S+) 2> tmp(\d+)\.block(\d+)\.r(\d+)\.(minus|plus)(?:\.split(\d+))?\.err")
+    lastz_command_regex = re.compile(r"lastz (.+?)?ref\.2bit\[nameparse=darkspace\]\[multiple\]\[subset=ref_block(\d+)\.name\] (.+?)?query\.2bit\[nameparse=darkspace\]\[subset=query_block(\d+)\.name] --format=(\S+) --ydrop=(\d+) --gappedthresh=(\d+) --strand=(minus|plus)(?: --ambiguous=(\S+))?(?: --(notrivial))?(?: --scores=(\S+))? --segments=tmp(\d+)\.block(\d+)\.r(\d+)\.(minus|plus)(?:\.split(\d+))?\.segments --output=tmp(\d+)\.block(\d+)\.r(\d+)\.(minus|plus)(?:\.split(\d+))?(?:\.sweep(\d+))?\.(\S+) 2> tmp(\d+)\.block(\d+)\.r(\d+)\.(minus|plus)(?:\.split(\d+))?(?:\.sweep\d+)?\.err")
+
+    # one instance per lastz job, so keep these small: strings shared by
+    # every command are interned, filenames and argv are derived on demand
+    __slots__ = (
+        "target_filename",
+        "query_filename",
+        "ref_block",
+        "query_block",
+        "output_format",
+        "ydrop",
+        "gappedthresh",
+        "strand",
+        "ambiguous",
+        "notrivial",
+        "scoring",
+        "base_filename",
+        "interval",
+        "r_start",
+        "split",
+        "num_hsps",
+        "segment_bytes",
+        "sweep",
+    )
 
     def __init__(self, line: str) -> None:
-        self.line = line
-        self.args: list[str] = []
         self.target_filename: str = ''
         self.query_filename: str = ''
-        self.data_folder: str = ''
         self.ref_block: int = 0
         self.query_block: int = 0
         self.output_format: str = ''
         self.ydrop: int = 0
         self.gappedthresh: int = 0
-        self.strand: int | None = None
-        self.ambiguous: bool = False
-        self.nontrivial: bool = False
+        self.strand: int = 0
+        self.ambiguous: str | None = None
+        self.notrivial: bool = False
         self.scoring: str | None = None
-        self.segments_filename: str = ''
-        self.output_filename: str = ''
-        self.error_filename: str = ''
+        self.base_filename: str = ''
+        self.interval: int = 0
+        self.r_start: int = 0
+        self.split: int | None = None
+        self.num_hsps: int | None = None
+        self.segment_bytes: int | None = None
+        self.sweep: int | None = None
+
+        if line.startswith("{"):
+            self._load_json(line)
+        else:
+            self._parse_command(line)
+
+    def _load_json(self, line: str) -> None:
+        try:
+            command_dict = json.loads(line)
+            options = command_dict["options"]
+
+            self.target_filename = sys.intern(command_dict["target"])
+            self.query_filename = sys.intern(command_dict["query"])
+            self.ref_block = int(command_dict["ref_block"])
+            self.query_block = int(command_dict["query_block"])
+            self.output_format = sys.intern(options["format"])
+            self.ydrop = int(options["ydrop"])
+            self.gappedthresh = int(options["gappedthresh"])
+            self.notrivial = bool(options.get("notrivial", False))
+            self.num_hsps = command_dict.get("num_hsps")
+            self.segment_bytes = command_dict.get("segment_bytes")
+            self.sweep = command_dict.get("sweep")
+
+            if "ambiguous" in options:
+                self.ambiguous = sys.intern(options["ambiguous"])
+
+            if "scores" in options:
+                self.scoring = sys.intern(options["scores"])
+
+            strand = command_dict["strand"]
+            segments_filename = command_dict["segments"]
+            output_filename = command_dict["output"]
+            error_filename = command_dict["stderr"]
+            split = command_dict.get("split")
+            self.interval = int(command_dict["interval"])
+            self.r_start = int(command_dict["r_start"])
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+            sys.exit(f"Unkown lastz command format: {line}")
+
+        if strand == 'plus':
+            self.strand = 0
+        elif strand == 'minus':
+            self.strand = 1
+        else:
+            sys.exit(f"Unkown lastz command format: {line}")
+
+        self.base_filename = segments_filename.removesuffix(".segments")
+        if output_filename != self.output_filename or error_filename != self.error_filename:
+            sys.exit(f"Unkown lastz command format: {line}")
 
-        self._parse_command()
+        self.split = None if split is None else int(split)
 
-    def _parse_command(self) -> None:
-        match = self.lastz_command_regex.match(self.line)
+    def _parse_command(self, line: str) -> None:
+        match = self.lastz_command_regex.match(line)
         if not match:
-            sys.exit(f"Unkown lastz command format: {self.line}")
+            sys.exit(f"Unkown lastz command format: {line}")
 
-        self.data_folder = match.group(1)
+        data_folder = match.group(1) or ""
         self.ref_block = int(match.group(2))
         self.query_block = int(match.group(4))
-        self.output_format = match.group(5)
+        self.output_format = sys.intern(match.group(5))
         self.ydrop = int(match.group(6))
         self.gappedthresh = int(match.group(7))
         strand = match.group(8)
@@ -78,33 +147,16 @@ class LastzCommand:
         elif strand == 'minus':
             self.strand = 1
 
-        self.target_filename = f"{self.data_folder}ref.2bit[nameparse=darkspace][multiple][subset=ref_block{self.ref_block}.name]"
-        self.query_filename = f"{self.data_folder}query.2bit[nameparse=darkspace][subset=query_block{self.query_block}.name]"
+        self.target_filename = sys.intern(f"{data_folder}ref.2bit[nameparse=darkspace][multiple][subset=ref_block{self.ref_block}.name]")
+        self.query_filename = sys.intern(f"{data_folder}query.2bit[nameparse=darkspace][subset=query_block{self.query_block}.name]")
 
-        self.args = [
-            "lastz",
-            self.target_filename,
-            self.query_filename,
-            f"--format={self.output_format}",
-            f"--ydrop={self.ydrop}",
-            f"--gappedthresh={self.gappedthresh}",
-            f"--strand={strand}"
-        ]
-
-        ambiguous = match.group(9)
-        if ambiguous is not None:
-            self.ambiguous = True
-            self.args.append(f"--ambiguous={ambiguous}")
+        if match.group(9) is not None:
+            self.ambiguous = sys.intern(match.group(9))
 
-        nontrivial = match.group(10)
-        if nontrivial is not None:
-            self.nontrivial = True
-            self.args.append("--nontrivial")
+        self.notrivial = match.group(10) is not None
 
-        scoring = match.group(11)
-        if scoring is not None:
-            self.scoring = scoring
-            self.args.append(f"--scoring={scoring}")
+        if match.group(11) is not None:
+            self.scoring = sys.intern(match.group(11))
 
         tmp_no = int(match.group(12))
         block_no = int(match.group(13))
@@ -116,170 +168,671 @@ class LastzCommand:
         if split is not None:
             base_filename = f"{base_filename}.split{split}"
 
-        self.segments_filename = f"{base_filename}.segments"
-        self.args.append(f"--segments={self.segments_filename}")
+        if match.group(22) is not None:
+            self.sweep = int(match.group(22))
 
-        self.output_filename = f"{base_filename}.{self.output_format}"
-        self.args.append(f"--output={self.output_filename}")
+        self.base_filename = base_filename
+        self.interval = tmp_no
+        self.r_start = r_no
+        self.split = None if split is None else int(split)
 
-        self.error_filename = f"{base_filename}.err"
+    @property
+    def strand_name(self) -> str:
+        return "minus" if self.strand == 1 else "plus"
 
+    @property
+    def segments_filename(self) -> str:
+        return f"{self.base_filename}.segments"
 
-class KegAlignSegments:
-    def __init__(self) -> None:
-        self.segments: dict[str, KegAlignSegment] = {}
+    @property
+    def output_base_filename(self) -> str:
+        if self.sweep is None:
+            return self.base_filename
 
-    def add(self, filename: str) -> None:
-        if filename not in self.segments:
-            self.segments[filename] = KegAlignSegment(filename)
+        return f"{self.base_filename}.sweep{self.sweep}"
 
-    def __iter__(self) -> "KegAlignSegments":
-        return self
+    @property
+    def output_filename(self) -> str:
+        return f"{self.output_base_filename}.{self.output_format}"
 
-    def __next__(self) -> typing.Generator["KegAlignSegment", None, None]:
-        for segment in sorted(self.segments.values()):
-            yield segment
+    @property
+    def error_filename(self) -> str:
+        return f"{self.output_base_filename}.err"
 
+    @property
+    def args(self) -> list[str]:
+        args = [
+            "lastz",
+            self.target_filename,
+            self.query_filename,
+            f"--format={self.output_format}",
+            f"--ydrop={self.ydrop}",
+            f"--gappedthresh={self.gappedthresh}",
+            f"--strand={self.strand_name}"
+        ]
 
-class KegAlignSegment:
-    def __init__(self, filename: str):
-        self.filename = filename
-        self.tmp: int = 0
-        self.block: int = 0
-        self.r: int = 0
-        self.strand: int = 0
-        self.split: int | None = None
-        self.fmt: str = ""
-        self._parse_filename()
-
-    def _parse_filename(self) -> None:
-        match = re.match(r"tmp(\d+)\.block(\d+)\.r(\d+)\.(minus|plus)(?:\.split(\d+))?\.segments$", self.filename)
-        if not match:
-            sys.exit(f"Unkown segment filename format: {self.filename}")
-
-        self.tmp = int(match.group(1))
-        self.block = int(match.group(2))
-        self.r = int(match.group(3))
-
-        strand = match.group(4)
-        if strand == 'plus':
-            self.strand = 0
-        if strand == 'minus':
-            self.strand = 1
-
-        split = match.group(5)
-        if split is None:
-            self.split = None
-        else:
-            self.split = int(split)
+        if self.ambiguous is not None:
+            args.append(f"--ambiguous={self.ambiguous}")
+
+        if self.notrivial:
+            args.append("--notrivial")
+
+        if self.scoring is not None:
+            args.append(f"--scores={self.scoring}")
+
+        args.append(f"--segments={self.segments_filename}")
+        args.append(f"--output={self.output_filename}")
+
+        return args
+
+    def shell_line(self) -> str:
+        return f"{' '.join(self.args)} 2> {self.error_filename}"
+
+    def json_line(self) -> str:
+        options: dict[str, typing.Any] = {
+            "format": self.output_format,
+            "ydrop": self.ydrop,
+            "gappedthresh": self.gappedthresh,
+        }
+
+        if self.ambiguous is not None:
+            options["ambiguous"] = self.ambiguous
+
+        if self.notrivial:
+            options["notrivial"] = True
+
+        if self.scoring is not None:
+            options["scores"] = self.scoring
+
+        command_dict: dict[str, typing.Any] = {
+            "executable": "lastz",
+            "target": self.target_filename,
+            "query": self.query_filename,
+            "ref_block": self.ref_block,
+            "query_block": self.query_block,
+            "interval": self.interval,
+            "r_start": self.r_start,
+            "strand": self.strand_name,
+            "options": options,
+            "segments": self.segments_filename,
+            "output": self.output_filename,
+            "stderr": self.error_filename,
+        }
+
+        if self.split is not None:
+            command_dict["split"] = self.split
+
+        if self.num_hsps is not None:
+            command_dict["num_hsps"] = self.num_hsps
+
+        if self.segment_bytes is not None:
+            command_dict["segment_bytes"] = self.segment_bytes
+
+        if self.sweep is not None:
+            command_dict["sweep"] = self.sweep
+
+        return json.dumps(command_dict)
+
+    def sweep_variant(self, sweep: int, parameters: dict[str, int]) -> "LastzCommand":
+        variant = copy.copy(self)
+        variant.sweep = sweep
+        for name, value in parameters.items():
+            setattr(variant, name, value)
+
+        return variant
+
+
+class GpuStageCache:
+    """
+    Content-addressed cache of the kegalign (seeding and filtering) stage
+
+    An entry holds the JSON commands printed by kegalign together with the
+    segment and block name files they reference. It is keyed on the input
+    sequence contents and every option that changes the HSPs, so a rerun
+    that only changes gapped-stage options starts at lastz.
+    """
+
+    # kegalign options that change the segment files (see src/main.cpp)
+    seed_stage_options: typing.Final = [
+        "strand",
+        "ambiguous",
+        "seed",
+        "step",
+        "notransition",
+        "xdrop",
+        "hspthresh",
+        "noentropy",
+        "nogapped",
+        "target_prefix",
+        "query_prefix",
+        "wga_chunk_size",
+        "lastz_interval_size",
+        "seq_block_size",
+    ]
+
+    def __init__(self, cache_dir: str, kegalign_args: list[str], debug: bool = False) -> None:
+        self.cache_dir = cache_dir
+        self.debug = debug
+        self.options = parse_kegalign_args(kegalign_args)
+
+        if len(self.options.sequences) < 2:
+            sys.exit("Error: --cache-dir needs the target and query sequence files")
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.key = self._key()
+        self.entry_dir = os.path.join(self.cache_dir, self.key)
+
+    def _key(self) -> str:
+        key_material: dict[str, typing.Any] = {
+            "target": file_digest(self.options.sequences[0]),
+            "query": file_digest(self.options.sequences[1]),
+            "scoring": None if self.options.scoring is None else file_digest(self.options.scoring),
+        }
+
+        for option in self.seed_stage_options:
+            key_material[option] = getattr(self.options, option)
+
+        return hashlib.sha256(json.dumps(key_material, sort_keys=True).encode()).hexdigest()
+
+    def load(self, commands_filename: str) -> bool:
+        commands_pathname = os.path.join(self.entry_dir, "commands.jsonl")
+        if not os.path.exists(commands_pathname):
+            if self.debug:
+                print(f"kegalign cache miss: {self.key}", file=sys.stderr, flush=True)
+            return False
+
+        files_dir = os.path.join(self.entry_dir, "files")
+        for entry in os.scandir(files_dir):
+            link_or_copy(entry.path, entry.name)
+
+        gappedthresh = self.options.gappedthresh
+        if gappedthresh is None:
+            gappedthresh = self.options.hspthresh
+
+        with open(commands_pathname) as f, open(commands_filename, "w") as ofh:
+            for line in f:
+                command_dict = json.loads(line)
+                options = command_dict["options"]
+                base_filename = command_dict["segments"].removesuffix(".segments")
+
+                # gapped-stage options come from this run
+                options["format"] = self.options.format
+                options["ydrop"] = self.options.ydrop
+                options["gappedthresh"] = gappedthresh
+                options.pop("notrivial", None)
+                if self.options.notrivial:
+                    options["notrivial"] = True
+                options.pop("scores", None)
+                if self.options.scoring is not None:
+                    options["scores"] = self.options.scoring
+
+                command_dict["output"] = f"{base_filename}.{self.options.format}"
+                print(json.dumps(command_dict), file=ofh)
+
+        print(f"kegalign cache hit: {self.key}", file=sys.stderr, flush=True)
+        return True
+
+    def store(self, commands_filename: str) -> None:
+        if os.path.exists(self.entry_dir):
+            return
+
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        files_dir = os.path.join(tmp_dir, "files")
+        os.mkdir(files_dir)
+
+        try:
+            with open(commands_filename) as f, open(os.path.join(tmp_dir, "commands.jsonl"), "w") as ofh:
+                for line in f:
+                    if not line.startswith("{"):
+                        # only the JSON command stream can be re-targeted
+                        shutil.rmtree(tmp_dir)
+                        return
+
+                    segments_filename = json.loads(line)["segments"]
+                    link_or_copy(segments_filename, os.path.join(files_dir, segments_filename))
+                    ofh.write(line)
+
+            for entry in os.scandir("."):
+                if re.match(r"(?:ref|query)_block\d+\.name$", entry.name):
+                    link_or_copy(entry.name, os.path.join(files_dir, entry.name))
+
+            os.rename(tmp_dir, self.entry_dir)
+        except OSError:
+            # another run stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        if self.debug:
+            print(f"kegalign cache stored: {self.key}", file=sys.stderr, flush=True)
+
+
+def parse_kegalign_args(kegalign_args: list[str]) -> argparse.Namespace:
+    # mirrors the options and defaults in src/main.cpp
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("sequences", nargs="*")
+    parser.add_argument("--strand", default="both")
+    parser.add_argument("--scoring")
+    parser.add_argument("--ambiguous")
+    parser.add_argument("--seed", default="12of19")
+    parser.add_argument("--step", type=int, default=1)
+    parser.add_argument("--notransition", action="store_true")
+    parser.add_argument("--xdrop", type=int, default=910)
+    parser.add_argument("--hspthresh", type=int, default=3000)
+    parser.add_argument("--noentropy", action="store_true")
+    parser.add_argument("--nogapped", action="store_true")
+    parser.add_argument("--ydrop", type=int, default=9430)
+    parser.add_argument("--gappedthresh", type=int)
+    parser.add_argument("--notrivial", action="store_true")
+    parser.add_argument("--format", default="maf-")
+    parser.add_argument("--output")
+    parser.add_argument("--target_prefix", default="")
+    parser.add_argument("--query_prefix", default="")
+    parser.add_argument("--markend", action="store_true")
+    parser.add_argument("--json_commands", action="store_true")
+    parser.add_argument("--wga_chunk_size", type=int, default=250000)
+    parser.add_argument("--lastz_interval_size", type=int, default=10000000)
+    parser.add_argument("--seq_block_size", type=int, default=500000000)
+    parser.add_argument("--num_gpu", type=int, default=-1)
+    parser.add_argument("--num_threads", type=int, default=-1)
+    parser.add_argument("--debug", action="store_true")
+
+    options, _ = parser.parse_known_intermixed_args(kegalign_args)
+    return options
+
+
+def file_digest(pathname: str) -> str:
+    digest = hashlib.sha256()
 
-    def __lt__(self, other: "KegAlignSegment") -> bool:
-        for attr in ['strand', 'tmp', 'block', 'r', 'split']:
-            self_value = getattr(self, attr)
-            other_value = getattr(other, attr)
-            if self_value < other_value:
-                return True
-            elif self_value > other_value:
-                return False
+    try:
+        with open(pathname, "rb") as f:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+    except FileNotFoundError:
+        sys.exit(f"Error: unable to read {pathname}")
 
-        return False
+    return digest.hexdigest()
 
 
 def main() -> None:
     args, kegalign_args = parse_args()
-    lastz_commands = LastzCommands()
 
     if args.diagonal_partition:
         num_diagonal_partitioners = args.num_cpu
     else:
         num_diagonal_partitioners = 0
 
-    with multiprocessing.Manager() as manager:
-        kegalign_q: queue.Queue[str] = manager.Queue()
-        skip_kegalign = run_kegalign(args, num_diagonal_partitioners, kegalign_args, kegalign_q, lastz_commands)
+    output_filename = "lastz-commands.txt"
+    if args.output_type == "commands":
+        output_filename = args.output_file
+
+    sweep: list[dict[str, int]] = []
+    if args.sweep is not None:
+        sweep = parse_sweep(args.sweep)
+
+    cache: GpuStageCache | None = None
+    if args.cache_dir is not None:
+        cache = GpuStageCache(args.cache_dir, kegalign_args, debug=args.debug)
+
+    # every stage streams through bounded queues, so the number of
+    # commands in flight is capped no matter how many kegalign prints
+    with multiprocessing.Manager() as manager, concurrent.futures.ThreadPoolExecutor(max_workers=2) as feeders:
+        kegalign_future: concurrent.futures.Future[bool] | None = None
+        output_q: queue.Queue[str] = manager.Queue(maxsize=QUEUE_SIZE)
+        num_producers = 1
+        partition_executor = None
+        partition_futures: list[concurrent.futures.Future[None]] = []
 
-        if num_diagonal_partitioners > 0:
-            diagonal_partition_q = kegalign_q
-            kegalign_q = manager.Queue()
-            run_diagonal_partitioners(args, num_diagonal_partitioners, diagonal_partition_q, kegalign_q)
+        spool_filename = "kegalign-commands.txt"
+        spooled = True
 
-        kegalign_q.put(SENTINEL_VALUE)
-        output_q = kegalign_q
-        kegalign_q = manager.Queue()
+        if cache is not None and cache.load(spool_filename):
+            # seeding and filtering results reused, start at lastz
+            pass
+        elif cache is not None or num_diagonal_partitioners > 0:
+            # chunk size estimation needs every segment file and the cache
+            # needs the complete stage, so the kegalign stage is spooled to disk
+            kegalign_q: queue.Queue[str] = manager.Queue(maxsize=QUEUE_SIZE)
+            kegalign_future = feeders.submit(run_kegalign, args, 1, kegalign_args, kegalign_q)
+            spool_queue(kegalign_q, spool_filename)
+            skipped_kegalign = kegalign_future.result()
+
+            if cache is not None and not skipped_kegalign:
+                cache.store(spool_filename)
+        else:
+            kegalign_future = feeders.submit(run_kegalign, args, 1, kegalign_args, output_q)
+            spooled = False
+
+        if spooled and num_diagonal_partitioners > 0:
+            diagonal_partition_q: queue.Queue[str] = manager.Queue(maxsize=QUEUE_SIZE)
+            partition_executor, partition_futures = run_diagonal_partitioners(args, num_diagonal_partitioners, diagonal_partition_q, output_q)
+            feeders.submit(feed_queue, spool_filename, diagonal_partition_q, num_diagonal_partitioners, partition_futures)
+
+            num_producers = num_diagonal_partitioners
+        elif spooled:
+            feeders.submit(feed_queue, spool_filename, output_q, 1, [])
 
-        output_filename = "lastz-commands.txt"
-        if args.output_type == "commands":
-            output_filename = args.output_file
+        lastz_q: queue.Queue[str] = manager.Queue(maxsize=QUEUE_SIZE)
+        lastz_run = None
+        if args.output_type == "output":
+            lastz_run = LastzRun(args, lastz_q)
 
-        with open(output_filename, "w") as f:
-            while True:
+        package_run = None
+        if args.output_type == "tarball":
+            package_run = PackageRun(args, kegalign_args)
+
+        # the debug shortcut may still be reading the old file, so write to a
+        # temporary one. Otherwise write in place, line by line, and mark the
+        # end with a .done file so package_output.py --follow can tail it
+        done_filename = f"{output_filename}.done"
+        if os.path.exists(done_filename):
+            os.remove(done_filename)
+        write_filename = f"{output_filename}.tmp" if args.debug else output_filename
+
+        with open(write_filename, "w", buffering=1) as f:
+            while num_producers > 0:
                 line = output_q.get()
                 if line == SENTINEL_VALUE:
-                    output_q.task_done()
-                    break
+                    num_producers -= 1
+                    continue
 
-                # messy, fix this
-                if skip_kegalign:
-                    lastz_commands.add(line)
+                # once the lastz workers have failed, keep draining the
+                # producers so they can exit, lastz_run.finish() reports it
+                if lastz_run is not None and lastz_run.failed:
+                    continue
 
-                if args.output_type != "commands":
-                    kegalign_q.put(line)
+                try:
+                    command = LastzCommand(line) if sweep else None
+                    if command is not None and command.sweep is not None:
+                        # already swept, the --debug shortcut re-reads lastz-commands.txt
+                        write_command(args, line, command, f, lastz_run, package_run)
+                    elif command is not None:
+                        # every parameter set reuses the same (partitioned) segments
+                        for i, parameters in enumerate(sweep):
+                            variant = command.sweep_variant(i, parameters)
+                            write_command(args, variant.json_line(), variant, f, lastz_run, package_run)
+                    else:
+                        write_command(args, line, None, f, lastz_run, package_run)
+                except ConsumerError:
+                    assert lastz_run is not None
+                    lastz_run.failed = True
+
+        if write_filename != output_filename:
+            os.replace(write_filename, output_filename)
+        open(done_filename, "w").close()
+
+        try:
+            if kegalign_future is not None:
+                kegalign_future.result()
+            if partition_executor is not None:
+                partition_executor.shutdown()
+                for future in partition_futures:
+                    future.result()
+        finally:
+            # let the queued lastz jobs drain before reporting any failure
+            if lastz_run is not None:
+                lastz_run.finish()
+            if package_run is not None:
+                package_run.finish()
+
+        # the outputs are merged in the order of the commands file, so no
+        # per-command state is kept while the commands are streaming
+        if lastz_run is not None and sweep:
+            stem, ext = os.path.splitext(args.output_file)
+            for i, parameters in enumerate(sweep):
+                sweep_output_file = f"{stem}.sweep{i}{ext}"
+                merge_outputs(sweep_output_file, (c for c in read_commands(output_filename) if c.sweep == i))
+
+                description = ",".join(f"{name}={value}" for name, value in parameters.items())
+                print(f"sweep {i} ({description}): {sweep_output_file}", file=sys.stderr, flush=True)
+        elif lastz_run is not None:
+            merge_outputs(args.output_file, read_commands(output_filename))
+
+
+def write_command(args: argparse.Namespace, line: str, command: LastzCommand | None, f: typing.TextIO, lastz_run: "LastzRun | None" = None, package_run: "PackageRun | None" = None) -> None:
+    if lastz_run is not None:
+        lastz_run.put(line)
+
+    if args.json_commands or not line.startswith("{"):
+        output_line = line
+    else:
+        if command is None:
+            command = LastzCommand(line)
+        output_line = command.shell_line()
+
+    print(output_line, file=f)
+    if package_run is not None:
+        package_run.put(output_line)
+
+
+def read_commands(filename: str) -> typing.Iterator[LastzCommand]:
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line != "":
+                yield LastzCommand(line)
+
+
+def merge_outputs(output_file: str, commands: typing.Iterable[LastzCommand]) -> None:
+    with open(output_file, 'w') as of:
+        print("##maf version=1", file=of)
+        for lastz_command in commands:
+            with open(lastz_command.output_filename) as f:
+                for line in f:
+                    of.write(line)
+
+
+def parse_sweep(value: str) -> list[dict[str, int]]:
+    # "ydrop=9430,gappedthresh=3000;ydrop=3400" or @file with one set per line
+    if value.startswith("@"):
+        try:
+            with open(value[1:]) as f:
+                entries = [line.strip() for line in f]
+        except FileNotFoundError:
+            sys.exit(f"Error: unable to read {value[1:]}")
+    else:
+        entries = [entry.strip() for entry in value.split(";")]
+
+    sweep: list[dict[str, int]] = []
+    for entry in entries:
+        if entry == "" or entry.startswith("#"):
+            continue
+
+        parameters: dict[str, int] = {}
+        for item in entry.split(","):
+            name, sep, parameter_value = item.strip().partition("=")
+            if sep == "" or name not in SWEEP_OPTIONS:
+                sys.exit(f"Error: unknown sweep parameter: {item}")
+            try:
+                parameters[name] = int(parameter_value)
+            except ValueError:
+                sys.exit(f"Error: invalid sweep value: {item}")
 
-                print(line, file=f)
+        sweep.append(parameters)
 
-        if args.output_type == "output":
-            run_lastz(args, kegalign_q, lastz_commands)
+    if not sweep:
+        sys.exit("Error: --sweep needs at least one parameter set")
 
-            with open(args.output_file, 'w') as of:
-                print("##maf version=1", file=of)
-                for lastz_command in lastz_commands.commands.values():
-                    with open(lastz_command.output_filename) as f:
-                        for line in f:
-                            of.write(line)
+    return sweep
 
-        if args.output_type == "tarball":
-            pass
 
+def spool_queue(input_q: queue.Queue[str], filename: str) -> None:
+    with open(filename, "w") as f:
+        while True:
+            line = input_q.get()
+            if line == SENTINEL_VALUE:
+                break
 
-def run_lastz(args: argparse.Namespace, input_q: queue.Queue[str], lastz_commands: LastzCommands) -> None:
-    num_lastz_workers = args.num_cpu
+            print(line, file=f)
 
-    for _ in range(num_lastz_workers):
-        input_q.put(SENTINEL_VALUE)
 
-    if args.debug:
-        r_beg = resource.getrusage(resource.RUSAGE_CHILDREN)
-        beg: int = time.monotonic_ns()
+class ConsumerError(Exception):
+    pass
+
+
+def put_checked(output_q: queue.Queue[str], item: str, consumers: typing.Sequence[concurrent.futures.Future[typing.Any]], stop_on_error: bool = True) -> None:
+    """
+    Put an item into a bounded queue without hanging on dead consumers
+
+    Raises ConsumerError, chained to the first consumer exception, as soon as
+    a consumer failed, or, with stop_on_error False, once all of them exited.
+    Without consumer futures (read by this process) it simply blocks.
+    """
+    if not consumers:
+        output_q.put(item)
+        return
+
+    while True:
+        try:
+            output_q.put(item, timeout=PUT_TIMEOUT)
+            return
+        except queue.Full:
+            pass
+
+        errors = [future.exception() for future in consumers if future.done()]
+        failures = [e for e in errors if e is not None]
+        if len(errors) == len(consumers) or (stop_on_error and failures):
+            if failures:
+                raise ConsumerError(f"queue consumer failed: {failures[0]}") from failures[0]
+            raise ConsumerError(f"all {len(consumers)} queue consumers exited")
 
+
+def feed_queue(filename: str, output_q: queue.Queue[str], num_sentinel: int, consumers: typing.Sequence[concurrent.futures.Future[typing.Any]]) -> None:
     try:
-        with concurrent.futures.ProcessPoolExecutor(max_workers=num_lastz_workers) as executor:
-            for i in range(num_lastz_workers):
-                executor.submit(lastz_worker, input_q, i, lastz_commands)
-    except Exception as e:
-        sys.exit(f"Error: lastz failed: {e}")
+        with open(filename) as f:
+            for line in f:
+                put_checked(output_q, line.rstrip("\n"), consumers)
+    finally:
+        # the consumers still running need their sentinel to exit
+        try:
+            for _ in range(num_sentinel):
+                put_checked(output_q, SENTINEL_VALUE, consumers, stop_on_error=False)
+        except ConsumerError:
+            pass
+
+
+class LastzRun:
+    def __init__(self, args: argparse.Namespace, input_q: queue.Queue[str]) -> None:
+        self.args = args
+        self.input_q = input_q
+        self.num_workers = args.num_cpu
+
+        if args.debug:
+            self.r_beg = resource.getrusage(resource.RUSAGE_CHILDREN)
+            self.beg: int = time.monotonic_ns()
+
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers)
+        self.futures = [self.executor.submit(lastz_worker, input_q, i, args.lastz_cache_dir) for i in range(self.num_workers)]
+        self.failed = False
+
+    def put(self, line: str) -> None:
+        put_checked(self.input_q, line, self.futures)
+
+    def finish(self) -> None:
+        try:
+            for _ in range(self.num_workers):
+                put_checked(self.input_q, SENTINEL_VALUE, self.futures, stop_on_error=False)
+        except ConsumerError:
+            # the worker exceptions are reported below
+            pass
+
+        cache_stats = []
+        try:
+            self.executor.shutdown()
+            for future in self.futures:
+                cache_stats.append(future.result())
+        except BaseException as e:
+            sys.exit(f"Error: lastz failed: {e}")
+
+        if self.args.lastz_cache_dir is not None:
+            cache = LastzCache(self.args.lastz_cache_dir, self.args.lastz_cache_size)
+            print_stats(cache_stats, cache.evict())
+
+        if self.args.debug:
+            ns: int = time.monotonic_ns() - self.beg
+            r_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+            print(f"lastz clock time: {ns} ns", file=sys.stderr, flush=True)
+            for rusage_attr in RUSAGE_ATTRS:
+                value = getattr(r_end, rusage_attr) - getattr(self.r_beg, rusage_attr)
+                print(f"  lastz {rusage_attr}: {value}", file=sys.stderr, flush=True)
+
+
+class PackageRun:
+    """
+    package_output.py reading the lastz commands from a pipe, so segment
+    files are packaged while kegalign is still running
+    """
+
+    def __init__(self, args: argparse.Namespace, kegalign_args: list[str]) -> None:
+        self.args = args
+
+        run_args = [
+            sys.executable,
+            os.path.join(args.tool_directory, "package_output.py"),
+            "--tool_directory", args.tool_directory,
+            "--format_selector", package_format_selector(parse_kegalign_args(kegalign_args).format),
+            "--input", "-",
+            "--output", args.output_file,
+            "--threads", str(args.num_cpu),
+        ]
+        if args.debug:
+            run_args.append("--debug")
+
+        self.process = subprocess.Popen(run_args, stdin=subprocess.PIPE, text=True)
+
+    def put(self, line: str) -> None:
+        if self.process.stdin is not None:
+            try:
+                print(line, file=self.process.stdin)
+            except BrokenPipeError:
+                # reported by finish()
+                pass
+
+    def finish(self) -> None:
+        if self.process.stdin is not None:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        returncode = self.process.wait()
+        if returncode != 0:
+            sys.exit(f"Error: package_output.py exited with returncode {returncode}")
+
+
+def package_format_selector(lastz_format: str) -> str:
+    # the Galaxy format of the final output, see package_output.py
+    if lastz_format.startswith("maf"):
+        return "maf"
+    elif lastz_format.startswith("sam") or lastz_format.startswith("softsam"):
+        return "bam"
+    elif lastz_format == "differences":
+        return "differences"
+    else:
+        return "tabular"
 
-    if args.debug:
-        ns: int = time.monotonic_ns() - beg
-        r_end = resource.getrusage(resource.RUSAGE_CHILDREN)
-        print(f"lastz clock time: {ns} ns", file=sys.stderr, flush=True)
-        for rusage_attr in RUSAGE_ATTRS:
-            value = getattr(r_end, rusage_attr) - getattr(r_beg, rusage_attr)
-            print(f"  lastz {rusage_attr}: {value}", file=sys.stderr, flush=True)
 
+def lastz_worker(input_q: queue.Queue[str], instance: int, cache_dir: str | None = None) -> dict[str, int]:
+    cache = None
+    if cache_dir is not None:
+        cache = LastzCache(cache_dir)
 
-def lastz_worker(input_q: queue.Queue[str], instance: int, lastz_commands: LastzCommands) -> None:
     while True:
         line = input_q.get()
         if line == SENTINEL_VALUE:
-            input_q.task_done()
             break
 
-        if line not in lastz_commands.commands:
-            sys.exit(f"Error: lastz worker {instance} unexpected command format: {line}")
-
-        command = lastz_commands.commands[line]
+        # parsed here instead of being shipped from the coordinator
+        command = LastzCommand(line)
 
         if not os.path.exists(command.output_filename):
+            cache_key = None
+            if cache is not None:
+                cache_key = cache.key(command.args)
+                if cache_key is None:
+                    cache.uncacheable += 1
+                elif cache.get(cache_key, command.output_filename):
+                    continue
+
             process = subprocess.run(command.args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
 
             for line in process.stdout.splitlines():
@@ -292,38 +845,49 @@ def lastz_worker(input_q: queue.Queue[str], instance: int, lastz_commands: Lastz
             if process.returncode != 0:
                 sys.exit(f"Error: lastz {instance} exited with returncode {process.returncode}")
 
+            if cache is not None and cache_key is not None:
+                cache.put(cache_key, command.output_filename)
+
+    return {} if cache is None else cache.stats()
 
-def run_diagonal_partitioners(args: argparse.Namespace, num_workers: int, input_q: queue.Queue[str], output_q: queue.Queue[str]) -> None:
+
+def run_diagonal_partitioners(args: argparse.Namespace, num_workers: int, input_q: queue.Queue[str], output_q: queue.Queue[str]) -> tuple[concurrent.futures.ProcessPoolExecutor, list[concurrent.futures.Future[None]]]:
     chunk_size = estimate_chunk_size(args)
 
     if args.debug:
         print(f"estimated chunk size: {chunk_size}", file=sys.stderr, flush=True)
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
-        for i in range(num_workers):
-            executor.submit(diagonal_partition_worker(args, input_q, output_q, chunk_size, i))
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+    futures = [executor.submit(diagonal_partition_worker, args, input_q, output_q, chunk_size, i) for i in range(num_workers)]
 
+    return executor, futures
 
-def diagonal_partition_worker(args: argparse.Namespace, input_q: queue.Queue[str], output_q: queue.Queue[str], chunk_size: int, instance: int) -> None:
-    while True:
-        line = input_q.get()
-        if line == SENTINEL_VALUE:
-            input_q.task_done()
-            break
 
-        run_args = ["python", f"{args.tool_directory}/diagonal_partition.py", str(chunk_size)]
-        for word in line.split():
-            run_args.append(word)
-        process = subprocess.run(run_args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1, text=True)
+def diagonal_partition_worker(args: argparse.Namespace, input_q: queue.Queue[str], output_q: queue.Queue[str], chunk_size: int, instance: int) -> None:
+    try:
+        while True:
+            line = input_q.get()
+            if line == SENTINEL_VALUE:
+                break
+
+            run_args = ["python", f"{args.tool_directory}/diagonal_partition.py", str(chunk_size)]
+            if line.startswith("{"):
+                run_args.append(line)
+            else:
+                run_args.extend(line.split())
+            process = subprocess.run(run_args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1, text=True)
 
-        for line in process.stdout.splitlines():
-            output_q.put(line)
+            for line in process.stdout.splitlines():
+                output_q.put(line)
 
-        for line in process.stderr.splitlines():
-            print(line, file=sys.stderr, flush=True)
+            for line in process.stderr.splitlines():
+                print(line, file=sys.stderr, flush=True)
 
-        if process.returncode != 0:
-            sys.exit(f"Error: diagonal partitioner {instance} exited with returncode {process.returncode}")
+            if process.returncode != 0:
+                sys.exit(f"Error: diagonal partitioner {instance} exited with returncode {process.returncode}")
+    finally:
+        # always let the consumer know this producer is done
+        output_q.put(SENTINEL_VALUE)
 
 
 def estimate_chunk_size(args: argparse.Namespace) -> int:
@@ -379,47 +943,44 @@ def estimate_chunk_size(args: argparse.Namespace) -> int:
     return chunk_size
 
 
-def run_kegalign(args: argparse.Namespace, num_sentinel: int, kegalign_args: list[str], kegalign_q: queue.Queue[str], commands: LastzCommands) -> bool:
+def run_kegalign(args: argparse.Namespace, num_sentinel: int, kegalign_args: list[str], kegalign_q: queue.Queue[str]) -> bool:
     skip_kegalign: bool = False
 
-    # use the currently existing output file if it exists
-    if args.debug:
-        skip_kegalign = load_kegalign_output("lastz-commands.txt", kegalign_q)
-
-    if not skip_kegalign:
-        run_args = ["kegalign"]
-        run_args.extend(kegalign_args)
-        run_args.append("--num_threads")
-        run_args.append(str(args.num_cpu))
-        run_args.append("work/")
-
+    try:
+        # use the currently existing output file if it exists
         if args.debug:
-            beg: int = time.monotonic_ns()
-            r_beg = resource.getrusage(resource.RUSAGE_CHILDREN)
-
-        process = subprocess.run(run_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1, text=True)
-
-        for line in process.stdout.splitlines():
-            commands.add(line)
-            kegalign_q.put(line)
+            skip_kegalign = load_kegalign_output("lastz-commands.txt", kegalign_q)
 
-        if len(process.stderr) != 0:
-            for line in process.stderr.splitlines():
-                print(line, file=sys.stderr, flush=True)
+        if not skip_kegalign:
+            run_args = ["kegalign"]
+            run_args.extend(kegalign_args)
+            run_args.append("--num_threads")
+            run_args.append(str(args.num_cpu))
+            run_args.append("work/")
 
-        if process.returncode != 0:
-            sys.exit(f"Error: kegalign exited with returncode {process.returncode}")
+            if args.debug:
+                beg: int = time.monotonic_ns()
+                r_beg = resource.getrusage(resource.RUSAGE_CHILDREN)
 
-        if args.debug:
-            ns: int = time.monotonic_ns() - beg
-            r_end = resource.getrusage(resource.RUSAGE_CHILDREN)
-            print(f"kegalign clock time: {ns} ns", file=sys.stderr, flush=True)
-            for rusage_attr in RUSAGE_ATTRS:
-                value = getattr(r_end, rusage_attr) - getattr(r_beg, rusage_attr)
-                print(f"  kegalign {rusage_attr}: {value}", flush=True)
+            # stream the commands as they are printed, kegalign's stderr goes straight to ours
+            with subprocess.Popen(run_args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, bufsize=1, text=True) as process:
+                assert process.stdout is not None
+                for line in process.stdout:
+                    kegalign_q.put(line.rstrip("\n"))
 
-    for _ in range(num_sentinel):
-        kegalign_q.put(SENTINEL_VALUE)
+            if process.returncode != 0:
+                sys.exit(f"Error: kegalign exited with returncode {process.returncode}")
+
+            if args.debug:
+                ns: int = time.monotonic_ns() - beg
+                r_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+                print(f"kegalign clock time: {ns} ns", file=sys.stderr, flush=True)
+                for rusage_attr in RUSAGE_ATTRS:
+                    value = getattr(r_end, rusage_attr) - getattr(r_beg, rusage_attr)
+                    print(f"  kegalign {rusage_attr}: {value}", flush=True)
+    finally:
+        for _ in range(num_sentinel):
+            kegalign_q.put(SENTINEL_VALUE)
 
     return skip_kegalign
 
@@ -460,6 +1021,11 @@ def parse_args() -> tuple[argparse.Namespace, list[str]]:
     parser.add_argument("--markend", action="store_true", help="write a marker line just before completion")
     parser.add_argument("--num-gpu", default=-1, type=int, help="number of GPUs to use (default: %(default)s [use all GPUs])")
     parser.add_argument("--num-cpu", default=-1, type=int, help="number of CPUs to use (default: %(default)s [use all CPUs])")
+    parser.add_argument("--cache-dir", type=str, help="reuse kegalign (seeding and filtering) results cached in this directory when only gapped-stage options change")
+    parser.add_argument("--lastz-cache-dir", type=str, help="reuse lastz outputs cached in this directory across runs")
+    parser.add_argument("--lastz-cache-size", type=str, default="10G", help="evict the least recently used lastz outputs beyond this size (default: %(default)s)")
+    parser.add_argument("--sweep", type=str, help="run lastz once per gapped-stage parameter set, e.g. 'ydrop=9430,gappedthresh=3000;ydrop=3400' or @file with one set per line")
+    parser.add_argument("--json-commands", action="store_true", help="write lastz commands as JSON objects instead of shell command lines")
     parser.add_argument("--debug", action="store_true", help="print debug messages")
     parser.add_argument("--tool_directory", type=str, required=True, help="tool directory")
 
@@ -475,6 +1041,8 @@ def parse_args() -> tuple[argparse.Namespace, list[str]]:
     elif args.num_cpu > cpus_available:
         sys.exit(f"Error: additional {args.num_cpu - cpus_available} CPUs")
 
+    args.lastz_cache_size = parse_size(args.lastz_cache_size)
+
     if args.nogapped:
         kegalign_args.append("--nogapped")
 
@@ -487,6 +1055,9 @@ def parse_args() -> tuple[argparse.Namespace, list[str]]:
     if args.debug:
         kegalign_args.append("--debug")
 
+    # always read the machine-readable command stream from kegalign
+    kegalign_args.append("--json_commands")
+
     return args, kegalign_args
 
 
@@ -0,0 +1,159 @@
+"""
+Compact binary encoding of kegalign segment files, written by
+package_output.py and decoded by run_lastz_tarball.py
+
+A segment line is
+
+    target  target_start  target_end  query  query_start  query_end  strand  score
+
+The encoding is a sequence-name dictionary followed by one column per field:
+name indexes, start coordinates as the difference to the previous line,
+lengths instead of end coordinates and the strand folded into the query
+name index. Every column is stored as an array of the narrowest integer type
+holding its values, which the package compressor squeezes much further than
+the text. Files that would not decode back to the same bytes are not encoded.
+"""
+
+import array
+import itertools
+import os
+import struct
+import sys
+import tempfile
+import typing
+
+MAGIC: typing.Final = b"KEGSEG1\n"
+# narrowest first
+TYPECODES: typing.Final = ["b", "h", "i", "q"]
+NUM_FIELDS: typing.Final = 8
+NUM_COLUMNS: typing.Final = 7
+
+
+def _column_bytes(values: typing.List[int]) -> bytes:
+    low, high = (min(values), max(values)) if values else (0, 0)
+
+    for typecode in TYPECODES:
+        bits = 8 * array.array(typecode).itemsize - 1
+        if -(1 << bits) <= low and high < (1 << bits):
+            column = array.array(typecode, values)
+            if sys.byteorder == "big":
+                column.byteswap()
+            return typecode.encode() + column.tobytes()
+
+    raise OverflowError("segment value out of range")
+
+
+def _read_column(data: bytes, offset: int, count: int) -> typing.Tuple[typing.List[int], int]:
+    column = array.array(chr(data[offset]))
+    end = offset + 1 + count * column.itemsize
+    column.frombytes(data[offset + 1: end])
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column.tolist(), end
+
+
+def encode(text: bytes) -> typing.Optional[bytes]:
+    """
+    Returns the encoded segments, None if text is not a plain segment file
+    """
+
+    if not text.endswith(b"\n"):
+        return None
+
+    names: typing.Dict[bytes, int] = {}
+    columns: typing.List[typing.List[int]] = [[] for _ in range(NUM_COLUMNS)]
+    target_names, target_starts, target_lengths, query_names, query_starts, length_differences, scores = columns
+    previous_target_start = 0
+    previous_query_start = 0
+
+    try:
+        for line in text[:-1].split(b"\n"):
+            fields = line.split(b"\t")
+            if len(fields) != NUM_FIELDS or fields[6] not in [b"+", b"-"]:
+                return None
+
+            target_start, target_end = int(fields[1]), int(fields[2])
+            query_start, query_end = int(fields[4]), int(fields[5])
+
+            target_names.append(names.setdefault(fields[0], len(names)))
+            target_starts.append(target_start - previous_target_start)
+            target_lengths.append(target_end - target_start)
+            query_names.append(2 * names.setdefault(fields[3], len(names)) + (fields[6] == b"-"))
+            query_starts.append(query_start - previous_query_start)
+            length_differences.append((query_end - query_start) - (target_end - target_start))
+            scores.append(int(fields[7]))
+
+            previous_target_start = target_start
+            previous_query_start = query_start
+
+        parts = [MAGIC, struct.pack("<I", len(names))]
+        for name in names:
+            parts.append(struct.pack("<H", len(name)) + name)
+        parts.append(struct.pack("<Q", len(scores)))
+        parts.extend(_column_bytes(column) for column in columns)
+    except (ValueError, OverflowError, struct.error):
+        return None
+
+    encoded = b"".join(parts)
+
+    # leading zeros, "+1" and the like do not survive int(), only keep
+    # encodings that are lossless
+    if decode(encoded) != text:
+        return None
+
+    return encoded
+
+
+def decode(data: bytes) -> bytes:
+    offset = len(MAGIC)
+    (num_names,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+
+    names: typing.List[bytes] = []
+    for _ in range(num_names):
+        (name_size,) = struct.unpack_from("<H", data, offset)
+        names.append(data[offset + 2: offset + 2 + name_size])
+        offset += 2 + name_size
+
+    (num_lines,) = struct.unpack_from("<Q", data, offset)
+    offset += 8
+
+    columns = []
+    for _ in range(NUM_COLUMNS):
+        column, offset = _read_column(data, offset, num_lines)
+        columns.append(column)
+    target_names, target_start_deltas, target_lengths, query_names, query_start_deltas, length_differences, scores = columns
+
+    lines = []
+    strands = [b"+", b"-"]
+    target_starts = itertools.accumulate(target_start_deltas)
+    query_starts = itertools.accumulate(query_start_deltas)
+    for target_name, target_start, target_length, query_name, query_start, length_difference, score in zip(target_names, target_starts, target_lengths, query_names, query_starts, length_differences, scores):
+        query_length = target_length + length_difference
+        lines.append(b"%s\t%d\t%d\t%s\t%d\t%d\t%s\t%d\n" % (names[target_name], target_start, target_start + target_length, names[query_name >> 1], query_start, query_start + query_length, strands[query_name & 1], score))
+
+    return b"".join(lines)
+
+
+def is_encoded(pathname: str) -> bool:
+    with open(pathname, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def decode_file(pathname: str) -> bool:
+    """
+    Replaces an encoded segment file by its text, False if it was not encoded
+    """
+
+    if not is_encoded(pathname):
+        return False
+
+    with open(pathname, "rb") as f:
+        text = decode(f.read())
+
+    fd, tmp_pathname = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(pathname) or ".")
+    with os.fdopen(fd, "wb") as f:
+        f.write(text)
+    os.replace(tmp_pathname, pathname)
+
+    return True
@@ -0,0 +1,123 @@
+"""
+Claims on work items in a directory shared by several run_lastz_tarball.py
+instances, possibly on different nodes
+
+An item is claimed by creating claims/<name> with O_EXCL and finished by
+creating done/<name>. The instance holding a claim refreshes its mtime
+(a heartbeat) while it works on the item; a claim that has not been
+refreshed for a lease is taken to be left by a dead instance and can be
+taken over. Leases are compared with the local clock, so they should be
+much longer than the clock skew between the nodes.
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+import typing
+
+DEFAULT_LEASE: typing.Final = 600.0
+
+
+class SharedWorkDir:
+    def __init__(self, directory: str, lease: float = DEFAULT_LEASE, debug: bool = False) -> None:
+        self.claims_dir = os.path.join(directory, "claims")
+        self.done_dir = os.path.join(directory, "done")
+        self.lease = lease
+        self.debug = debug
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.held: typing.Set[str] = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._heartbeat_thread: threading.Thread | None = None
+
+        os.makedirs(self.claims_dir, exist_ok=True)
+        os.makedirs(self.done_dir, exist_ok=True)
+
+    def start(self) -> None:
+        # a daemon, the claims of an instance that exits go stale
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+
+    def claim(self, name: str) -> bool:
+        """
+        Returns True when this instance now holds name, False if it is done
+        or held by a live instance
+        """
+
+        if self.is_done(name):
+            return False
+
+        claim_pathname = os.path.join(self.claims_dir, name)
+        for _ in range(2):
+            try:
+                fd = os.open(claim_pathname, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._take_over(claim_pathname):
+                    return False
+                continue
+
+            with os.fdopen(fd, "w") as f:
+                f.write(f"{self.owner}\n")
+            with self._lock:
+                self.held.add(name)
+            return True
+
+        return False
+
+    def _take_over(self, claim_pathname: str) -> bool:
+        try:
+            st = os.stat(claim_pathname)
+        except FileNotFoundError:
+            # released in the meantime
+            return True
+
+        if time.time() - st.st_mtime < self.lease:
+            return False
+
+        # only one instance gets to rename the stale claim away
+        stale_pathname = f"{claim_pathname}.stale-{self.owner}"
+        try:
+            os.rename(claim_pathname, stale_pathname)
+        except FileNotFoundError:
+            return False
+
+        try:
+            if os.stat(stale_pathname).st_ino != st.st_ino:
+                # a fresh claim was made since the stat(), put it back
+                try:
+                    os.link(stale_pathname, claim_pathname)
+                except FileExistsError:
+                    pass
+                return False
+        finally:
+            os.remove(stale_pathname)
+
+        if self.debug:
+            print(f"taking over stale claim {claim_pathname}", file=sys.stderr, flush=True)
+
+        return True
+
+    def mark_done(self, name: str) -> None:
+        open(os.path.join(self.done_dir, name), "w").close()
+        with self._lock:
+            self.held.discard(name)
+
+    def is_done(self, name: str) -> bool:
+        return os.path.exists(os.path.join(self.done_dir, name))
+
+    def _heartbeat(self) -> None:
+        while not self._stopped.wait(self.lease / 4):
+            with self._lock:
+                held = list(self.held)
+            for name in held:
+                try:
+                    os.utime(os.path.join(self.claims_dir, name))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,103 @@
+import gzip
+import io
+import os
+import subprocess
+import sys
+import tarfile
+
+import pytest
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+
+import run_lastz_tarball  # noqa: E402
+
+# package_output.py BLOCK_SIZE, every block is its own gzip member
+BLOCK_SIZE = 4 << 20
+TWOBIT_SIZE = 6 << 20
+
+
+def write_package(pathname, truncate=False):
+    # a package as written by package_output.py: several gzip members
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.GNU_FORMAT) as tar:
+        for name, data in [
+            ("galaxy/commands.json", b""),
+            ("galaxy/format.txt", b"maf\n"),
+            ("galaxy/files/ref.2bit", os.urandom(TWOBIT_SIZE)),
+        ]:
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+
+    data = buffer.getvalue()
+    with open(pathname, "wb") as f:
+        for offset in range(0, len(data), BLOCK_SIZE):
+            f.write(gzip.compress(data[offset:offset + BLOCK_SIZE], mtime=0))
+        if truncate:
+            f.truncate(f.tell() // 2)
+
+
+def test_extracts_every_gzip_member(tmp_path, monkeypatch):
+    write_package(tmp_path / "package.tgz")
+    monkeypatch.chdir(tmp_path)
+
+    batch_tar = run_lastz_tarball.BatchTar("package.tgz")
+    for _ in batch_tar.ready_commands():
+        pass
+
+    assert os.path.getsize("galaxy/files/ref.2bit") == TWOBIT_SIZE
+    assert batch_tar.final_output_format() == "maf"
+
+
+def test_truncated_package_exits(tmp_path):
+    write_package(tmp_path / "package.tgz", truncate=True)
+
+    process = subprocess.run(
+        [sys.executable, os.path.join(SCRIPTS_DIR, "run_lastz_tarball.py"), "--input", "package.tgz", "--output", "out.maf"],
+        cwd=tmp_path,
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+
+    assert process.returncode != 0
+    assert "error reading input tarball" in process.stderr
+
+
+def lastz_line(i):
+    return f"lastz work/ref.2bit[nameparse=darkspace][multiple][subset=ref_block0.name] work/query.2bit[nameparse=darkspace][subset=query_block0.name] --format=maf- --ydrop=9400 --gappedthresh=3000 --strand=plus --segments=tmp{i}.block0.r0.plus.segments --output=tmp{i}.block0.r0.plus.maf- 2> tmp{i}.block0.r0.plus.err"
+
+
+def test_streamed_package_dispatches_early(tmp_path, monkeypatch):
+    pytest.importorskip("bashlex")
+    import package_output
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("work")
+    for name in ["work/ref.2bit", "work/query.2bit"]:
+        with open(name, "wb") as f:
+            f.write(os.urandom(1000))
+    for name, data in [("ref_block0.name", "s0\n"), ("query_block0.name", "s1\n")]:
+        with open(name, "w") as f:
+            f.write(data)
+    for i in range(3):
+        with open(f"tmp{i}.block0.r0.plus.segments", "w") as f:
+            f.write("s0 1 s1 1 +\n")
+
+    # a part per command, as runner.py --output-type tarball streams them
+    monkeypatch.setattr(package_output, "STREAM_PART_COMMANDS", 1)
+    monkeypatch.setattr(sys, "stdin", io.StringIO("".join(f"{lastz_line(i)}\n" for i in range(3))))
+    monkeypatch.setattr(sys, "argv", ["package_output.py", "--tool_directory", SCRIPTS_DIR, "--format_selector", "maf", "--input", "-", "--output", "package.tgz", "--threads", "1"])
+    package_output.main()
+
+    os.makedirs("run")
+    monkeypatch.chdir(tmp_path / "run")
+    batch_tar = run_lastz_tarball.BatchTar("../package.tgz")
+    ready_before_commands_json = 0
+    for batch in batch_tar.ready_commands():
+        if not os.path.exists("galaxy/commands.json"):
+            ready_before_commands_json += len(batch)
+
+    assert ready_before_commands_json == 3
+    assert len(batch_tar.commands) == 3
@@ -63,6 +63,7 @@ typedef struct Configuration {
     std::string target_prefix;
     std::string query_prefix;
     bool markend;
+    bool json_commands;
 
     // System parameters
     uint32_t wga_chunk_size;
@@ -120,7 +120,8 @@ int main(int argc, char** argv){
         ("output", po::value<std::string>(&cfg.output), "output filename")
         ("target_prefix", po::value<std::string>(&cfg.target_prefix)->default_value(""), "prefix the target sequence names with argument string")
         ("query_prefix", po::value<std::string>(&cfg.query_prefix)->default_value(""), "prefix the query sequence names with argument string")
-        ("markend", po::bool_switch(&cfg.markend), "write a marker line just before completion");
+        ("markend", po::bool_switch(&cfg.markend), "write a marker line just before completion")
+        ("json_commands", po::bool_switch(&cfg.json_commands)->default_value(false), "print each LASTZ job as a JSON object instead of a shell command line");
 
     po::options_description system_desc{"System Options"};
     system_desc.add_options()
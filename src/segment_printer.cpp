@@ -3,11 +3,70 @@
 #include <string>
 #include <map>
 #include <mutex>
+#include <stdio.h>
 #include "graph.h"
 #include "store.h"
 
 std::mutex io_lock;
 
+std::string json_string(const std::string &value){
+    std::string escaped = "\"";
+    char buf[8];
+
+    for (unsigned char c: value) {
+        if (c == '"' || c == '\\') {
+            escaped += '\\';
+            escaped += c;
+        }
+        else if (c < 0x20) {
+            snprintf(buf, sizeof(buf), "\\u%04x", c);
+            escaped += buf;
+        }
+        else {
+            escaped += c;
+        }
+    }
+
+    return escaped + "\"";
+}
+
+std::string lastz_command(uint32_t index, int r_block_index, int q_block_index, size_t r_block_start, const std::string &strand, const std::string &base_filename, uint32_t num_hsps, size_t num_bytes){
+
+    std::string target = cfg.data_folder+"ref.2bit[nameparse=darkspace][multiple][subset=ref_block"+std::to_string(r_block_index)+".name]";
+    std::string query = cfg.data_folder+"query.2bit[nameparse=darkspace][subset=query_block"+std::to_string(q_block_index)+".name]";
+    std::string segment_filename = base_filename+".segments";
+    std::string output_filename = base_filename+"."+cfg.output_format;
+    std::string err_filename = base_filename+".err";
+    std::string cmd;
+
+    if(cfg.json_commands){
+        cmd = "{\"executable\": \"lastz\", \"target\": "+json_string(target)+", \"query\": "+json_string(query);
+        cmd = cmd+", \"ref_block\": "+std::to_string(r_block_index)+", \"query_block\": "+std::to_string(q_block_index);
+        cmd = cmd+", \"interval\": "+std::to_string(index)+", \"r_start\": "+std::to_string(r_block_start)+", \"strand\": \""+strand+"\"";
+        cmd = cmd+", \"options\": {\"format\": "+json_string(cfg.output_format)+", \"ydrop\": "+std::to_string(cfg.ydrop)+", \"gappedthresh\": "+std::to_string(cfg.gappedthresh);
+        if(cfg.ambiguous != "")
+            cmd = cmd+", \"ambiguous\": "+json_string(cfg.ambiguous);
+        if(cfg.notrivial)
+            cmd = cmd+", \"notrivial\": true";
+        if(cfg.scoring_file != "")
+            cmd = cmd+", \"scores\": "+json_string(cfg.scoring_file);
+        cmd = cmd+"}, \"segments\": "+json_string(segment_filename)+", \"output\": "+json_string(output_filename)+", \"stderr\": "+json_string(err_filename);
+        cmd = cmd+", \"num_hsps\": "+std::to_string(num_hsps)+", \"segment_bytes\": "+std::to_string(num_bytes)+"}";
+    }
+    else{
+        cmd = "lastz "+target+" "+query+" --format="+ cfg.output_format +" --ydrop="+std::to_string(cfg.ydrop)+" --gappedthresh="+std::to_string(cfg.gappedthresh)+" --strand="+strand;
+        if(cfg.ambiguous != "")
+            cmd = cmd+" --ambiguous="+cfg.ambiguous;
+        if(cfg.notrivial)
+            cmd = cmd+" --notrivial";
+        if(cfg.scoring_file != "")
+            cmd = cmd+" --scores=" + cfg.scoring_file;
+        cmd = cmd+" --segments="+segment_filename+" --output="+output_filename+" 2> "+err_filename;
+    }
+
+    return cmd;
+}
+
 void segment_printer_body::operator()(printer_input input, printer_node::output_ports_type & op){
 
     auto &payload = std::get<0>(input);
@@ -38,8 +97,6 @@ void segment_printer_body::operator()(printer_input input, printer_node::output_
 
     std::string base_filename;
     std::string segment_filename;
-    std::string output_filename;
-    std::string err_filename;
     std::string cmd;
 
     uint32_t fw_num_hsps  = fw_hsps.size();
@@ -66,6 +123,8 @@ void segment_printer_body::operator()(printer_input input, printer_node::output_
 
         std::string out_str;
         FILE* segmentFile;
+        size_t fw_num_bytes = 0;
+        size_t rc_num_bytes = 0;
 
         if(fw_num_hsps > 0){
 
@@ -89,23 +148,13 @@ void segment_printer_body::operator()(printer_input input, printer_node::output_
 
                 out_str = r_chr_name[r_index] + '\t' + std::to_string(seg_r_start+1-r_chr_start[r_index]) + '\t' + std::to_string(seg_r_start+e.len+1-r_chr_start[r_index]) + '\t' + curr_q_chr + '\t' +  std::to_string(seg_q_start+1-curr_q_chr_start) + '\t' + std::to_string(seg_q_start+e.len+1-curr_q_chr_start) + "\t+\t" + std::to_string(e.score) + "\n";
                 fprintf(segmentFile, "%s", out_str.c_str());
+                fw_num_bytes += out_str.size();
             }
 
             fclose(segmentFile);
 
             if(cfg.gapped){
-
-                err_filename = base_filename+".err";
-                output_filename  = base_filename+"."+cfg.output_format;
-
-                cmd = "lastz "+cfg.data_folder+"ref.2bit[nameparse=darkspace][multiple][subset=ref_block"+std::to_string(r_block_index)+".name] "+cfg.data_folder+"query.2bit[nameparse=darkspace][subset=query_block"+std::to_string(q_block_index)+".name] --format="+ cfg.output_format +" --ydrop="+std::to_string(cfg.ydrop)+" --gappedthresh="+std::to_string(cfg.gappedthresh)+" --strand=plus";
-                if(cfg.ambiguous != "")
-                    cmd = cmd+" --ambiguous="+cfg.ambiguous;
-                if(cfg.notrivial)
-                    cmd = cmd+" --notrivial";
-                if(cfg.scoring_file != "")
-                    cmd = cmd+" --scores=" + cfg.scoring_file;
-                cmd = cmd+" --segments="+segment_filename+" --output="+output_filename+" 2> "+err_filename;
+                cmd = lastz_command(index, r_block_index, q_block_index, r_block_start, "plus", base_filename, fw_num_hsps, fw_num_bytes);
 
                 io_lock.lock();
                 printf("%s\n", cmd.c_str());
@@ -144,23 +193,13 @@ void segment_printer_body::operator()(printer_input input, printer_node::output_
 
                 out_str = r_chr_name[r_index] + '\t' + std::to_string(seg_r_start+1-r_chr_start[r_index]) + '\t' + std::to_string(seg_r_start+e.len+1-r_chr_start[r_index]) + '\t' + curr_q_chr + '\t' +  std::to_string(seg_q_start+1-curr_q_chr_start) + '\t' + std::to_string(seg_q_start+e.len+1-curr_q_chr_start) + "\t-\t" + std::to_string(e.score) + "\n";
                 fprintf(segmentFile, "%s", out_str.c_str());
+                rc_num_bytes += out_str.size();
             }
 
             fclose(segmentFile);
 
             if(cfg.gapped){
-
-                err_filename = base_filename+".err";
-                output_filename  = base_filename+"."+cfg.output_format;
-
-                cmd = "lastz "+cfg.data_folder+"ref.2bit[nameparse=darkspace][multiple][subset=ref_block"+std::to_string(r_block_index)+".name] "+cfg.data_folder+"query.2bit[nameparse=darkspace][subset=query_block"+std::to_string(q_block_index)+".name] --format="+ cfg.output_format +" --ydrop="+std::to_string(cfg.ydrop)+" --gappedthresh="+std::to_string(cfg.gappedthresh)+" --strand=minus";
-                if(cfg.ambiguous != "")
-                    cmd = cmd+" --ambiguous="+cfg.ambiguous;
-                if(cfg.notrivial)
-                    cmd = cmd+" --notrivial";
-                if(cfg.scoring_file != "")
-                    cmd = cmd+" --scores=" + cfg.scoring_file;
-                cmd = cmd+" --segments="+segment_filename+" --output="+output_filename+" 2> "+err_filename;
+                cmd = lastz_command(index, r_block_index, q_block_index, r_block_start, "minus", base_filename, rc_num_hsps, rc_num_bytes);
 
                 io_lock.lock();
                 printf("%s\n", cmd.c_str());